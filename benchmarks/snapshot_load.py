@@ -0,0 +1,123 @@
+# _*_ coding: utf-8 _*_
+"""Compares building the tables of a spec release/version from the minified
+JSON files (``compile_spec``) against loading them from the binary snapshot
+checked against those files (``load_spec_tables``): wall time and resident
+memory of the loaded tables.
+
+Usage::
+
+    python benchmarks/snapshot_load.py [R4 4.0.1] [--repeat 5]
+
+Every loader is measured in a fresh interpreter, so that memory is not shared
+between them. Results are printed as JSON.
+"""
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+BASE_PATH = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_PATH))
+
+from fhirpath_helpers.snapshot import SPEC_FILES  # noqa: E402
+from fhirpath_helpers.snapshot import build_snapshot  # noqa: E402
+
+MEASURE = """
+import json, resource, sys, time, pathlib
+sys.path.insert(0, {base_path!r})
+from fhirpath_helpers.snapshot import compile_spec
+from fhirpath_helpers.snapshot import load_spec_tables
+source = pathlib.Path({source!r})
+
+def load_json():
+    return compile_spec(source)[0]
+
+def load_snapshot():
+    return load_spec_tables(source, pathlib.Path({snapshot!r}))
+
+def rss_kb():
+    # current resident set size (linux), falls back to the peak elsewhere
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+loader = {{"json": load_json, "snapshot": load_snapshot}}[{loader!r}]
+rss_before = rss_kb()
+data = loader()
+rss = rss_kb() - rss_before
+del data
+timings = list()
+for _ in range({repeat}):
+    started = time.perf_counter()
+    data = loader()
+    timings.append(time.perf_counter() - started)
+    del data
+print(json.dumps({{"seconds": min(timings), "rss_kb": rss}}))
+"""
+
+
+def measure(loader, source, snapshot, repeat):
+    """ """
+    code = MEASURE.format(
+        base_path=str(BASE_PATH),
+        source=str(source),
+        snapshot=str(snapshot),
+        loader=loader,
+        repeat=repeat,
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+    return json.loads(output)
+
+
+def main(argv=None):
+    """ """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("release", nargs="?", default="R4")
+    parser.add_argument("version", nargs="?", default="4.0.1")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    archive = (
+        BASE_PATH
+        / "static"
+        / "HL7"
+        / "FHIR"
+        / "spec"
+        / "minified"
+        / args.release
+        / f"{args.version}.zip"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        with zipfile.ZipFile(str(archive)) as zip_ref:
+            zip_ref.extractall(str(tmp_dir))
+        source = tmp_dir / args.version
+        snapshot = tmp_dir / "spec.snapshot"
+        build_snapshot(source, snapshot)
+
+        results = {
+            "release": args.release,
+            "version": args.version,
+            "json_bytes": sum(
+                (source / f).stat().st_size for f in SPEC_FILES if f.endswith(".json")
+            ),
+            "snapshot_bytes": snapshot.stat().st_size,
+        }
+        for loader in ("json", "snapshot"):
+            results[loader] = measure(loader, source, snapshot, args.repeat)
+    results["speedup"] = round(
+        results["json"]["seconds"] / results["snapshot"]["seconds"], 2
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# _*_ coding: utf-8 _*_
+"""Benchmarks of the mapping generation and spec minification hot paths.
+
+Usage::
+
+    python benchmarks/suite.py [--release R4 --release STU3] [--repeat 5]
+        [--profiles 200 --valuesets 1000] [--filter create_resource_mapping]
+        [--output results.json] [--compare baseline.json --threshold 0.1]
+
+Runs offline: the FHIR spec is loaded from the ``static/`` archives of this
+repository and ``build_minified_json`` gets a synthetic definitions archive
+(``--profiles`` StructureDefinitions and ``--valuesets`` ValueSets/CodeSystems).
+
+Results are written as JSON (``--output``, stdout by default): the timings in
+seconds of every run plus their min/median/mean/stdev. With ``--compare``, the
+medians are compared with the ones of a previous results file (the baseline);
+any benchmark slower than ``1 + threshold`` times its baseline is reported as
+a regression and the exit status is 1.
+"""
+from contextlib import contextmanager
+from unittest import mock
+import argparse
+import gc
+import json
+import logging
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+BASE_PATH = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_PATH))
+
+import fhirpath  # noqa: E402
+from fhirpath.enums import FHIR_VERSION  # noqa: E402
+
+import fhirpath_helpers  # noqa: E402
+from fhirpath_helpers.elasticsearch.mapping import build_elements_paths  # noqa: E402
+from fhirpath_helpers.elasticsearch.mapping import create_resource_mapping  # noqa
+from fhirpath_helpers.elasticsearch.mapping import extract_elements_paths  # noqa
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings  # noqa: E402
+from fhirpath_helpers.elasticsearch.mapping import load_resources_elements  # noqa
+from fhirpath_helpers.elasticsearch.pytypes import types_mapping_registry  # noqa
+from fhirpath_helpers.fhirspec import build_minified_json  # noqa: E402
+
+STATIC_SPEC_DIR = BASE_PATH / "static" / "HL7" / "FHIR" / "spec" / "minified"
+
+
+@contextmanager
+def static_spec():
+    """Makes ``fhirpath`` load every release from the ``static/`` archives
+    (extracted into a temporary directory) instead of its own spec files."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spec_dir = pathlib.Path(tmp_dir)
+        for archive in STATIC_SPEC_DIR.glob("*/*.zip"):
+            with zipfile.ZipFile(str(archive)) as zip_ref:
+                zip_ref.extractall(str(spec_dir / archive.parent.name))
+        with mock.patch("fhirpath.fhirspec.SPEC_JSON_DIR", spec_dir), mock.patch(
+            "fhirpath_helpers.fhirspec.SPEC_JSON_DIR", spec_dir
+        ):
+            yield spec_dir
+
+
+def synthetic_definitions_archive(destination: pathlib.Path, profiles, valuesets):
+    """Writes a definitions archive (as published by HL7) of ``profiles``
+    StructureDefinitions and ``valuesets`` ValueSets/CodeSystems."""
+
+    def bundle(entries):
+        return {"resourceType": "Bundle", "type": "collection", "entry": entries}
+
+    def structure_definition(index):
+        name = f"Res{index}"
+        elements = [
+            {
+                "id": f"{name}.element{i}",
+                "path": f"{name}.element{i}",
+                "short": "x" * 80,
+                "definition": "y" * 400,
+                "min": 0,
+                "max": "*",
+                "type": [{"code": "string"}],
+            }
+            for i in range(40)
+        ]
+        return {
+            "fullUrl": f"http://hl7.org/fhir/StructureDefinition/{name}",
+            "resource": {
+                "resourceType": "StructureDefinition",
+                "id": name,
+                "url": f"http://hl7.org/fhir/StructureDefinition/{name}",
+                "name": name,
+                "kind": "resource",
+                "text": {"div": "<div>" + "z" * 2000 + "</div>"},
+                "snapshot": {"element": elements},
+                "differential": {"element": elements[:10]},
+            },
+        }
+
+    def terminology(index):
+        concepts = [{"code": f"c{i}", "display": f"Code {i}"} for i in range(20)]
+        yield {
+            "fullUrl": f"http://hl7.org/fhir/ValueSet/vs{index}",
+            "resource": {
+                "resourceType": "ValueSet",
+                "url": f"http://hl7.org/fhir/ValueSet/vs{index}",
+                "text": {"div": "<div>" + "z" * 500 + "</div>"},
+                "compose": {"include": [{"system": f"http://example.org/cs{index}"}]},
+            },
+        }
+        yield {
+            "fullUrl": f"http://hl7.org/fhir/CodeSystem/cs{index}",
+            "resource": {
+                "resourceType": "CodeSystem",
+                "url": f"http://example.org/cs{index}",
+                "text": {"div": "<div>" + "z" * 500 + "</div>"},
+                "content": "complete",
+                "concept": concepts,
+            },
+        }
+
+    profiles_bundle = bundle([structure_definition(i) for i in range(profiles)])
+    valuesets_bundle = bundle(
+        [entry for i in range(valuesets) for entry in terminology(i)]
+    )
+    with zipfile.ZipFile(str(destination), "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr("version.info", "[FHIR]\nFhirVersion=4.0.1\n")
+        zip_ref.writestr("profiles-types.json", json.dumps(bundle([]), indent=2))
+        zip_ref.writestr(
+            "profiles-resources.json", json.dumps(profiles_bundle, indent=2)
+        )
+        zip_ref.writestr("valuesets.json", json.dumps(valuesets_bundle, indent=2))
+        zip_ref.writestr("search-parameters.json", json.dumps(bundle([]), indent=2))
+    return destination
+
+
+def release_benchmarks(release):
+    """Yields ``(name, function)`` of the mapping benchmarks of ``release``."""
+    resources_elements = load_resources_elements(release)
+    elements_paths = build_elements_paths(dict(resources_elements))
+    fhir_es_mappings = types_mapping_registry(release)
+
+    def run_extract_elements_paths():
+        for elements in resources_elements.values():
+            extract_elements_paths(elements)
+
+    def run_build_elements_paths():
+        # build_elements_paths pops Resource/DomainResource
+        build_elements_paths(dict(resources_elements))
+
+    def run_create_resource_mapping():
+        for paths in elements_paths.values():
+            create_resource_mapping(paths, fhir_es_mappings)
+
+    def run_generate_mappings():
+        generate_mappings(release)
+
+    yield f"extract_elements_paths[{release}]", run_extract_elements_paths
+    yield f"build_elements_paths[{release}]", run_build_elements_paths
+    yield f"create_resource_mapping[{release}]", run_create_resource_mapping
+    yield f"generate_mappings[{release}]", run_generate_mappings
+
+
+def measure(function, repeat):
+    """Runs ``function`` ``repeat`` times (after a warm up run), with the
+    garbage collector disabled as ``timeit`` does. Returns the timings."""
+    function()
+    timings = list()
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return timings
+
+
+def summarize(timings):
+    """ """
+    return {
+        "runs": timings,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns the ``(name, baseline median, median, ratio, regression)``
+    rows of the benchmarks present in both results."""
+    rows = list()
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]["median"]
+        ratio = result["median"] / base if base else float("inf")
+        rows.append((name, base, result["median"], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def run(args):
+    """ """
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "fhirpath_helpers": fhirpath_helpers.__version__,
+            "fhirpath": fhirpath.__version__,
+            "repeat": args.repeat,
+            "profiles": args.profiles,
+            "valuesets": args.valuesets,
+        },
+        "results": dict(),
+    }
+
+    def selected(name):
+        return not args.filter or any(f in name for f in args.filter)
+
+    def record(name, function):
+        sys.stderr.write(f"{name} ...")
+        sys.stderr.flush()
+        results["results"][name] = summarize(measure(function, args.repeat))
+        sys.stderr.write(f" {results['results'][name]['median']:.4f}s\n")
+
+    with static_spec():
+        for release in args.release:
+            for name, function in release_benchmarks(release):
+                if selected(name):
+                    record(name, function)
+
+    name = f"build_minified_json[{args.profiles}x{args.valuesets}]"
+    if selected(name):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = pathlib.Path(tmp_dir)
+            archive = synthetic_definitions_archive(
+                tmp_dir / "definitions.json.zip", args.profiles, args.valuesets
+            )
+            record(
+                name,
+                lambda: build_minified_json(archive, None, tmp_dir / "minified"),
+            )
+    return results
+
+
+def main(argv=None):
+    """ """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--release",
+        action="append",
+        choices=[FHIR_VERSION.R4.name, FHIR_VERSION.STU3.name],
+        help="Release(s) to benchmark the mapping generation of (all by default).",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--profiles", type=int, default=200)
+    parser.add_argument("--valuesets", type=int, default=1000)
+    parser.add_argument(
+        "--filter",
+        action="append",
+        help="Only run the benchmarks whose name contains this (repeatable).",
+    )
+    parser.add_argument("--output", "-o", help="Results file, stdout by default.")
+    parser.add_argument("--compare", help="Baseline results file to compare to.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of the median reported as regression.",
+    )
+    args = parser.parse_args(argv)
+    args.release = args.release or [FHIR_VERSION.R4.name, FHIR_VERSION.STU3.name]
+    # the spec parser warnings are not what is measured here
+    logging.getLogger("fhirspec").setLevel(logging.CRITICAL)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+    if not args.compare:
+        return 0
+    with open(args.compare, "r", encoding="utf-8") as fp:
+        baseline = json.load(fp)
+    regressions = 0
+    for name, base, median, ratio, regression in compare(
+        results, baseline, args.threshold
+    ):
+        regressions += regression
+        sys.stderr.write(
+            f"{'REGRESSION' if regression else 'ok':<10} {name:<48} "
+            f"{base:.4f}s -> {median:.4f}s ({ratio:.2f}x)\n"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,57 @@
 """Console script for fhirpath_helpers."""
 import sys
 import click
+import datetime
+import json
 import os
 import pathlib
 from fhirpath.enums import FHIR_VERSION
-import hashlib
-import shutil
+from .elasticsearch.analysis import DEFAULT_LIMITS
+from .elasticsearch.analysis import DEFAULT_NESTED_CARDINALITY
+from .elasticsearch.analysis import analyze_mappings
+from .elasticsearch.bulk import DEFAULT_CONCURRENCY as BULK_CONCURRENCY
+from .elasticsearch.bulk import DEFAULT_MAX_DOCS
+from .elasticsearch.bulk import iter_actions
+from .elasticsearch.bulk import iter_payloads
+from .elasticsearch.bulk import post_payloads
+from .elasticsearch.bulk import write_payloads
+from .elasticsearch.bundle import DEFAULT_INDEX_PREFIX
+from .elasticsearch.bundle import OUTPUT_MODES
+from .elasticsearch.cache import cache_stats
+from .elasticsearch.cache import clear_cache
+from .elasticsearch.mapping import generate_mappings
 from .elasticsearch.mapping import make_and_write_es_mappings
-from .helpers import download
+from .elasticsearch.multivalue import MULTI_VALUE_PROFILES
+from .elasticsearch.multivalue import load_multi_value_policy
+from .elasticsearch.projection import DEFAULT_CHUNK_SIZE
+from .elasticsearch.projection import load_mappings
+from .elasticsearch.projection import project_ndjson
+from .elasticsearch.pruning import PRUNE_MODES
+from .elasticsearch.settings import SETTINGS_PROFILES
+from .helpers import COMPRESSIONS
+from .helpers import OUTPUT_FORMATS
 from .helpers import resolve_path
 from .fhirspec import build_minified_json
+from .fhirspec import build_static_archives
+from .profiling import phase
+from .profiling import profile_run
+from .snapshot import build_snapshot
+from .spec_cache import DEFAULT_CONCURRENCY
+from .spec_cache import clear_spec_cache
+from .spec_cache import fetch_all
+from .spec_cache import list_cache
+from .spec_cache import parse_size
+from .spec_cache import prune_cache
+from .spec_cache import spec_artifact_urls
+from .spec_cache import verify_cache
 
 BASE_PATH = pathlib.Path(os.path.dirname(os.path.abspath(__file__))).parent
 CACHE_DIR = BASE_PATH / ".cache"
+MAPPING_CACHE_DIR = CACHE_DIR / "mapping"
+SPEC_CACHE_DIR = CACHE_DIR / "spec"
+SPEC_CACHE_MAX_SIZE_ENVVAR = "FHIRPATH_HELPERS_SPEC_CACHE_MAX_SIZE"
+STATIC_SPEC_DIR = BASE_PATH / "static" / "HL7" / "FHIR" / "spec" / "minified"
+RELEASE_VERSIONS = {"STU3": ("3.0.1", "3.0.2"), "R4": ("4.0.0", "4.0.1")}
 all_colors = (
     "black",
     "red",
@@ -39,13 +78,156 @@ def main(ctx, args=None):
     """Console script for fhirpath_helpers."""
 
 
+def multi_value_policy(profile_or_file):
+    """ """
+    if profile_or_file is None:
+        return None
+    try:
+        return load_multi_value_policy(profile_or_file)
+    except (OSError, ValueError) as exc:
+        raise click.BadParameter(str(exc), param_hint="--multi-value")
+
+
+def size_hints_option(values):
+    """Parses the ``RESOURCE=SIZE`` values of ``--size-hint``."""
+    size_hints = dict()
+    for value in values:
+        resource, _, size = value.partition("=")
+        try:
+            size_hints[resource.strip()] = parse_size(size)
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint="--size-hint")
+        if not resource.strip() or not size_hints[resource.strip()]:
+            raise click.BadParameter(
+                f"{value!r} is not RESOURCE=SIZE", param_hint="--size-hint"
+            )
+    return size_hints or None
+
+
+def mappings_option(mappings_path):
+    """ """
+    if mappings_path is None:
+        return None
+    try:
+        return load_mappings(mappings_path)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="--mappings")
+
+
 @main.command()
 @click.option("--fhir-release", "-R", type=click.STRING)
 @click.option("--reference-analyzer", type=click.STRING)
 @click.option("--token-normalizer", type=click.STRING)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of worker processes, 0 means all available CPUs.",
+)
+@click.option("--no-cache", "-c", is_flag=True, default=False)
+@click.option(
+    "--resource",
+    "-r",
+    "resources",
+    multiple=True,
+    type=click.STRING,
+    help="Generate mapping for this resource only (repeatable).",
+)
+@click.option(
+    "--resource-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="File with resources names (one per line) to generate mapping for.",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(OUTPUT_FORMATS, case_sensitive=True),
+    default="pretty",
+)
+@click.option(
+    "--compression", type=click.Choice(COMPRESSIONS, case_sensitive=True)
+)
+@click.option(
+    "--output-mode",
+    type=click.Choice(OUTPUT_MODES, case_sensitive=True),
+    default="files",
+    help="One file per resource (files), a single JSON file keyed by resource "
+    "(bundle), a single NDJSON file (ndjson) or composable index templates "
+    "sharing one component template (index-templates).",
+)
+@click.option(
+    "--index-prefix",
+    default=DEFAULT_INDEX_PREFIX,
+    help="Indices names prefix of the index-templates output mode.",
+)
+@click.option(
+    "--settings-profile",
+    type=click.Choice(SETTINGS_PROFILES, case_sensitive=True),
+    help="Add the index settings (analyzer/normalizer definitions, mapping "
+    "limits) to the mappings: only those (analysis), tuned for the initial "
+    "load (bulk-load) or for search (serve).",
+)
+@click.option(
+    "--size-hint",
+    "size_hints",
+    multiple=True,
+    type=click.STRING,
+    help="Expected index size of a resource (i.e. Observation=200G, "
+    "repeatable), sets the number of shards of its bulk-load/serve settings.",
+)
+@click.option(
+    "--prune",
+    type=click.Choice(PRUNE_MODES, case_sensitive=True),
+    help="Map only the elements referenced by the search parameters, the "
+    "others are mapped with enabled false (disable) or left out (exclude).",
+)
+@click.option(
+    "--multi-value",
+    type=click.STRING,
+    help="Repeating elements strategy (nested, object or flattened) policy: "
+    f"a built-in profile ({', '.join(MULTI_VALUE_PROFILES)}) or a JSON policy "
+    "file. Everything is nested by default.",
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the per phase (wall/CPU time, peak RSS, bytes read/written) "
+    "JSON run report to this file.",
+)
+@click.option(
+    "--profile-stats",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Dump the cProfile stats (see pstats) to this file.",
+)
 @click.argument("output-dir")
-def es_generate_mapping(fhir_release, reference_analyzer, token_normalizer, output_dir):
+def es_generate_mapping(
+    fhir_release,
+    reference_analyzer,
+    token_normalizer,
+    jobs,
+    no_cache,
+    resources,
+    resource_file,
+    output_format,
+    compression,
+    output_mode,
+    index_prefix,
+    settings_profile,
+    size_hints,
+    prune,
+    multi_value,
+    profile,
+    profile_stats,
+    output_dir,
+):
     """ """
+    resources = list(resources)
+    if resource_file:
+        with open(resource_file, "r", encoding="utf-8") as fp:
+            for line in fp:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    resources.append(line)
     if output_dir.startswith("./"):
         output_dir = os.path.dirname(os.path.abspath(__file__)) + output_dir[1:]
     output_dir = pathlib.Path(output_dir)
@@ -55,82 +237,661 @@ def es_generate_mapping(fhir_release, reference_analyzer, token_normalizer, outp
         FHIR_VERSION[fhir_release]
     else:
         fhir_release = FHIR_VERSION.R4.name
+    size_hints = size_hints_option(size_hints)
 
     try:
-        make_and_write_es_mappings(
-            output_dir, fhir_release, reference_analyzer, token_normalizer
-        )
+        with profile_run(profile, profile_stats, command="es-generate-mapping"):
+            make_and_write_es_mappings(
+                output_dir,
+                fhir_release,
+                reference_analyzer,
+                token_normalizer,
+                jobs=jobs,
+                cache_dir=None if no_cache else MAPPING_CACHE_DIR,
+                resources=resources or None,
+                output_format=output_format,
+                compression=compression,
+                output_mode=output_mode,
+                index_prefix=index_prefix,
+                prune=prune,
+                multi_value=multi_value_policy(multi_value),
+                settings_profile=settings_profile,
+                size_hints=size_hints,
+            )
         return 0
     except Exception as exc:
         click.echo(str(exc), color=click.style("red", bold=True))
         return 1
 
 
+@main.command()
+@click.option("--fhir-release", "-R", type=click.STRING)
+@click.option(
+    "--resource",
+    "-r",
+    "resources",
+    multiple=True,
+    type=click.STRING,
+    help="Analyze the mapping of this resource only (repeatable).",
+)
+@click.option(
+    "--prune",
+    type=click.Choice(PRUNE_MODES, case_sensitive=True),
+    help="Map only the elements referenced by the search parameters, the "
+    "others are mapped with enabled false (disable) or left out (exclude).",
+)
+@click.option(
+    "--multi-value",
+    type=click.STRING,
+    help="Repeating elements strategy (nested, object or flattened) policy: "
+    f"a built-in profile ({', '.join(MULTI_VALUE_PROFILES)}) or a JSON policy "
+    "file. Everything is nested by default.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of worker processes, 0 means all available CPUs.",
+)
+@click.option(
+    "--total-fields-limit",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMITS["total_fields"],
+    help="index.mapping.total_fields.limit to check against.",
+)
+@click.option(
+    "--nested-fields-limit",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMITS["nested_fields"],
+    help="index.mapping.nested_fields.limit to check against.",
+)
+@click.option(
+    "--depth-limit",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMITS["depth"],
+    help="index.mapping.depth.limit to check against.",
+)
+@click.option(
+    "--nested-objects-limit",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LIMITS["nested_objects"],
+    help="index.mapping.nested_objects.limit to check the estimated hidden "
+    "nested documents against.",
+)
+@click.option(
+    "--nested-cardinality",
+    type=click.IntRange(min=1),
+    default=DEFAULT_NESTED_CARDINALITY,
+    help="Assumed number of values of every nested field, used to estimate "
+    "the hidden nested documents per source document.",
+)
+@click.option(
+    "--top",
+    type=click.IntRange(min=0),
+    default=5,
+    help="Number of largest subtrees listed per resource.",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, default=False, help="JSON report output."
+)
+def es_analyze_mapping(
+    fhir_release,
+    resources,
+    prune,
+    multi_value,
+    jobs,
+    total_fields_limit,
+    nested_fields_limit,
+    depth_limit,
+    nested_objects_limit,
+    nested_cardinality,
+    top,
+    as_json,
+):
+    """Reports the fields count and nesting cost of the generated mappings,
+    exits with status 1 if any exceeds a limit."""
+    fhir_release = FHIR_VERSION[fhir_release or FHIR_VERSION.R4.name].name
+    report = analyze_mappings(
+        generate_mappings(
+            fhir_release,
+            jobs=jobs,
+            resources=list(resources) or None,
+            prune=prune,
+            multi_value=multi_value_policy(multi_value),
+        ),
+        limits={
+            "total_fields": total_fields_limit,
+            "nested_fields": nested_fields_limit,
+            "depth": depth_limit,
+            "nested_objects": nested_objects_limit,
+        },
+        nested_cardinality=nested_cardinality,
+        top=top,
+    )
+    exceeded = [resource for resource, stats in report.items() if stats["exceeded"]]
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        click.echo(
+            f"{'Resource':<32} {'fields':>7} {'nested':>7} {'depth':>6} "
+            f"{'hidden':>7}  exceeded"
+        )
+        for resource, stats in report.items():
+            click.echo(
+                f"{resource:<32} {stats['total_fields']:>7} "
+                f"{stats['nested_fields']:>7} {stats['max_depth']:>6} "
+                f"{stats['hidden_docs']:>7}  {', '.join(stats['exceeded'])}"
+            )
+            for path, fields in stats["largest_subtrees"]:
+                click.echo(f"    {path:<56} {fields:>7}")
+        click.echo(
+            f"{len(exceeded)} of {len(report)} mappings exceed the limits"
+            + (f": {', '.join(exceeded)}" if exceeded else "")
+        )
+    if exceeded:
+        sys.exit(1)
+
+
+@main.command()
+@click.option(
+    "--mappings",
+    "-m",
+    "mappings_path",
+    type=click.Path(exists=True),
+    help="Directory of mapping files or mappings bundle/ndjson/index-templates "
+    "file to project onto, by default the mappings are generated.",
+)
+@click.option("--fhir-release", "-R", type=click.STRING)
+@click.option(
+    "--prune",
+    type=click.Choice(PRUNE_MODES, case_sensitive=True),
+    help="Project onto the mappings pruned to the search parameters elements "
+    "(generated mappings only).",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of worker processes, 0 means all available CPUs.",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHUNK_SIZE,
+    help="Number of resources (lines) sent to a worker at once.",
+)
+@click.argument("input-file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output-file", type=click.Path(dir_okay=False, writable=True))
+def es_project_resources(
+    mappings_path, fhir_release, prune, jobs, chunk_size, input_file, output_file
+):
+    """Strips the elements which are not mapped from the resources of the
+    NDJSON INPUT_FILE into OUTPUT_FILE (.gz/.xz compressed by suffix)."""
+    if mappings_path:
+        mappings = mappings_option(mappings_path)
+    else:
+        fhir_release = FHIR_VERSION[fhir_release or FHIR_VERSION.R4.name].name
+        mappings = generate_mappings(fhir_release, jobs=jobs, prune=prune)
+    projected, skipped = project_ndjson(
+        mappings, input_file, output_file, jobs=jobs, chunk_size=chunk_size
+    )
+    click.echo(
+        f"{projected} resources projected into {output_file}"
+        + (f", {skipped} without mapping skipped" if skipped else "")
+    )
+
+
+@main.command()
+@click.option(
+    "--output-dir",
+    "-o",
+    type=click.Path(file_okay=False, writable=True),
+    help="Write the _bulk bodies into bulk-<n>.ndjson files of this directory.",
+)
+@click.option(
+    "--url",
+    type=click.STRING,
+    help="POST the _bulk bodies to this endpoint "
+    "(i.e. http://localhost:9200/_bulk).",
+)
+@click.option(
+    "--index-prefix",
+    default=DEFAULT_INDEX_PREFIX,
+    help="Indices names prefix, the indices are named <prefix>-<resource>.",
+)
+@click.option(
+    "--mappings",
+    "-m",
+    "mappings_path",
+    type=click.Path(exists=True),
+    help="Project the resources onto these mapping files (directory) or "
+    "mappings bundle/ndjson/index-templates file, resources without mapping "
+    "are skipped.",
+)
+@click.option(
+    "--max-bytes",
+    default="5M",
+    help="Maximum size of a _bulk body (i.e. 5M).",
+)
+@click.option(
+    "--max-docs",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_DOCS,
+    help="Maximum number of resources of a _bulk body.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of worker processes, 0 means all available CPUs.",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHUNK_SIZE,
+    help="Number of resources sent to a worker at once.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=BULK_CONCURRENCY,
+    help="Maximum number of _bulk requests in flight.",
+)
+@click.argument(
+    "input-files", nargs=-1, required=True, type=click.Path(exists=True)
+)
+def es_bulk(
+    output_dir,
+    url,
+    index_prefix,
+    mappings_path,
+    max_bytes,
+    max_docs,
+    jobs,
+    chunk_size,
+    concurrency,
+    input_files,
+):
+    """Builds the _bulk request bodies of the resources of the NDJSON or
+    Bundle INPUT_FILES."""
+    if bool(output_dir) == bool(url):
+        raise click.UsageError("Exactly one of --output-dir or --url is required.")
+    try:
+        max_bytes = parse_size(max_bytes)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="--max-bytes")
+    stats = dict()
+    payloads = iter_payloads(
+        iter_actions(
+            input_files,
+            mappings_option(mappings_path),
+            index_prefix,
+            jobs=jobs,
+            chunk_size=chunk_size,
+            stats=stats,
+        ),
+        max_bytes=max_bytes,
+        max_docs=max_docs,
+    )
+    if output_dir:
+        paths = write_payloads(payloads, output_dir)
+        click.echo(f"{len(paths)} _bulk bodies written into {output_dir}")
+    else:
+        summary = post_payloads(payloads, url, concurrency=concurrency)
+        click.echo(
+            f"{summary['requests']} _bulk requests, "
+            f"{summary['items'] - summary['failed']} resources indexed, "
+            f"{summary['failed']} failed"
+        )
+        if summary["failed"]:
+            sys.exit(1)
+    if stats["skipped"]:
+        click.echo(f"{stats['skipped']} resources without mapping skipped")
+
+
+@main.group()
+def es_mapping_cache():
+    """Manage the generated elasticsearch mappings cache."""
+
+
+@es_mapping_cache.command("stats")
+def es_mapping_cache_stats():
+    """ """
+    stats = cache_stats(MAPPING_CACHE_DIR)
+    click.echo(f"Cache directory: {MAPPING_CACHE_DIR}")
+    click.echo(f"Entries: {stats['entries']}")
+    click.echo(f"Files: {stats['files']}")
+    click.echo(f"Size: {stats['size']} bytes")
+
+
+@es_mapping_cache.command("clear")
+def es_mapping_cache_clear():
+    """ """
+    clear_cache(MAPPING_CACHE_DIR)
+    click.echo(f"Cache directory {MAPPING_CACHE_DIR} has been cleared")
+
+
+@main.group()
+def cache():
+    """Manage the downloaded spec artifacts cache."""
+
+
+@cache.command("ls")
+def cache_ls():
+    """ """
+    entries = list_cache(SPEC_CACHE_DIR)
+    for entry in entries:
+        last_access = datetime.datetime.fromtimestamp(entry["last_access"])
+        click.echo(
+            f"{entry['name']}  {entry['size']:>10}  "
+            f"{last_access:%Y-%m-%d %H:%M:%S}  {entry['url']}"
+        )
+    click.echo(
+        f"Total: {len(entries)} files, "
+        f"{sum(entry['size'] for entry in entries)} bytes in {SPEC_CACHE_DIR}"
+    )
+
+
+@cache.command("verify")
+@click.option(
+    "--keep-invalid",
+    is_flag=True,
+    default=False,
+    help="Only report the invalid files, don't remove them.",
+)
+def cache_verify(keep_invalid: bool):
+    """ """
+    invalid = verify_cache(SPEC_CACHE_DIR, remove=not keep_invalid)
+    for name, reason in sorted(invalid.items()):
+        click.echo(f"{name}: {reason}", err=True)
+    if invalid:
+        sys.exit(1)
+    click.echo("All cached files are valid")
+
+
+@cache.command("prune")
+@click.option(
+    "--max-size",
+    envvar=SPEC_CACHE_MAX_SIZE_ENVVAR,
+    type=click.STRING,
+    help="Evict the least recently used files beyond this size (i.e. 500M).",
+)
+def cache_prune(max_size: str):
+    """ """
+    removed = prune_cache(SPEC_CACHE_DIR, parse_size(max_size))
+    for name in removed:
+        click.echo(f"Removed {name}")
+    click.echo(f"{len(removed)} files removed from {SPEC_CACHE_DIR}")
+
+
+@cache.command("clear")
+def cache_clear():
+    """ """
+    clear_spec_cache(SPEC_CACHE_DIR)
+    click.echo(f"Cache directory {SPEC_CACHE_DIR} has been cleared")
+
+
+def read_matrix_file(matrix_file):
+    """Reads the ``(release, version)`` pairs of a matrix file: one
+    ``<release> <version>`` pair per line, ``#`` starts a comment."""
+    matrix = list()
+    with open(matrix_file, "r", encoding="utf-8") as fp:
+        for lineno, line in enumerate(fp, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            try:
+                release, version = line.split()
+            except ValueError:
+                raise click.BadParameter(
+                    f"line {lineno}: expected '<release> <version>', got {line!r}",
+                    param_hint="--matrix",
+                )
+            matrix.append((release, version))
+    return matrix
+
+
 @main.command()
 @click.option(
     "--release",
     "-r",
-    required=True,
-    type=click.Choice(["STU3", "R4"], case_sensitive=True),
+    type=click.Choice(list(RELEASE_VERSIONS), case_sensitive=True),
 )
 @click.option(
     "--version",
     "-v",
-    required=True,
     type=click.Choice(["3.0.1", "3.0.2", "4.0.0", "4.0.1"], case_sensitive=True),
 )
-@click.option("--output-dir", "-o", required=True, type=click.STRING)
+@click.option(
+    "--all",
+    "all_versions",
+    is_flag=True,
+    default=False,
+    help="Build the static archives of every supported release/version.",
+)
+@click.option(
+    "--matrix",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Build the static archives of the release/version pairs of this file "
+    "(one '<release> <version>' per line).",
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    type=click.STRING,
+    help="Required for a single release/version, the batch mode defaults to "
+    "the static minified spec directory.",
+)
 @click.option("--no-cache", "-c", is_flag=True, default=False)
+@click.option(
+    "--output-format",
+    type=click.Choice(OUTPUT_FORMATS, case_sensitive=True),
+    default="compact",
+    help="Use pretty for human readable (indented) JSON files.",
+)
+@click.option(
+    "--compression", type=click.Choice(COMPRESSIONS, case_sensitive=True)
+)
+@click.option(
+    "--index",
+    is_flag=True,
+    default=False,
+    help="Write the byte offsets index (<file>.index.json) of every minified "
+    "bundle, for random access to its entries.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CONCURRENCY,
+    help="Maximum number of concurrent downloads.",
+)
+@click.option(
+    "--cache-max-size",
+    envvar=SPEC_CACHE_MAX_SIZE_ENVVAR,
+    type=click.STRING,
+    help="Maximum size of the spec download cache (i.e. 500M), the least "
+    "recently used files are evicted beyond it.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Batch mode worker processes, 0 (default) means all available CPUs.",
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the per phase (wall/CPU time, peak RSS, bytes read/written) "
+    "JSON run report to this file.",
+)
+@click.option(
+    "--profile-stats",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Dump the cProfile stats (see pstats) to this file.",
+)
 def fhirspec_build_minified_static_json(
-    release: str, version: str, output_dir: str, no_cache: bool
+    release: str,
+    version: str,
+    all_versions: bool,
+    matrix: str,
+    output_dir: str,
+    no_cache: bool,
+    output_format: str,
+    compression: str,
+    index: bool,
+    concurrency: int,
+    cache_max_size: str,
+    jobs: int,
+    profile: str,
+    profile_stats: str,
 ):
     """ """
-    if release == "R4" and version not in ("4.0.1", "4.0.0"):
-        sys.stderr.write(
-            f"Invalid version {version} has been provided for release {release}\n"
+    if all_versions or matrix:
+        if release or version:
+            raise click.UsageError(
+                "--release/--version can't be combined with --all/--matrix"
+            )
+        if compression:
+            raise click.UsageError("--compression is not supported in batch mode")
+        if index:
+            raise click.UsageError("--index is not supported in batch mode")
+        if all_versions:
+            pairs = [
+                (release_, version_)
+                for release_, versions in RELEASE_VERSIONS.items()
+                for version_ in versions
+            ]
+        else:
+            pairs = read_matrix_file(matrix)
+    elif release and version:
+        if index and compression:
+            raise click.UsageError("--index can't be combined with --compression")
+        pairs = [(release, version)]
+    else:
+        raise click.UsageError(
+            "--release and --version (or --all/--matrix) are required"
         )
-        return 1
-    if release == "STU3" and version not in ("3.0.1", "3.0.2"):
+
+    for release_, version_ in pairs:
+        if version_ not in RELEASE_VERSIONS.get(release_, ()):
+            sys.stderr.write(
+                f"Invalid version {version_} has been provided for release "
+                f"{release_}\n"
+            )
+            return 1
+
+    with profile_run(
+        profile, profile_stats, command="fhirspec-build-minified-static-json"
+    ):
+        urls = list()
+        for release_, version_ in pairs:
+            urls.extend(spec_artifact_urls(release_, version_))
+        with phase("download"):
+            files = fetch_all(
+                urls,
+                SPEC_CACHE_DIR,
+                use_cache=no_cache is False,
+                concurrency=concurrency,
+                max_size=parse_size(cache_max_size),
+            )
+
+        if all_versions or matrix:
+            output_dir = resolve_path(output_dir) if output_dir else STATIC_SPEC_DIR
+            tasks = [
+                dict(
+                    archive_file=files[index * 2 + 1],
+                    version_info=files[index * 2],
+                    version=version_,
+                    destination=output_dir / release_ / f"{version_}.zip",
+                    output_format=output_format,
+                )
+                for index, (release_, version_) in enumerate(pairs)
+            ]
+            with phase("minify"):
+                for task, report in build_static_archives(tasks, jobs=jobs):
+                    click.echo(f"{task['destination']} has been built")
+                    echo_size_report(report)
+            return
+
+        if not output_dir:
+            raise click.UsageError("--output-dir is required")
+        output_dir = resolve_path(output_dir)
+        if not output_dir.name == version:
+            if not output_dir.parent.name == release:
+                output_dir = output_dir / release
+            output_dir = output_dir / version
+
+        version_info_file, definition_achieve_file = files
+        with phase("minify"):
+            report = build_minified_json(
+                archive_file=definition_achieve_file,
+                version_info=version_info_file,
+                destination_dir=output_dir,
+                output_format=output_format,
+                compression=compression,
+                index=index,
+            )
+        echo_size_report(report)
+
+
+def echo_size_report(report):
+    """ """
+    total_source = total = 0
+    for filename, source_size, size in report:
+        click.echo(f"{filename}: {source_size} -> {size} bytes")
+        total_source += source_size
+        total += size
+    click.echo(
+        f"Total: {total_source} -> {total} bytes",
+        color=click.style("green"),
+    )
+
+
+@main.command()
+@click.option(
+    "--release",
+    "-r",
+    required=True,
+    type=click.Choice(list(RELEASE_VERSIONS), case_sensitive=True),
+)
+@click.option(
+    "--version",
+    "-v",
+    required=True,
+    type=click.Choice(["3.0.1", "3.0.2", "4.0.0", "4.0.1"], case_sensitive=True),
+)
+@click.option(
+    "--source",
+    "-s",
+    type=click.STRING,
+    help="Minified spec directory or zip archive, "
+    "defaults to the bundled static archive.",
+)
+@click.option("--output", "-o", required=True, type=click.STRING)
+def fhirspec_build_snapshot(release: str, version: str, source: str, output: str):
+    """Compile a minified spec release/version into a binary snapshot."""
+    if version not in RELEASE_VERSIONS[release]:
         sys.stderr.write(
             f"Invalid version {version} has been provided for release {release}\n"
         )
         return 1
-    use_cache = no_cache is False
-    cache_dir = CACHE_DIR / "spec"
-    if not cache_dir.exists():
-        cache_dir.mkdir(parents=True)
-
-    base_url = "https://github.com/nazrulworld/fhir-parser/raw/master/archives/HL7/FHIR"
-    output_dir = resolve_path(output_dir)
-    if not output_dir.name == version:
-        if not output_dir.parent.name == release:
-            output_dir = output_dir / release
-        output_dir = output_dir / version
-
-    version_info_url = f"{base_url}/{release}/{version}-version.info"
-    version_info_hash = hashlib.md5(version_info_url.encode()).digest().hex()
-    version_info_file = cache_dir / version_info_hash
-
-    definition_achieve_url = f"{base_url}/{release}/{version}-definitions.json.zip"
-    definition_achieve_hash = (
-        hashlib.md5(definition_achieve_url.encode()).digest().hex()
-    )
-    definition_achieve_file = cache_dir / definition_achieve_hash
-
-    if use_cache is False or not version_info_file.exists():
-        filename = download(version_info_url)
-        shutil.copyfile(filename, version_info_file)
-        shutil.rmtree(filename.parent)
-
-    if use_cache is False or not definition_achieve_file.exists():
-        filename = download(definition_achieve_url)
-        shutil.copyfile(filename, definition_achieve_file)
-        shutil.rmtree(filename.parent)
-
-    build_minified_json(
-        archive_file=definition_achieve_file,
-        version_info=version_info_file,
-        destination_dir=output_dir,
+    if source:
+        source = resolve_path(source)
+    else:
+        source = STATIC_SPEC_DIR / release / f"{version}.zip"
+    output = resolve_path(output)
+    if not output.parent.exists():
+        output.parent.mkdir(parents=True)
+
+    spec_hash = build_snapshot(source, output)
+    click.echo(
+        f"Snapshot ({output.stat().st_size} bytes, spec sha256 {spec_hash}) "
+        f"has been written to {output}",
+        color=click.style("green"),
     )
 
 
@@ -0,0 +1,90 @@
+# _*_ coding: utf-8 _*_
+"""Field count and nesting cost analysis of the generated mappings.
+
+Counts follow elasticsearch: every property is a field (objects and nested
+included) as is every multi-field (``fields``), every ``nested`` property is
+indexed as a hidden Lucene document per value. The hidden documents estimate
+assumes ``nested_cardinality`` values for every nested property; a nested
+property inside another one is multiplied by its parents cardinality.
+"""
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+# elasticsearch defaults of the index.mapping.*.limit settings
+DEFAULT_LIMITS = {
+    "total_fields": 1000,
+    "nested_fields": 50,
+    "depth": 20,
+    "nested_objects": 10000,
+}
+DEFAULT_NESTED_CARDINALITY = 2
+
+
+def analyze_mapping(
+    properties,
+    limits=None,
+    nested_cardinality: int = DEFAULT_NESTED_CARDINALITY,
+    top: int = 10,
+):
+    """Analyzes the mapping ``properties`` of one resource.
+
+    Returns a dict of ``total_fields``, ``nested_fields``, ``max_depth``,
+    ``hidden_docs`` (estimated hidden nested documents per source document),
+    ``largest_subtrees`` (the ``top`` ``[path, fields]`` of the object/nested
+    properties, largest first) and ``exceeded`` (the names of the exceeded
+    ``limits``, which default to ``DEFAULT_LIMITS``).
+    """
+    limits = dict(DEFAULT_LIMITS, **(limits or {}))
+    stats = {"total_fields": 0, "nested_fields": 0, "max_depth": 0, "hidden_docs": 0}
+    subtrees = list()
+
+    def walk(properties_, prefix, depth, weight):
+        """Returns the fields count of ``properties_``."""
+        count = 0
+        for name, field in properties_.items():
+            path = prefix + name
+            stats["max_depth"] = max(stats["max_depth"], depth)
+            field_count = 1 + len(field.get("fields", ()))
+            if "properties" in field:
+                child_weight = weight
+                if field.get("type") == "nested":
+                    stats["nested_fields"] += 1
+                    child_weight = weight * nested_cardinality
+                    stats["hidden_docs"] += child_weight
+                field_count += walk(
+                    field["properties"], path + ".", depth + 1, child_weight
+                )
+                subtrees.append([path, field_count])
+            count += field_count
+        return count
+
+    stats["total_fields"] = walk(properties, "", 1, 1)
+    subtrees.sort(key=lambda item: -item[1])
+    stats["largest_subtrees"] = subtrees[:top]
+    stats["exceeded"] = [
+        name
+        for name, value in (
+            ("total_fields", stats["total_fields"]),
+            ("nested_fields", stats["nested_fields"]),
+            ("depth", stats["max_depth"]),
+            ("nested_objects", stats["hidden_docs"]),
+        )
+        if value > limits[name]
+    ]
+    return stats
+
+
+def analyze_mappings(
+    mappings,
+    limits=None,
+    nested_cardinality: int = DEFAULT_NESTED_CARDINALITY,
+    top: int = 10,
+):
+    """Analyzes every resource ``mappings`` (as returned by
+    ``generate_mappings``), largest total fields first."""
+    report = {
+        resource: analyze_mapping(properties, limits, nested_cardinality, top)
+        for resource, properties in mappings.items()
+    }
+    return dict(
+        sorted(report.items(), key=lambda item: -item[1]["total_fields"])
+    )
@@ -0,0 +1,259 @@
+# _*_ coding: utf-8 _*_
+"""``_bulk`` request bodies of FHIR resources.
+
+Resources are streamed from NDJSON files or FHIR Bundles (``BundleReader``,
+one entry at a time) and turned into ``index`` actions on the index of their
+resource (``<prefix>-<resource>``, the names of the ``index-templates`` output)
+with their ``id`` as ``_id``; with mappings, they are first projected onto them
+(see ``fhirpath_helpers.elasticsearch.projection``) and resources without
+mapping are skipped.
+
+The actions are encoded in chunks of resources across a process pool (a
+bounded number of chunks in flight) and gathered into bodies of at most
+``max_bytes`` and ``max_docs`` actions, which are either written to files or
+POSTed to a ``_bulk`` endpoint through the shared (pooled) session, at most
+``concurrency`` requests at a time. A rejected body (i.e. ``413`` for an
+oversize body) or one still failing after the retries is logged and its
+actions are counted as failed, the others are still sent.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from ..fhirspec import BundleReader
+from ..helpers import RETRY_EXCEPTIONS
+from ..helpers import RETRY_STATUS_CODES
+from ..helpers import get_session
+from ..helpers import open_text
+from .bundle import DEFAULT_INDEX_PREFIX
+from .bundle import index_name
+from .projection import DEFAULT_CHUNK_SIZE
+from .projection import compile_projectors
+from .projection import read_chunks
+import json
+import logging
+import os
+import pathlib
+import requests
+import time
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+logger = logging.getLogger("fhirpath_helpers.elasticsearch.bulk")
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_MAX_DOCS = 1000
+DEFAULT_CONCURRENCY = 4
+BULK_FILE_NAME = "bulk-{0:06d}.ndjson"
+
+
+def read_resources(path_):
+    """Yields the resources of an NDJSON file (as text lines) or of a Bundle
+    or single resource JSON file (as dicts)."""
+    path_ = pathlib.Path(path_)
+    with open_text(path_) as fp:
+        if ".ndjson" in path_.suffixes:
+            for line in fp:
+                if line.strip():
+                    yield line
+            return
+        reader = BundleReader(fp)
+        for entry in reader.entries():
+            if "resource" in entry:
+                yield entry["resource"]
+        if reader.bundle.get("resourceType") not in (None, "Bundle"):
+            yield reader.bundle
+
+
+def encode_actions(resources, index_prefix=DEFAULT_INDEX_PREFIX, projectors=None):
+    """Returns ``(actions, skipped)``: the encoded ``index`` action and source
+    lines of every one of ``resources`` (dicts or JSON texts)."""
+    actions = list()
+    skipped = 0
+    for resource in resources:
+        if isinstance(resource, str):
+            resource = json.loads(resource)
+        resource_type = resource.get("resourceType")
+        if projectors is not None:
+            projector = projectors.get(resource_type)
+            if projector is None:
+                skipped += 1
+                continue
+            resource = projector(resource)
+        elif not resource_type:
+            skipped += 1
+            continue
+        action = {"_index": index_name(resource_type, index_prefix)}
+        if "id" in resource:
+            action["_id"] = resource["id"]
+        actions.append(
+            (
+                json.dumps({"index": action}, separators=(",", ":"))
+                + "\n"
+                + json.dumps(resource, separators=(",", ":"))
+                + "\n"
+            ).encode("utf-8")
+        )
+    return actions, skipped
+
+
+_worker_context = dict()
+
+
+def _init_worker(index_prefix, mappings):
+    """ """
+    _worker_context["index_prefix"] = index_prefix
+    _worker_context["projectors"] = (
+        None if mappings is None else compile_projectors(mappings)
+    )
+
+
+def _encode_actions_task(resources):
+    """ """
+    return encode_actions(
+        resources, _worker_context["index_prefix"], _worker_context["projectors"]
+    )
+
+
+def iter_actions(
+    paths,
+    mappings=None,
+    index_prefix=DEFAULT_INDEX_PREFIX,
+    jobs=1,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    stats=None,
+):
+    """Yields the encoded actions of the resources of ``paths`` in order.
+    ``mappings``: optional mapping properties keyed by resource name to
+    project the resources onto. The ``skipped`` resources are counted in the
+    ``stats`` dict."""
+    stats = stats if stats is not None else dict()
+    stats.setdefault("skipped", 0)
+    jobs = jobs or os.cpu_count() or 1
+
+    def chunks():
+        for path_ in paths:
+            yield from read_chunks(read_resources(path_), chunk_size)
+
+    if jobs <= 1:
+        projectors = None if mappings is None else compile_projectors(mappings)
+        for chunk in chunks():
+            actions, skipped = encode_actions(chunk, index_prefix, projectors)
+            stats["skipped"] += skipped
+            yield from actions
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(index_prefix, mappings)
+    ) as executor:
+        pending = deque()
+        for chunk in chunks():
+            pending.append(executor.submit(_encode_actions_task, chunk))
+            while len(pending) >= jobs * 2 or (pending and pending[0].done()):
+                actions, skipped = pending.popleft().result()
+                stats["skipped"] += skipped
+                yield from actions
+        while pending:
+            actions, skipped = pending.popleft().result()
+            stats["skipped"] += skipped
+            yield from actions
+
+
+def iter_payloads(actions, max_bytes=DEFAULT_MAX_BYTES, max_docs=DEFAULT_MAX_DOCS):
+    """Gathers the encoded ``actions`` into ``_bulk`` bodies of at most
+    ``max_bytes`` (unless a single action is larger) and ``max_docs``
+    actions."""
+    payload = list()
+    size = 0
+    for action in actions:
+        if payload and (size + len(action) > max_bytes or len(payload) >= max_docs):
+            yield b"".join(payload)
+            payload = list()
+            size = 0
+        payload.append(action)
+        size += len(action)
+    if payload:
+        yield b"".join(payload)
+
+
+def write_payloads(payloads, output_dir):
+    """Writes every payload into its ``bulk-<n>.ndjson`` file of
+    ``output_dir``. Returns the paths."""
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = list()
+    for number, payload in enumerate(payloads, 1):
+        path_ = output_dir / BULK_FILE_NAME.format(number)
+        with open(str(path_), "wb") as fp:
+            fp.write(payload)
+        paths.append(path_)
+    return paths
+
+
+def post_payload(url, payload, timeout=60, retries=3, backoff=0.5):
+    """POSTs a ``_bulk`` body, retrying on connection errors and retryable
+    statuses. Returns ``(items count, failed items count)``, all the actions
+    of the body are failed when the request is."""
+    session = get_session()
+    attempt = 0
+    try:
+        while True:
+            attempt += 1
+            try:
+                response = session.post(
+                    url,
+                    data=payload,
+                    headers={"Content-Type": "application/x-ndjson"},
+                    timeout=timeout,
+                )
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt > retries
+                ):
+                    response.raise_for_status()
+                    break
+                reason = f"HTTP {response.status_code}"
+            except RETRY_EXCEPTIONS as exc:
+                if attempt > retries:
+                    raise
+                reason = str(exc)
+            delay = backoff * (2 ** (attempt - 1))
+            logger.warning(f"_bulk request failed ({reason}), retrying in {delay} sec")
+            time.sleep(delay)
+        result = response.json()
+    except (requests.exceptions.RequestException, ValueError) as exc:
+        actions = payload.count(b"\n") // 2
+        logger.error(f"_bulk request of {actions} actions failed: {exc}")
+        return actions, actions
+    items = result.get("items", [])
+    failed = 0
+    if result.get("errors"):
+        for item in items:
+            action = next(iter(item.values()))
+            if action.get("error"):
+                failed += 1
+                logger.error(
+                    f"{action.get('_index')}/{action.get('_id')}: {action['error']}"
+                )
+    return len(items), failed
+
+
+def post_payloads(payloads, url, concurrency=DEFAULT_CONCURRENCY, timeout=60):
+    """POSTs the ``payloads`` to ``url``, at most ``concurrency`` at a time
+    (and in memory). Returns ``{"requests", "items", "failed"}`` counts."""
+    summary = {"requests": 0, "items": 0, "failed": 0}
+
+    def collect(future):
+        items, failed = future.result()
+        summary["requests"] += 1
+        summary["items"] += items
+        summary["failed"] += failed
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for payload in payloads:
+            if len(pending) >= concurrency:
+                collect(pending.popleft())
+            pending.append(executor.submit(post_payload, url, payload, timeout))
+        while pending:
+            collect(pending.popleft())
+    return summary
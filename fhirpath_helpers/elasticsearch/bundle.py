@@ -0,0 +1,217 @@
+# _*_ coding: utf-8 _*_
+"""Consolidated outputs of the generated elasticsearch mappings.
+
+Instead of one ``<Resource>.mapping.json`` file per resource, all the mapping
+documents are written into a single file:
+
+- ``bundle``: ``mappings.json``, a JSON object keyed by resource name.
+- ``ndjson``: ``mappings.ndjson``, one mapping document per line (streamable).
+- ``index-templates``: ``index-templates.json``, ready to PUT composable index
+  templates (``_index_template/<name>``) all composed of one shared component
+  template (``_component_template/<name>``) holding the properties common to
+  every resource.
+"""
+from ..helpers import compressed_path
+from ..helpers import json_dumps_kwargs
+from ..helpers import open_text
+from ..helpers import write_text_atomic
+import datetime
+import hashlib
+import json
+import logging
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+OUTPUT_MODES = ("files", "bundle", "ndjson", "index-templates")
+BUNDLE_FILE_NAMES = {
+    "bundle": "mappings.json",
+    "ndjson": "mappings.ndjson",
+    "index-templates": "index-templates.json",
+}
+DEFAULT_INDEX_PREFIX = "fhir"
+
+
+def bundle_path(output_dir, output_mode, compression=None):
+    """ """
+    return compressed_path(output_dir / BUNDLE_FILE_NAMES[output_mode], compression)
+
+
+def read_mappings_bundle(path_):
+    """Loads the mapping documents of a ``bundle`` or ``ndjson`` file, keyed by
+    resource name."""
+    with open_text(path_) as fp:
+        if ".ndjson" in path_.suffixes:
+            documents = (json.loads(line) for line in fp if line.strip())
+            return {document["resourceType"]: document for document in documents}
+        return json.load(fp)
+
+
+def index_name(resource, index_prefix: str = DEFAULT_INDEX_PREFIX):
+    """Name of the index (or index template) of ``resource``, no prefix
+    when ``index_prefix`` is empty."""
+    if not index_prefix:
+        return resource.lower()
+    return f"{index_prefix}-{resource.lower()}"
+
+
+def keep_last_updated(documents, existing_documents):
+    """Returns ``documents`` where the ones with the same ``contentHash`` as
+    in ``existing_documents`` keep their existing ``lastUpdated``, the other
+    existing ones are stamped with the current time (cached documents carry
+    the time of their cache entry)."""
+    now = datetime.datetime.now().isoformat()
+    kept = dict()
+    for resource, document in documents.items():
+        meta = existing_documents.get(resource, {}).get("meta", {})
+        if meta.get("contentHash") == document["meta"]["contentHash"]:
+            document = dict(
+                document, meta=dict(document["meta"], lastUpdated=meta["lastUpdated"])
+            )
+        elif meta:
+            document = dict(document, meta=dict(document["meta"], lastUpdated=now))
+        kept[resource] = document
+    return kept
+
+
+def properties_hash(properties):
+    """ """
+    content = json.dumps(properties, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def shared_properties(documents):
+    """Properties defined identically by every mapping document."""
+    documents = list(documents)
+    if not documents:
+        return dict()
+    shared = dict(documents[0]["mapping"]["properties"])
+    for document in documents[1:]:
+        properties = document["mapping"]["properties"]
+        for name in list(shared):
+            if properties.get(name) != shared[name]:
+                del shared[name]
+    return shared
+
+
+def build_index_templates(
+    documents, fhir_release, index_prefix: str = DEFAULT_INDEX_PREFIX
+):
+    """Builds the composable index templates of the mapping ``documents``
+    (keyed by resource name).
+
+    Every resource gets the index template ``<prefix>-<resource>`` matching the
+    ``<prefix>-<resource>`` and ``<prefix>-<resource>-*`` indices; the
+    properties shared by all the resources live in the component template
+    ``<prefix>-<release>-base`` which all the index templates are composed of.
+    The index settings of the documents (if any) are the ones of their index
+    template.
+    Returns ``{"component_templates": {name: body}, "index_templates": {name:
+    body}}``.
+    """
+    shared = shared_properties(documents.values())
+    component_name = f"{index_prefix}-{fhir_release.lower()}-base"
+    component_templates = {
+        component_name: {
+            "template": {"mappings": {"properties": shared}},
+            "_meta": {
+                "versionId": fhir_release,
+                "contentHash": properties_hash(shared),
+            },
+        }
+    }
+    index_templates = dict()
+    for resource in sorted(documents):
+        document = documents[resource]
+        properties = {
+            name: value
+            for name, value in document["mapping"]["properties"].items()
+            if name not in shared
+        }
+        name = index_name(resource, index_prefix)
+        template = {"mappings": {"properties": properties}}
+        if "settings" in document:
+            template["settings"] = document["settings"]
+        index_templates[name] = {
+            "index_patterns": [name, f"{name}-*"],
+            "composed_of": [component_name],
+            "template": template,
+            "_meta": {
+                "resourceType": resource,
+                "versionId": fhir_release,
+                "contentHash": document["meta"]["contentHash"],
+            },
+        }
+    return {
+        "component_templates": component_templates,
+        "index_templates": index_templates,
+    }
+
+
+def templates_mappings(templates):
+    """Mapping properties, keyed by resource name, of the index templates
+    (``build_index_templates`` output): the properties of the component
+    templates an index template is composed of, then its own."""
+    components = templates.get("component_templates", {})
+    mappings = dict()
+    for template in templates["index_templates"].values():
+        properties = dict()
+        for component in template.get("composed_of", ()):
+            properties.update(
+                components[component]["template"]["mappings"]["properties"]
+            )
+        properties.update(template["template"]["mappings"]["properties"])
+        mappings[template["_meta"]["resourceType"]] = properties
+    return mappings
+
+
+def write_mappings_bundle(
+    output_dir,
+    documents,
+    fhir_release,
+    output_mode="bundle",
+    output_format="pretty",
+    compression=None,
+    index_prefix: str = DEFAULT_INDEX_PREFIX,
+):
+    """Writes the mapping ``documents`` (keyed by resource name) into the
+    single file of ``output_mode``. As for the per resource files, unchanged
+    documents keep their ``lastUpdated`` and the file is only (atomically)
+    rewritten when its content changes.
+
+    Returns ``(path, status)``, status is ``added``, ``changed`` or
+    ``unchanged``.
+    """
+    path_ = bundle_path(output_dir, output_mode, compression)
+    documents = {resource: documents[resource] for resource in sorted(documents)}
+    existing_text = None
+    existing_documents = dict()
+    exists = path_.exists()
+    if exists:
+        try:
+            with open_text(path_) as fp:
+                existing_text = fp.read()
+            if output_mode != "index-templates":
+                existing_documents = read_mappings_bundle(path_)
+        except (OSError, EOFError, ValueError, KeyError):
+            logging.warning(f"Existing mappings bundle {path_} is unreadable")
+    documents = keep_last_updated(documents, existing_documents)
+
+    if output_mode == "ndjson":
+        text = "".join(
+            json.dumps(document, **json_dumps_kwargs("compact")) + "\n"
+            for document in documents.values()
+        )
+    elif output_mode == "bundle":
+        text = json.dumps(documents, **json_dumps_kwargs(output_format))
+    elif output_mode == "index-templates":
+        text = json.dumps(
+            build_index_templates(documents, fhir_release, index_prefix),
+            **json_dumps_kwargs(output_format),
+        )
+    else:
+        raise ValueError(f"Unknown output mode {output_mode}")
+
+    if text == existing_text:
+        return path_, "unchanged"
+    write_text_atomic(path_, text)
+    return path_, "changed" if exists else "added"
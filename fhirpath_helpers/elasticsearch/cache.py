@@ -0,0 +1,152 @@
+# _*_ coding: utf-8 _*_
+"""Content addressed on-disk cache of generated elasticsearch mappings.
+
+Every cache entry is a directory named by the hash of everything the generated
+mappings depend on; it holds the ``<Resource>.mapping.json`` files as they were
+written by ``make_and_write_es_mappings``.
+"""
+from ..fhirspec import spec_source_dir
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+MAPPING_FILE_SUFFIX = ".mapping.json"
+
+
+def hash_files(files, hash_=None):
+    """ """
+    hash_ = hash_ or hashlib.sha256()
+    for file_ in files:
+        hash_.update(file_.name.encode())
+        with open(str(file_), "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                hash_.update(chunk)
+    return hash_
+
+
+def spec_content_hash(fhir_release):
+    """ """
+    spec_dir = spec_source_dir(fhir_release)
+    return hash_files(sorted(p for p in spec_dir.iterdir() if p.is_file())).hexdigest()
+
+
+def generator_source_hash():
+    """Hash of the modules which the mappings output depends on
+    (the datatypes mapping from ``pytypes``, the mapping builder and its
+    pruning, multi-value strategies, index settings and their mapping limits,
+    the spec loading of the selected resources) and of the ``fhirpath``
+    version."""
+    import fhirpath
+
+    from .. import fhirspec
+    from . import analysis
+    from . import mapping
+    from . import multivalue
+    from . import pruning
+    from . import pytypes
+    from . import settings
+
+    hash_ = hash_files(
+        [
+            pathlib.Path(pytypes.__file__),
+            pathlib.Path(mapping.__file__),
+            pathlib.Path(pruning.__file__),
+            pathlib.Path(multivalue.__file__),
+            pathlib.Path(settings.__file__),
+            pathlib.Path(analysis.__file__),
+            pathlib.Path(fhirspec.__file__),
+        ]
+    )
+    hash_.update(f"fhirpath {fhirpath.__version__}".encode())
+    return hash_.hexdigest()
+
+
+def mapping_cache_key(
+    fhir_release,
+    reference_analyzer=None,
+    token_normalizer=None,
+    resources=None,
+    output_format="pretty",
+    compression=None,
+    prune=None,
+    multi_value=None,
+    settings_profile=None,
+    size_hints=None,
+):
+    """ """
+    from fhirpath_helpers import __version__
+
+    key = {
+        "fhir_release": fhir_release,
+        "spec": spec_content_hash(fhir_release),
+        "reference_analyzer": reference_analyzer,
+        "token_normalizer": token_normalizer,
+        "generator": generator_source_hash(),
+        "version": __version__,
+        "resources": sorted(set(resources)) if resources is not None else None,
+        "output_format": output_format,
+        "compression": compression,
+        "prune": prune,
+        "multi_value": multi_value,
+        "settings_profile": settings_profile,
+        "size_hints": size_hints or None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_cached_mappings(cache_dir: pathlib.Path, key: str):
+    """Returns the list of cached mapping files for ``key`` or None if there
+    is no cache entry yet."""
+    entry = cache_dir / key
+    if not entry.is_dir():
+        return None
+    return sorted(entry.glob("*" + MAPPING_FILE_SUFFIX + "*"))
+
+
+def store_mappings(cache_dir: pathlib.Path, key: str, writer):
+    """Creates the cache entry for ``key``; ``writer`` is called with the
+    (temporary) directory where the mapping files should be written.
+
+    The entry is renamed into place once complete, so that concurrent runs
+    never see a partial entry.
+    """
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix=".tmp-", dir=str(cache_dir)))
+    try:
+        writer(tmp_dir)
+        os.rename(str(tmp_dir), str(cache_dir / key))
+    except OSError:
+        if not (cache_dir / key).is_dir():
+            raise
+        # another run has just stored the same entry
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(str(tmp_dir))
+    return get_cached_mappings(cache_dir, key)
+
+
+def cache_stats(cache_dir: pathlib.Path):
+    """ """
+    stats = {"entries": 0, "files": 0, "size": 0}
+    if not cache_dir.exists():
+        return stats
+    for entry in cache_dir.iterdir():
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        stats["entries"] += 1
+        for file_ in entry.iterdir():
+            stats["files"] += 1
+            stats["size"] += file_.stat().st_size
+    return stats
+
+
+def clear_cache(cache_dir: pathlib.Path):
+    """ """
+    if cache_dir.exists():
+        shutil.rmtree(str(cache_dir))
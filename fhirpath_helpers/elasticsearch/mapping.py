@@ -1,11 +1,37 @@
 # _*_ coding: utf-8 _*_
 from collections import defaultdict
-from fhirpath.fhirspec import FhirSpecFactory
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from fhirpath.enums import FHIR_VERSION
-from .pytypes import fhir_types_mapping
+from ..fhirspec import BASE_RESOURCES
+from ..fhirspec import fhir_spec_from_release
+from ..helpers import compressed_path
+from ..helpers import json_dumps_kwargs
+from ..helpers import open_text
+from ..helpers import write_text_atomic
+from ..profiling import collect_phase
+from ..profiling import is_active
+from ..profiling import phase
+from ..profiling import record_phases
+from .bundle import DEFAULT_INDEX_PREFIX
+from .bundle import write_mappings_bundle
+from .cache import MAPPING_FILE_SUFFIX
+from .cache import get_cached_mappings
+from .cache import mapping_cache_key
+from .cache import store_mappings
+from .multivalue import apply_inner_strategies
+from .multivalue import resolve_strategy
+from .multivalue import with_strategy
+from .pruning import prune_mapping
+from .pruning import resources_referenced_trees
+from .pytypes import types_mapping_registry
+from .settings import profile_settings
+from .settings import resource_settings
 import datetime
+import hashlib
 import json
 import logging
+import os
 import click
 
 __author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
@@ -29,35 +55,195 @@ ignored_datatype = [
 
 
 def generate_mappings(
-    fhir_release=None, reference_analyzer=None, token_normalizer=None
+    fhir_release=None,
+    reference_analyzer=None,
+    token_normalizer=None,
+    jobs=1,
+    resources=None,
+    prune=None,
+    multi_value=None,
 ):
-    """ """
+    """``resources``: optional list of resources names to generate mappings for,
+    by default all domain resources are mapped.
+
+    ``prune`` (``disable`` or ``exclude``) restricts the mappings to the
+    elements referenced by the search parameters, see
+    ``fhirpath_helpers.elasticsearch.pruning``. ``multi_value``: the
+    repeating elements policy, see ``fhirpath_helpers.elasticsearch.multivalue``.
+    """
     fhir_release = fhir_release or FHIR_VERSION.R4.name
-    fhir_spec = FhirSpecFactory.from_release(fhir_release)
+    elements_paths = load_elements_paths(fhir_release, resources)
+    fhir_es_mappings = types_mapping_registry(
+        fhir_release, reference_analyzer, token_normalizer
+    )
+    pruning = load_pruning(fhir_release, elements_paths, prune)
+    with phase("mappings"):
+        return dict(
+            run_resources_tasks(
+                _create_resource_mapping_task,
+                elements_paths,
+                fhir_es_mappings,
+                jobs,
+                pruning=pruning,
+                multi_value=multi_value,
+            )
+        )
+
+
+def load_settings(settings_profile, reference_analyzer=None, token_normalizer=None):
+    """Returns the index settings of ``settings_profile``, or None."""
+    if settings_profile is None:
+        return None
+    return profile_settings(settings_profile, reference_analyzer, token_normalizer)
+
+
+def load_pruning(fhir_release, elements_paths, prune=None):
+    """Returns the ``(mode, referenced trees)`` pruning of the resources of
+    ``elements_paths``, or None without ``prune`` mode."""
+    if prune is None:
+        return None
+    return prune, resources_referenced_trees(fhir_release, elements_paths)
+
+
+def load_elements_paths(fhir_release, resources=None):
+    """ """
+    with phase("spec_load"):
+        resources_elements = load_resources_elements(fhir_release, resources)
+    with phase("path_extraction"):
+        return build_elements_paths(resources_elements)
+
+
+def load_resources_elements(fhir_release, resources=None):
+    """Returns the StructureDefinition elements of the domain resources (and of
+    Resource/DomainResource), keyed by resource name."""
+    fhir_spec = fhir_spec_from_release(fhir_release, resources)
 
     resources_elements = defaultdict()
 
     for definition_klass in fhir_spec.profiles.values():
-        if definition_klass.name in ("Resource", "DomainResource"):
+        if definition_klass.name in BASE_RESOURCES:
             # exceptional
             resources_elements[definition_klass.name] = definition_klass.elements
             continue
         if definition_klass.structure.subclass_of != "DomainResource":
             # we accept domain resource only
             continue
+        if resources is not None and definition_klass.name not in resources:
+            continue
 
         resources_elements[definition_klass.name] = definition_klass.elements
 
-    elements_paths = build_elements_paths(resources_elements)
+    if resources is not None:
+        unknown = set(resources) - set(resources_elements)
+        if unknown:
+            raise ValueError(
+                f"Unknown domain resource(s) for {fhir_release}: "
+                f"{', '.join(sorted(unknown))}"
+            )
+
+    return resources_elements
+
+
+def run_resources_tasks(
+    task,
+    elements_paths,
+    fhir_es_mappings,
+    jobs=1,
+    *args,
+    pruning=None,
+    multi_value=None,
+):
+    """Yields ``(resource, result)`` of ``task`` for every resource of
+    ``elements_paths``, in the same order as serial execution.
+
+    With ``jobs`` greater than 1 (or 0/None for all available CPUs) tasks are
+    distributed over a process pool; the elements paths, the types mapping, the
+    ``pruning`` (see ``load_pruning``) and the ``multi_value`` policy are sent
+    only once to each worker (through the pool initializer). The ``profile``
+    flag of the context tells the tasks to collect their phases (see
+    ``fhirpath_helpers.profiling.collect_phase``).
+    """
+    resources = list(elements_paths)
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(resources))
+    context = {
+        "elements_paths": elements_paths,
+        "fhir_es_mappings": fhir_es_mappings,
+        "pruning": pruning,
+        "multi_value": multi_value,
+        "profile": is_active(),
+    }
+
+    if jobs <= 1:
+        for resource in resources:
+            yield task(context, resource, *args)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(context,)
+    ) as executor:
+        yield from executor.map(
+            partial(_run_worker_task, task, args=args),
+            resources,
+            chunksize=max(1, len(resources) // (jobs * 4)),
+        )
 
-    mappings = dict()
-    fhir_es_mappings = fhir_types_mapping(
-        fhir_release, reference_analyzer, token_normalizer
-    )
-    for resource, paths_def in elements_paths.items():
-        mappings[resource] = create_resource_mapping(paths_def, fhir_es_mappings)
 
-    return mappings
+_worker_context = dict()
+
+
+def _init_worker(context):
+    """ """
+    _worker_context.update(context)
+
+
+def _run_worker_task(task, resource, args=()):
+    """ """
+    return task(_worker_context, resource, *args)
+
+
+def _create_resource_mapping_task(context, resource):
+    """ """
+    mappings = create_resource_mapping(
+        context["elements_paths"][resource],
+        context["fhir_es_mappings"],
+        context["multi_value"],
+    )
+    if context["pruning"] is not None:
+        mode, trees = context["pruning"]
+        mappings = prune_mapping(mappings, trees[resource], mode)
+    return resource, mappings
+
+
+def _write_resource_mapping_task(
+    context,
+    resource,
+    output_dir,
+    fhir_release,
+    output_format,
+    compression,
+    settings=None,
+    size_hints=None,
+):
+    """Returns ``(resource, (path, status, phases))``, ``phases`` being the
+    collected phases when profiling (None otherwise)."""
+    phases = list() if context["profile"] else None
+    with collect_phase("construction", phases):
+        resource, mappings = _create_resource_mapping_task(context, resource)
+    with collect_phase("write", phases):
+        path_ = resource_mapping_path(output_dir, resource, compression)
+        status = update_mapping_file(
+            path_,
+            add_mapping_meta(
+                resource,
+                mappings,
+                fhir_release,
+                settings,
+                (size_hints or {}).get(resource),
+            ),
+            output_format,
+        )
+    return resource, (str(path_), status, phases)
 
 
 def build_elements_paths(resources_elements):
@@ -106,90 +292,467 @@ def apply_default_paths(resource, defaults, container):
         container.append((_path, code, multiple))
 
 
-def add_mapping_meta(resource, mappings, fhir_release):
-    """ """
+def mapping_content_hash(data):
+    """sha256 of the mapping document, its ``lastUpdated`` and ``contentHash``
+    meta excluded."""
+    meta = {
+        key: value
+        for key, value in data["meta"].items()
+        if key not in ("lastUpdated", "contentHash")
+    }
+    content = json.dumps(dict(data, meta=meta), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def add_mapping_meta(resource, mappings, fhir_release, settings=None, size_hint=None):
+    """``settings``: the index settings of a profile (see
+    ``fhirpath_helpers.elasticsearch.settings``), added with the mapping limits
+    and the number of shards (from ``size_hint``) of the resource."""
     data = {
         "resourceType": resource,
         "meta": {
             "lastUpdated": datetime.datetime.now().isoformat(),
             "versionId": fhir_release,
         },
-        "mapping": {"properties": mappings},
     }
+    if settings is not None:
+        data["settings"] = resource_settings(settings, mappings, size_hint)
+    data["mapping"] = {"properties": mappings}
+    data["meta"]["contentHash"] = mapping_content_hash(data)
     return data
 
 
-def create_resource_mapping(elements_paths_def, fhir_es_mappings):
+def build_elements_tree(elements_paths_def):
+    """Group the flat list of elements paths into a tree of path segments.
+
+    Every node is a ``[definition, children]`` pair, where ``definition`` is the
+    ``(path, code, multiple)`` tuple (None for a segment without its own element,
+    i.e. the resource itself) and ``children`` maps the child segment name to its
+    node, in the order the elements were defined.
+    """
+    tree = dict()
+    for path_def in elements_paths_def:
+        children = tree
+        for segment in path_def[0].split("."):
+            try:
+                node = children[segment]
+            except KeyError:
+                node = children[segment] = [None, dict()]
+            children = node[1]
+        if node[0] is None:
+            # first definition wins
+            node[0] = path_def
+    return tree
+
+
+def create_resource_mapping(elements_paths_def, fhir_es_mappings, multi_value=None):
+    """``multi_value``: optional multi-value policy (see
+    ``fhirpath_helpers.elasticsearch.multivalue``), repeating elements are
+    mapped as nested by default."""
+    return map_elements_tree(
+        build_elements_tree(elements_paths_def), fhir_es_mappings, multi_value
+    )
+
+
+def map_elements_tree(elements_tree, fhir_es_mappings, multi_value=None):
     """ """
     mapped = dict()
 
-    # this generator function iterates over the list of elements definitions and groups
-    # children elements with their parents to reflect thbe nested resource structure.
-    def iterate_elements():
-        mapped_elements = list()
-        for path, code, multiple in elements_paths_def:
-            if path not in mapped_elements:
-                children = [
-                    x
-                    for x in elements_paths_def
-                    if x[0].startswith(path) and x[0] != path
-                ]
-                mapped_elements.extend([path, *[c[0] for c in children]])
-                yield path, code, multiple, children
-
-    for path, code, multiple, children in iterate_elements():
-        name = path.split(".")[-1]
-        try:
-            map_ = fhir_es_mappings[code].copy()
-        except KeyError:
-            # if the element is of type BackboneElement, it means that it has no external definition
-            # and needs to be mapped dynamically based on its inline definition.
-            if code == "BackboneElement":
-                map_ = {
-                    "type": "nested",
-                    "properties": create_resource_mapping(children, fhir_es_mappings),
-                }
-            elif code in ignored_datatype:
-                logging.debug(
-                    f"{path} won't be indexed in elasticsearch: type {code} is ignored"
-                )
+    def walk(children):
+        for name, (path_def, sub_children) in children.items():
+            if path_def is None:
+                # segment without definition, its children belong to this level.
+                walk(sub_children)
                 continue
+            path, code, multiple = path_def
+            try:
+                # shared template, copied below only if altered
+                map_ = fhir_es_mappings[code]
+            except KeyError:
+                # if the element is of type BackboneElement, it means that it has no
+                # external definition and needs to be mapped dynamically based on
+                # its inline definition.
+                if code == "BackboneElement":
+                    map_ = {
+                        "type": "nested",
+                        "properties": map_elements_tree(
+                            sub_children, fhir_es_mappings, multi_value
+                        ),
+                    }
+                elif code in ignored_datatype:
+                    logging.debug(
+                        f"{path} won't be indexed in elasticsearch: "
+                        f"type {code} is ignored"
+                    )
+                    continue
+                else:
+                    logging.debug(
+                        f"{path} won't be indexed in elasticsearch: "
+                        f"type {code} is unknown"
+                    )
+                    raise
+
+            if multi_value is None:
+                if multiple and "type" not in map_:
+                    map_ = {**map_, "type": "nested"}
             else:
-                logging.debug(
-                    f"{path} won't be indexed in elasticsearch: type {code} is unknown"
-                )
-                raise
+                if code != "BackboneElement":
+                    # the children of a BackboneElement got their strategy
+                    # (datatype rules included) while mapping them above
+                    map_ = apply_inner_strategies(map_, path, multi_value)
+                if (multiple and "type" not in map_) or code == "BackboneElement":
+                    map_ = with_strategy(
+                        map_, resolve_strategy(multi_value, path, code)
+                    )
+
+            mapped[name] = map_
+
+    walk(elements_tree)
+    mapped["resourceType"] = fhir_es_mappings["code"]
+    return mapped
 
-        if multiple and "type" not in map_:
-            map_.update({"type": "nested"})
 
-        mapped[name] = map_
+def write_resource_mapping(
+    output_dir,
+    resource,
+    mappings,
+    fhir_release,
+    verbose=True,
+    output_format="pretty",
+    compression=None,
+    settings=None,
+    size_hint=None,
+):
+    """Writes the mapping file of ``resource`` unless it already holds the
+    same mapping (see ``update_mapping_file``)."""
+    path_ = resource_mapping_path(output_dir, resource, compression)
+    status = update_mapping_file(
+        path_,
+        add_mapping_meta(resource, mappings, fhir_release, settings, size_hint),
+        output_format,
+    )
+    path_ = str(path_)
+    if verbose:
+        echo_mapping_written(path_, status)
+    return path_
+
+
+def resource_mapping_path(output_dir, resource, compression=None):
+    """ """
+    return compressed_path(
+        output_dir / "{0}{1}".format(resource, MAPPING_FILE_SUFFIX), compression
+    )
 
-    mapped["resourceType"] = fhir_es_mappings["code"].copy()
-    return mapped
 
+def update_mapping_file(path_, data, output_format="pretty"):
+    """Writes the mapping document ``data`` to ``path_`` (atomically), unless
+    the file already holds the same text. When the existing file has the same
+    ``contentHash``, its ``lastUpdated`` is kept, otherwise ``data`` replacing
+    it is stamped with the current time (a cached document carries the time
+    of its cache entry): the timestamp only moves forward, with the mapping
+    content.
 
-def write_resource_mapping(output_dir, resource, mappings, fhir_release):
+    Returns the status: ``added``, ``changed`` or ``unchanged``.
+    """
+    existing_text = existing = None
+    exists = path_.exists()
+    if exists:
+        try:
+            with open_text(path_) as fp:
+                existing_text = fp.read()
+            existing = json.loads(existing_text)
+        except (OSError, EOFError, ValueError):
+            logging.warning(f"Existing mapping file {path_} is unreadable")
+
+    meta = (existing or {}).get("meta", {})
+    if meta.get("contentHash") == data["meta"]["contentHash"]:
+        data = dict(data, meta=dict(data["meta"], lastUpdated=meta["lastUpdated"]))
+    elif meta:
+        now = datetime.datetime.now().isoformat()
+        data = dict(data, meta=dict(data["meta"], lastUpdated=now))
+    text = json.dumps(data, **json_dumps_kwargs(output_format))
+    if text == existing_text:
+        return "unchanged"
+    write_text_atomic(path_, text)
+    return "changed" if exists else "added"
+
+
+def echo_mapping_written(path_, status="changed"):
     """ """
-    data = add_mapping_meta(resource, mappings, fhir_release)
-    path_ = str(output_dir / "{0}.mapping.json".format(resource))
-    with open(path_, "w") as fp:
-        text = json.dumps(data, indent=2)
-        fp.write(text)
+    if status == "unchanged":
+        click.echo(f"Mapping File {path_} is unchanged")
+        return
     click.echo(f"Mapping File has been written to {path_}", color=click.style("green"))
 
 
-def make_and_write_es_mappings(
-    output_dir, fhir_release, reference_analyzer=None, token_normalizer=None
-):
+def echo_mappings_summary(output_dir, statuses):
     """ """
-    resources_mappings = generate_mappings(
-        fhir_release, reference_analyzer, token_normalizer
-    )
-
-    for resource, mappings in resources_mappings.items():
-        write_resource_mapping(output_dir, resource, mappings, fhir_release)
+    counts = {status: 0 for status in ("added", "changed", "unchanged")}
+    for status in statuses:
+        counts[status] += 1
     click.echo(
-        f"Total {len(resources_mappings)} files have been written to {output_dir}",
+        f"Total {len(statuses)} mapping files in {output_dir}: "
+        f"{counts['added']} added, {counts['changed']} changed, "
+        f"{counts['unchanged']} unchanged",
         color=click.style("green"),
     )
+
+
+def make_and_write_es_mappings(
+    output_dir,
+    fhir_release,
+    reference_analyzer=None,
+    token_normalizer=None,
+    jobs=1,
+    cache_dir=None,
+    resources=None,
+    output_format="pretty",
+    compression=None,
+    output_mode="files",
+    index_prefix=DEFAULT_INDEX_PREFIX,
+    prune=None,
+    multi_value=None,
+    settings_profile=None,
+    size_hints=None,
+):
+    """When ``cache_dir`` is given, mapping files are served from (or stored to)
+    the content addressed cache there, without loading the spec on a hit.
+
+    ``output_mode`` other than ``files`` (one file per resource) writes all the
+    mappings into a single file, see ``fhirpath_helpers.elasticsearch.bundle``.
+
+    With a ``settings_profile``, the mapping documents carry their index
+    settings, see ``fhirpath_helpers.elasticsearch.settings``; ``size_hints``
+    (expected index size in bytes keyed by resource name) sets their number of
+    shards.
+    """
+    fhir_release = fhir_release or FHIR_VERSION.R4.name
+
+    if output_mode != "files":
+        documents = mapping_documents(
+            fhir_release,
+            reference_analyzer,
+            token_normalizer,
+            jobs,
+            cache_dir,
+            resources,
+            prune,
+            multi_value,
+            settings_profile,
+            size_hints,
+        )
+        with phase("write"):
+            path_, status = write_mappings_bundle(
+                output_dir,
+                documents,
+                fhir_release,
+                output_mode,
+                output_format,
+                compression,
+                index_prefix,
+            )
+        echo_mapping_written(str(path_), status)
+        click.echo(
+            f"{len(documents)} resources mappings in {path_}",
+            color=click.style("green"),
+        )
+        return [str(path_)]
+
+    if cache_dir is None:
+        paths, statuses = write_es_mappings(
+            output_dir,
+            fhir_release,
+            reference_analyzer,
+            token_normalizer,
+            jobs,
+            resources=resources,
+            output_format=output_format,
+            compression=compression,
+            with_statuses=True,
+            prune=prune,
+            multi_value=multi_value,
+            settings_profile=settings_profile,
+            size_hints=size_hints,
+        )
+    else:
+        with phase("cache_key"):
+            key = mapping_cache_key(
+                fhir_release,
+                reference_analyzer,
+                token_normalizer,
+                resources,
+                output_format,
+                compression,
+                prune,
+                multi_value,
+                settings_profile,
+                size_hints,
+            )
+        cached_files = get_cached_mappings(cache_dir, key)
+        if cached_files is None:
+            cached_files = store_mappings(
+                cache_dir,
+                key,
+                lambda tmp_dir: write_es_mappings(
+                    tmp_dir,
+                    fhir_release,
+                    reference_analyzer,
+                    token_normalizer,
+                    jobs,
+                    verbose=False,
+                    resources=resources,
+                    output_format=output_format,
+                    compression=compression,
+                    prune=prune,
+                    multi_value=multi_value,
+                    settings_profile=settings_profile,
+                    size_hints=size_hints,
+                ),
+            )
+        else:
+            click.echo(f"Using cached mappings {cache_dir / key}")
+        paths = list()
+        statuses = list()
+        with phase("write"):
+            for cached_file in cached_files:
+                with open_text(cached_file) as fp:
+                    data = json.load(fp)
+                path_ = output_dir / cached_file.name
+                status = update_mapping_file(path_, data, output_format)
+                echo_mapping_written(str(path_), status)
+                paths.append(str(path_))
+                statuses.append(status)
+
+    echo_mappings_summary(output_dir, statuses)
+    return paths
+
+
+def mapping_documents(
+    fhir_release,
+    reference_analyzer=None,
+    token_normalizer=None,
+    jobs=1,
+    cache_dir=None,
+    resources=None,
+    prune=None,
+    multi_value=None,
+    settings_profile=None,
+    size_hints=None,
+):
+    """Returns the mapping documents (mappings with their meta) keyed by
+    resource name; served from the cache when ``cache_dir`` is given."""
+    if cache_dir is None:
+        settings = load_settings(settings_profile, reference_analyzer, token_normalizer)
+        return {
+            resource: add_mapping_meta(
+                resource,
+                mappings,
+                fhir_release,
+                settings,
+                (size_hints or {}).get(resource),
+            )
+            for resource, mappings in generate_mappings(
+                fhir_release,
+                reference_analyzer,
+                token_normalizer,
+                jobs,
+                resources,
+                prune,
+                multi_value,
+            ).items()
+        }
+
+    with phase("cache_key"):
+        key = mapping_cache_key(
+            fhir_release,
+            reference_analyzer,
+            token_normalizer,
+            resources,
+            "compact",
+            prune=prune,
+            multi_value=multi_value,
+            settings_profile=settings_profile,
+            size_hints=size_hints,
+        )
+    cached_files = get_cached_mappings(cache_dir, key)
+    if cached_files is None:
+        cached_files = store_mappings(
+            cache_dir,
+            key,
+            lambda tmp_dir: write_es_mappings(
+                tmp_dir,
+                fhir_release,
+                reference_analyzer,
+                token_normalizer,
+                jobs,
+                verbose=False,
+                resources=resources,
+                output_format="compact",
+                prune=prune,
+                multi_value=multi_value,
+                settings_profile=settings_profile,
+                size_hints=size_hints,
+            ),
+        )
+    else:
+        click.echo(f"Using cached mappings {cache_dir / key}")
+    documents = dict()
+    with phase("cache_read"):
+        for cached_file in cached_files:
+            with open_text(cached_file) as fp:
+                document = json.load(fp)
+            documents[document["resourceType"]] = document
+    return documents
+
+
+def write_es_mappings(
+    output_dir,
+    fhir_release,
+    reference_analyzer=None,
+    token_normalizer=None,
+    jobs=1,
+    verbose=True,
+    resources=None,
+    output_format="pretty",
+    compression=None,
+    with_statuses=False,
+    prune=None,
+    multi_value=None,
+    settings_profile=None,
+    size_hints=None,
+):
+    """Only the changed mapping files are (atomically) rewritten. Returns the
+    paths of the mapping files, along with their statuses (``added``,
+    ``changed`` or ``unchanged``) when ``with_statuses`` is true."""
+    elements_paths = load_elements_paths(fhir_release, resources)
+    fhir_es_mappings = types_mapping_registry(
+        fhir_release, reference_analyzer, token_normalizer
+    )
+    pruning = load_pruning(fhir_release, elements_paths, prune)
+    settings = load_settings(settings_profile, reference_analyzer, token_normalizer)
+    paths = list()
+    statuses = list()
+    with phase("mappings"):
+        for resource, (path_, status, phases) in run_resources_tasks(
+            _write_resource_mapping_task,
+            elements_paths,
+            fhir_es_mappings,
+            jobs,
+            output_dir,
+            fhir_release,
+            output_format,
+            compression,
+            settings,
+            size_hints,
+            pruning=pruning,
+            multi_value=multi_value,
+        ):
+            if phases:
+                record_phases(phases)
+            if verbose:
+                echo_mapping_written(path_, status)
+            paths.append(path_)
+            statuses.append(status)
+    if with_statuses:
+        return paths, statuses
+    return paths
@@ -0,0 +1,157 @@
+# _*_ coding: utf-8 _*_
+"""Multi-value strategy of the generated mappings.
+
+By default every repeating element (and every BackboneElement) is mapped as
+``nested``: each value is indexed as a hidden Lucene document so that queries
+can match several fields of the same value. A policy chooses, per element, one
+of the ``MULTI_VALUE_STRATEGIES``:
+
+- ``nested``: values are queryable as separate documents (same value
+  correlation, i.e. ``system|code`` of a Coding), at indexing/query cost.
+- ``object``: values are flattened into the parent document (cheap, no
+  correlation between the fields of a value).
+- ``flattened``: the whole element is indexed as keywords of one field.
+
+A policy is a JSON object (``--multi-value FILE``) or a built-in profile name
+(``MULTI_VALUE_PROFILES``)::
+
+    {
+        "extends": "performance",
+        "default": "object",
+        "datatypes": {"Identifier": "nested"},
+        "paths": {"Observation.component": "nested", "*.coding": "nested"}
+    }
+
+For a repeating element, the first of its FHIR path (``fnmatch`` pattern, the
+exact path first) then its datatype rules applies, ``default`` otherwise. The
+repeating fields inside the datatypes mappings (``CodeableConcept.coding``,
+``Meta.tag``...) only have path rules (``Observation.code.coding``,
+``*.coding``).
+"""
+from fnmatch import fnmatchcase
+import json
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+MULTI_VALUE_STRATEGIES = ("nested", "object", "flattened")
+
+# keys of a nested mapping which are meaningless for another strategy
+NESTED_ONLY_KEYS = ("type", "include_in_root", "include_in_parent")
+
+MULTI_VALUE_PROFILES = {
+    "nested": {"default": "nested", "datatypes": {}, "paths": {}},
+    # ``object`` wherever the FHIR search semantics don't correlate the fields
+    # of a same value: only token searches (``system|code``,
+    # ``system|value``) and composite search parameters need ``nested``.
+    "performance": {
+        "default": "object",
+        "datatypes": {
+            "Coding": "nested",
+            "Identifier": "nested",
+            "ContactPoint": "nested",
+        },
+        "paths": {
+            "*.coding": "nested",
+            "*.meta.tag": "nested",
+            "*.telecom": "nested",
+            "*.useContext": "nested",
+            "DocumentReference.relatesTo": "nested",
+            "Group.characteristic": "nested",
+            "MolecularSequence.referenceSeq": "nested",
+            "MolecularSequence.variant": "nested",
+            "Observation.component": "nested",
+            "Observation.related": "nested",
+            "Sequence.variant": "nested",
+        },
+    },
+}
+
+
+def validate_policy(policy):
+    """Returns the complete ``policy`` (default, datatypes and paths), raises
+    ValueError on unknown strategies."""
+    policy = {
+        "default": policy.get("default", "nested"),
+        "datatypes": dict(policy.get("datatypes", {})),
+        "paths": dict(policy.get("paths", {})),
+    }
+    strategies = (
+        [policy["default"]]
+        + list(policy["datatypes"].values())
+        + list(policy["paths"].values())
+    )
+    for strategy in strategies:
+        if strategy not in MULTI_VALUE_STRATEGIES:
+            raise ValueError(
+                f"Unknown multi-value strategy {strategy!r}, expected one of "
+                f"{', '.join(MULTI_VALUE_STRATEGIES)}"
+            )
+    return policy
+
+
+def load_multi_value_policy(profile_or_file):
+    """Returns the policy of a built-in profile name or of a JSON policy file,
+    which may extend (``extends``) a built-in profile."""
+    if profile_or_file in MULTI_VALUE_PROFILES:
+        return validate_policy(MULTI_VALUE_PROFILES[profile_or_file])
+    with open(str(profile_or_file), "r", encoding="utf-8") as fp:
+        policy = json.load(fp)
+    base = policy.get("extends")
+    if base is not None:
+        if base not in MULTI_VALUE_PROFILES:
+            raise ValueError(f"Unknown multi-value profile {base!r}")
+        base = MULTI_VALUE_PROFILES[base]
+        policy = {
+            "default": policy.get("default", base["default"]),
+            "datatypes": {**base["datatypes"], **policy.get("datatypes", {})},
+            "paths": {**base["paths"], **policy.get("paths", {})},
+        }
+    return validate_policy(policy)
+
+
+def resolve_strategy(policy, path, code=None):
+    """Strategy of the repeating element ``path`` of datatype ``code``."""
+    paths = policy["paths"]
+    if path in paths:
+        return paths[path]
+    for pattern, strategy in paths.items():
+        if fnmatchcase(path, pattern):
+            return strategy
+    if code is not None and code in policy["datatypes"]:
+        return policy["datatypes"][code]
+    return policy["default"]
+
+
+def with_strategy(map_, strategy):
+    """Returns the mapping of a repeating element for ``strategy``, ``map_``
+    itself when already so."""
+    if strategy == "flattened":
+        return {"type": "flattened"}
+    if strategy == "nested":
+        if map_.get("type") == "nested":
+            return map_
+        return {**map_, "type": "nested"}
+    if "type" not in map_:
+        return map_
+    return {key: value for key, value in map_.items() if key not in NESTED_ONLY_KEYS}
+
+
+def apply_inner_strategies(map_, path, policy):
+    """Applies the path rules of ``policy`` to the nested fields inside the
+    (datatype) mapping ``map_`` of element ``path``. Untouched nodes stay
+    shared, only the altered ones are copied."""
+    properties = map_.get("properties")
+    if not properties:
+        return map_
+    altered = dict()
+    for name, field in properties.items():
+        field_path = f"{path}.{name}"
+        new_field = field
+        if field.get("type") == "nested":
+            new_field = with_strategy(field, resolve_strategy(policy, field_path))
+        new_field = apply_inner_strategies(new_field, field_path, policy)
+        if new_field is not field:
+            altered[name] = new_field
+    if not altered:
+        return map_
+    return {**map_, "properties": {**properties, **altered}}
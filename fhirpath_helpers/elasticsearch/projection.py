@@ -0,0 +1,197 @@
+# _*_ coding: utf-8 _*_
+"""Projection of FHIR resources onto their elasticsearch mapping.
+
+Elements which are not mapped (ignored datatypes such as ``Extension`` or
+``markdown``, primitive extensions ``_<element>``, pruned elements...) are
+stripped from the resources before indexing, making smaller ``_source``
+documents. The FHIR JSON names of choice elements (``valueQuantity``) are the
+ones of the mapping, so ``[x]`` elements are projected like any other.
+
+``compile_projector`` turns the mapping properties of a resource into a
+projection function, only the keys present in the resource are looked up.
+``project_ndjson`` applies the projectors of all the resources to an NDJSON
+stream, in chunks of lines distributed over a process pool (at most two
+chunks per worker in flight, memory doesn't grow with the stream).
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from ..helpers import open_text
+from .bundle import read_mappings_bundle
+from .bundle import templates_mappings
+from .cache import MAPPING_FILE_SUFFIX
+import json
+import os
+import pathlib
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def projection_spec(properties):
+    """Returns ``{name: spec}`` of the mapping ``properties``, ``spec`` is
+    None for the fields kept as they are (leaves, flattened or disabled
+    objects)."""
+    spec = dict()
+    for name, field in properties.items():
+        if "properties" in field:
+            spec[name] = projection_spec(field["properties"])
+        else:
+            spec[name] = None
+    return spec
+
+
+def compile_projector(properties):
+    """Returns the ``project(resource)`` function of a resource mapping
+    ``properties``: a new dict with only the mapped elements of ``resource``
+    (elements left empty by the projection are dropped)."""
+
+    def compile_spec(spec):
+        children = {
+            name: None if sub_spec is None else compile_spec(sub_spec)
+            for name, sub_spec in spec.items()
+        }
+
+        def project(value):
+            if isinstance(value, list):
+                items = [project(item) for item in value]
+                return [item for item in items if item not in (None, {}, [])]
+            if not isinstance(value, dict):
+                # a primitive where an element is expected, not indexable
+                return None
+            projected = dict()
+            for name, item in value.items():
+                if name not in children:
+                    continue
+                project_child = children[name]
+                if project_child is not None:
+                    item = project_child(item)
+                    if item in (None, {}, []):
+                        continue
+                projected[name] = item
+            return projected
+
+        return project
+
+    return compile_spec(projection_spec(properties))
+
+
+def compile_projectors(mappings):
+    """Returns the projectors of the resources ``mappings`` (properties keyed
+    by resource name, as returned by ``generate_mappings``)."""
+    return {
+        resource: compile_projector(properties)
+        for resource, properties in mappings.items()
+    }
+
+
+def load_mappings(path_):
+    """Loads the mapping properties, keyed by resource name, of a directory of
+    mapping files or of a ``bundle``/``ndjson``/``index-templates`` mappings
+    file. Raises ValueError for any other file."""
+    path_ = pathlib.Path(path_)
+    try:
+        if path_.is_dir():
+            documents = dict()
+            for file_ in sorted(path_.glob("*" + MAPPING_FILE_SUFFIX + "*")):
+                with open_text(file_) as fp:
+                    document = json.load(fp)
+                documents[document["resourceType"]] = document
+        else:
+            documents = read_mappings_bundle(path_)
+            if "index_templates" in documents:
+                return templates_mappings(documents)
+        return {
+            resource: document["mapping"]["properties"]
+            for resource, document in documents.items()
+        }
+    except (KeyError, TypeError, AttributeError) as exc:
+        raise ValueError(
+            f"{path_} is not a mapping files directory nor a bundle, ndjson or "
+            f"index-templates mappings file (missing {exc})"
+        )
+
+
+def project_lines(projectors, lines):
+    """Projects the NDJSON ``lines``; returns ``(text, projected, skipped)``,
+    resources without mapping are skipped."""
+    output = list()
+    skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        resource = json.loads(line)
+        projector = projectors.get(resource.get("resourceType"))
+        if projector is None:
+            skipped += 1
+            continue
+        output.append(json.dumps(projector(resource), separators=(",", ":")))
+    text = "".join(line + "\n" for line in output)
+    return text, len(output), skipped
+
+
+_worker_projectors = dict()
+
+
+def _init_worker(mappings):
+    """ """
+    _worker_projectors.update(compile_projectors(mappings))
+
+
+def _project_lines_task(lines):
+    """ """
+    return project_lines(_worker_projectors, lines)
+
+
+def read_chunks(fp, chunk_size):
+    """Yields lists of (at most) ``chunk_size`` lines of ``fp``."""
+    chunk = list()
+    for line in fp:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def project_ndjson(
+    mappings, input_path, output_path, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """Writes the projection of every resource of the NDJSON ``input_path``
+    to ``output_path`` (both may be ``.gz``/``.xz`` compressed), in the same
+    order. ``jobs``: worker processes, 0/None for all available CPUs.
+
+    Returns ``(projected, skipped)`` resources counts.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    projected = skipped = 0
+    with open_text(pathlib.Path(input_path)) as input_fp, open_text(
+        pathlib.Path(output_path), "w"
+    ) as output_fp:
+
+        def write(result):
+            nonlocal projected, skipped
+            text, count, skipped_count = result
+            output_fp.write(text)
+            projected += count
+            skipped += skipped_count
+
+        chunks = read_chunks(input_fp, chunk_size)
+        if jobs <= 1:
+            projectors = compile_projectors(mappings)
+            for chunk in chunks:
+                write(project_lines(projectors, chunk))
+            return projected, skipped
+
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(mappings,)
+        ) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_project_lines_task, chunk))
+                if len(pending) >= jobs * 2:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    return projected, skipped
@@ -0,0 +1,148 @@
+# _*_ coding: utf-8 _*_
+"""Mappings pruned to the elements the search parameters can query.
+
+The FHIRPath expressions of ``search-parameters.json`` are reduced to the
+elements paths they reference (``Observation.value.as(Quantity)`` is
+``valueQuantity``, ``where(...)`` filters and functions calls are dropped).
+A referenced element keeps its whole mapping, its ancestors are kept with
+only the referenced children; every other property is either:
+
+- ``disable``: mapped as ``{"type": "object", "enabled": false}``, kept in the
+  ``_source`` but neither parsed nor indexed (nor dynamically mapped).
+- ``exclude``: left out of the mapping, meant for indices with ``dynamic``
+  mapping turned off.
+"""
+from ..fhirspec import spec_source_dir
+from ..profiling import phase
+import json
+import re
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+PRUNE_MODES = ("disable", "exclude")
+BASE_ROOTS = ("Resource", "DomainResource")
+# properties every mapping keeps, whatever the search parameters
+ALWAYS_KEPT = ("resourceType",)
+
+_as_type_re = re.compile(r"\(\s*([\w.]+)\s+as\s+(\w+)\s*\)|([\w.]+)\s+as\s+(\w+)")
+_where_re = re.compile(r"\.where\((?:[^()]|\([^()]*\))*\)")
+_path_re = re.compile(r"(?<![\w.])([A-Z]\w*)((?:\.\w+(?:\(\w*\))?|\[\d+\])+)")
+_type_function_re = re.compile(r"(?:as|is|ofType)\((\w+)\)")
+
+
+def expression_paths(expression):
+    """Returns the ``(root, path)`` pairs referenced by a search parameter
+    FHIRPath ``expression``, ``root`` being the resource name (or
+    ``Resource``/``DomainResource``) and ``path`` the dotted element path."""
+    expression = _as_type_re.sub(
+        lambda match: "{0}.as({1})".format(
+            match.group(1) or match.group(3), match.group(2) or match.group(4)
+        ),
+        expression,
+    )
+    expression = _where_re.sub("", expression)
+    paths = list()
+    for root, rest in _path_re.findall(expression):
+        segments = list()
+        for segment in re.sub(r"\[\d+\]", "", rest).split(".")[1:]:
+            type_match = _type_function_re.fullmatch(segment)
+            if type_match is not None and segments:
+                type_ = type_match.group(1)
+                segments[-1] += type_[0].upper() + type_[1:]
+                continue
+            if "(" in segment:
+                # any other function call ends the element path
+                break
+            segments.append(segment)
+        if segments:
+            paths.append((root, ".".join(segments)))
+    return paths
+
+
+def load_search_paths(fhir_release):
+    """Returns the elements paths referenced by the search parameters of
+    ``fhir_release``, keyed by root (resource name, ``Resource`` or
+    ``DomainResource``)."""
+    search_paths = dict()
+    with phase("search_parameters"):
+        with open(
+            str(spec_source_dir(fhir_release) / "search-parameters.json"),
+            "r",
+            encoding="utf-8",
+        ) as fp:
+            bundle = json.load(fp)
+        for entry in bundle.get("entry", ()):
+            expression = entry["resource"].get("expression")
+            if not expression:
+                continue
+            for root, path in expression_paths(expression):
+                search_paths.setdefault(root, set()).add(path)
+    return search_paths
+
+
+def referenced_tree(paths):
+    """Tree of the paths segments, a None leaf keeps the whole element."""
+    tree = dict()
+    for path in sorted(paths, key=lambda p: p.count(".")):
+        node = tree
+        segments = path.split(".")
+        for segment in segments[:-1]:
+            node = node.setdefault(segment, dict())
+            if node is None:
+                # an ancestor is already kept whole
+                break
+        else:
+            node[segments[-1]] = None
+    return tree
+
+
+def resources_referenced_trees(fhir_release, resources):
+    """Returns the ``referenced_tree`` of every one of ``resources``, including
+    the paths of the ``Resource``/``DomainResource`` search parameters."""
+    search_paths = load_search_paths(fhir_release)
+    base_paths = set()
+    for root in BASE_ROOTS:
+        base_paths |= search_paths.get(root, set())
+    return {
+        resource: referenced_tree(search_paths.get(resource, set()) | base_paths)
+        for resource in resources
+    }
+
+
+def _lookup(tree, name, properties):
+    """Returns ``(found, subtree)`` of property ``name``. A choice type
+    reference without type (``Observation.value``) matches all its typed
+    properties (``valueQuantity``, ``valueString``...)."""
+    if name in tree:
+        return True, tree[name]
+    for segment, subtree in tree.items():
+        if (
+            segment not in properties
+            and name.startswith(segment)
+            and name[len(segment) : len(segment) + 1].isupper()
+        ):
+            return True, subtree
+    return False, None
+
+
+def prune_mapping(properties, tree, mode="disable"):
+    """Prunes the mapping ``properties`` of a resource to the paths of its
+    ``referenced_tree``; see the module documentation for ``mode``. Returns
+    a new mapping, ``properties`` is left untouched."""
+    if mode not in PRUNE_MODES:
+        raise ValueError(f"Unknown prune mode {mode}")
+    pruned = dict()
+    for name, field in properties.items():
+        found, subtree = _lookup(tree, name, properties)
+        if name in ALWAYS_KEPT or (
+            found and (subtree is None or "properties" not in field)
+        ):
+            pruned[name] = field
+        elif found:
+            pruned[name] = {
+                **field,
+                "properties": prune_mapping(field["properties"], subtree, mode),
+            }
+        elif mode == "disable":
+            pruned[name] = {"type": "object", "enabled": False}
+    return pruned
@@ -9,10 +9,63 @@ Based on https://www.hl7.org/fhir/R4/datatypes.html, for other version
 need to make compatibility
 """
 from fhirpath.enums import FHIR_VERSION
+from functools import lru_cache
 
 __author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
 
 
+class FrozenDict(dict):
+    """Read only dict of the types mapping registry. Being a dict, it is
+    serialized as such by ``json``; any mutation raises TypeError, so mapping
+    templates shared across resources trees can't be altered by accident."""
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        """ """
+        raise TypeError(f"{self.__class__.__name__} is read only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        """Returns a (mutable) shallow copy."""
+        return dict(self)
+
+    def __reduce__(self):
+        """ """
+        return self.__class__, (dict(self),)
+
+
+def freeze(value, memo=None):
+    """Returns ``value`` with all its dicts turned into FrozenDict; a dict
+    shared by several parents is frozen once and stays shared."""
+    if not isinstance(value, dict) or isinstance(value, FrozenDict):
+        return value
+    memo = {} if memo is None else memo
+    frozen = memo.get(id(value))
+    if frozen is None:
+        frozen = memo[id(value)] = FrozenDict(
+            (key, freeze(item, memo)) for key, item in value.items()
+        )
+    return frozen
+
+
+@lru_cache(maxsize=None)
+def types_mapping_registry(
+    fhir_release: str, reference_analyzer=None, token_normalizer=None,
+):
+    """Memoized, read only (see FrozenDict) version of ``fhir_types_mapping``.
+
+    Templates must not be copied up front: whoever needs to alter one builds
+    a new dict from it (i.e. ``{**template, "type": "nested"}``), only the
+    altered nodes are copied while the untouched ones stay shared.
+    """
+    return freeze(
+        fhir_types_mapping(fhir_release, reference_analyzer, token_normalizer)
+    )
+
+
 def fhir_types_mapping(
     fhir_release: str, reference_analyzer=None, token_normalizer=None,
 ):
@@ -0,0 +1,170 @@
+# _*_ coding: utf-8 _*_
+"""Index settings generated along with the mappings.
+
+With a settings profile, every mapping document carries the ``settings`` of
+its index next to its ``mapping``; ``index_body`` turns it into the body of the
+create index request (``PUT <index>``). The settings hold:
+
+- the ``analysis`` definitions of the ``reference_analyzer`` and
+  ``token_normalizer`` the mappings refer to (unless elasticsearch built-in).
+- the settings of the profile:
+
+  - ``analysis``: nothing more.
+  - ``bulk-load``: for the initial load, refresh disabled, no replicas and
+    asynchronous translog. Once loaded, restore them with the
+    ``restore_settings`` body of ``PUT <index>/_settings``.
+  - ``serve``: ``best_compression`` codec and one replica.
+
+  For both, the number of shards of a resource index comes from its size
+  hint (expected primary store size): one shard per ``TARGET_SHARD_SIZE``
+  started, one shard without hint. Shards can't be changed once the index is
+  created, so the ``bulk-load`` index gets the same number as the served one.
+
+- ``index.mapping.*.limit`` raised to fit the resource mapping (the total
+  fields rounded up to the next hundred) when it exceeds the elasticsearch
+  defaults.
+"""
+from .analysis import DEFAULT_LIMITS
+from .analysis import analyze_mapping
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+SETTINGS_PROFILES = ("analysis", "bulk-load", "serve")
+# primary shard size aimed at, within the 10-50GB elasticsearch guidance
+TARGET_SHARD_SIZE = 30 * 1024 ** 3
+
+PROFILES_INDEX_SETTINGS = {
+    "analysis": {},
+    "bulk-load": {
+        "number_of_shards": 1,
+        "refresh_interval": "-1",
+        "number_of_replicas": 0,
+        "translog": {
+            "durability": "async",
+            "sync_interval": "30s",
+            "flush_threshold_size": "1gb",
+        },
+    },
+    "serve": {
+        "codec": "best_compression",
+        "number_of_shards": 1,
+        "number_of_replicas": 1,
+        "refresh_interval": "1s",
+    },
+}
+
+BUILTIN_ANALYZERS = (
+    "standard",
+    "simple",
+    "whitespace",
+    "stop",
+    "keyword",
+    "pattern",
+    "fingerprint",
+)
+BUILTIN_NORMALIZERS = ("lowercase",)
+
+# ``[<base url>/]<type>/<id>`` references are also indexed as ``<type>/<id>``
+REFERENCE_PATTERN = r"(?:https?://.+/)?([A-Z][A-Za-z]+/[A-Za-z0-9\-\.]{1,64})"
+
+
+def analysis_settings(reference_analyzer=None, token_normalizer=None):
+    """Definitions of the (non built-in) analyzer and normalizer the mappings
+    refer to."""
+    analysis = dict()
+    if reference_analyzer and reference_analyzer not in BUILTIN_ANALYZERS:
+        filter_name = f"{reference_analyzer}_reference"
+        analysis["filter"] = {
+            filter_name: {
+                "type": "pattern_capture",
+                "preserve_original": True,
+                "patterns": [REFERENCE_PATTERN],
+            }
+        }
+        analysis["analyzer"] = {
+            reference_analyzer: {
+                "type": "custom",
+                "tokenizer": "keyword",
+                "filter": [filter_name],
+            }
+        }
+    if token_normalizer and token_normalizer not in BUILTIN_NORMALIZERS:
+        analysis["normalizer"] = {
+            token_normalizer: {
+                "type": "custom",
+                "filter": ["lowercase", "asciifolding"],
+            }
+        }
+    return analysis
+
+
+def restore_settings():
+    """Body of the ``PUT <index>/_settings`` request which restores the
+    dynamic settings of a loaded ``bulk-load`` index to the ``serve`` ones
+    (the static ones, i.e. ``codec``, can't be changed on an open index)."""
+    serve = PROFILES_INDEX_SETTINGS["serve"]
+    return {
+        "index": {
+            "refresh_interval": serve["refresh_interval"],
+            "number_of_replicas": serve["number_of_replicas"],
+            "translog": {"durability": "request"},
+        }
+    }
+
+
+def profile_settings(profile, reference_analyzer=None, token_normalizer=None):
+    """Settings shared by the indices of every resource for ``profile``."""
+    if profile not in SETTINGS_PROFILES:
+        raise ValueError(f"Unknown settings profile {profile}")
+    settings = {"index": dict(PROFILES_INDEX_SETTINGS[profile])}
+    analysis = analysis_settings(reference_analyzer, token_normalizer)
+    if analysis:
+        settings["analysis"] = analysis
+    return settings
+
+
+def shard_count(size_hint=None):
+    """Number of primary shards of an index of ``size_hint`` bytes."""
+    if not size_hint:
+        return 1
+    return max(1, -(-size_hint // TARGET_SHARD_SIZE))
+
+
+def resource_settings(settings, properties, size_hint=None):
+    """Returns ``settings`` with the mapping limits raised to fit the mapping
+    ``properties`` of a resource and its number of shards (for the profiles
+    which set it) from ``size_hint``, the expected size of the index in
+    bytes."""
+    if size_hint and "number_of_shards" in settings["index"]:
+        settings = dict(
+            settings,
+            index=dict(settings["index"], number_of_shards=shard_count(size_hint)),
+        )
+    stats = analyze_mapping(properties, top=0)
+    limits = dict()
+    for name, value in (
+        ("total_fields", stats["total_fields"]),
+        ("nested_fields", stats["nested_fields"]),
+        ("depth", stats["max_depth"]),
+    ):
+        if value > DEFAULT_LIMITS[name]:
+            limits[name] = {"limit": value}
+    if not limits:
+        return settings
+    if "total_fields" in limits:
+        # headroom for the fields added later (i.e. dynamically mapped ones)
+        limits["total_fields"]["limit"] = -(-stats["total_fields"] // 100) * 100
+    return dict(settings, index=dict(settings["index"], mapping=limits))
+
+
+def index_body(document):
+    """Create index request body of a mapping document."""
+    body = {"mappings": dict(document["mapping"])}
+    body["mappings"]["_meta"] = {
+        "resourceType": document["resourceType"],
+        "versionId": document["meta"]["versionId"],
+        "contentHash": document["meta"]["contentHash"],
+    }
+    if "settings" in document:
+        body["settings"] = document["settings"]
+    return body
@@ -1,78 +1,593 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
 import zipfile
 import shutil
 import pathlib
-import tempfile
-import os
 import io
 import json
+import mmap
+import os
+from fhirpath.enums import FHIR_VERSION
+from fhirpath.fhirspec import SPEC_JSON_DIR
+from fhirpath.fhirspec import Configuration
+from fhirpath.fhirspec import FHIRSpec
+from fhirpath.fhirspec import FHIRStructureDefinition
+from fhirpath.fhirspec import FhirSpecFactory
+from fhirpath.fhirspec import ensure_spec_jsons
+from .helpers import archive_members
+from .helpers import compressed_path
+from .helpers import json_dumps_kwargs
+from .helpers import open_text
+from .profiling import phase
 
 __author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
 
+BASE_RESOURCES = ("Resource", "DomainResource")
+# members of the static versioned archives, in their archive order
+STATIC_ARCHIVE_FILES = (
+    "version.info",
+    "search-parameters.json",
+    "valuesets.min.json",
+    "profiles-resources.min.json",
+    "profiles-types.min.json",
+)
+# sidecar offsets index of the minified bundles
+INDEX_FILE_SUFFIX = ".index.json"
+# fixed members timestamp, so that the same spec always gives the same archive
+STATIC_ARCHIVE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class SelectiveFhirSpec(FHIRSpec):
+    """FHIRSpec which only processes the StructureDefinitions of the selected
+    resources (always including their Resource/DomainResource bases); datatypes
+    profiles are kept as they are required to resolve the resources classes.
+    """
+
+    def __init__(self, settings, src_directory=None, resources=None):
+        """ """
+        self.selected_resources = set(resources or ()) | set(BASE_RESOURCES)
+        FHIRSpec.__init__(self, settings, src_directory)
+
+    def read_profiles(self):
+        """ """
+        files = getattr(
+            self.settings,
+            "FHIR_PROFILES_FILE_NAMES",
+            ["profiles-types.json", "profiles-resources.json"],
+        )
+        for filename in files:
+            for resource in self.read_bundle_resources(filename):
+                if "StructureDefinition" != resource["resourceType"]:
+                    continue
+                if (
+                    resource.get("kind") == "resource"
+                    and resource.get("name") not in self.selected_resources
+                ):
+                    # unused resource definition, don't even parse it
+                    continue
+                profile = FHIRStructureDefinition(self, resource)
+                if self.found_profile(profile):
+                    profile.process_profile()
+
+
+def spec_source_dir(release: str):
+    """Returns the directory of the FHIR spec JSON files, that
+    ``FhirSpecFactory.from_release`` would load, without parsing them."""
+    release_enum = FHIR_VERSION[release]
+    if release_enum == FHIR_VERSION.DEFAULT:
+        release_enum = getattr(FHIR_VERSION, release_enum.value)
+    ensure_spec_jsons(release_enum)
+    return SPEC_JSON_DIR / release_enum.name / release_enum.value
+
+
+def fhir_spec_from_release(release: str, resources=None):
+    """Same as ``FhirSpecFactory.from_release`` but when ``resources`` are
+    provided, only those (and their bases) are parsed."""
+    if resources is None:
+        return FhirSpecFactory.from_release(release)
+
+    from fhirpath.fhirspec import settings
+
+    src_dir = spec_source_dir(release)
+    config = Configuration.from_module(settings)
+    config.update({"FHIR_DEFINITION_DIRECTORY": src_dir})
+    return SelectiveFhirSpec(config, src_dir, resources=resources)
+
+
+class BundleReader:
+    """Incremental reader of a FHIR Bundle JSON text stream.
+
+    ``entries()`` yields the items of ``entry`` one by one, so that only a single
+    entry is held in memory at any time; the other top level members of the
+    Bundle are collected in ``bundle`` while reading.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fp):
+        """ """
+        self.fp = fp
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bundle = dict()
+
+    def _fill(self, size=None):
+        """Reads more text into the buffer, returns False at the end of stream."""
+        if self.eof:
+            return False
+        if self.pos > 0:
+            self.buffer = self.buffer[self.pos :]
+            self.pos = 0
+        # grow geometrically, so a large value is not decoded again and again
+        text = self.fp.read(max(size or 0, self.chunk_size))
+        if not text:
+            self.eof = True
+            return False
+        self.buffer += text
+        return True
+
+    def _next_char(self):
+        """Skips whitespaces, returns the next significant character."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of Bundle JSON stream")
+
+    def _expect(self, chars):
+        """ """
+        char = self._next_char()
+        if char not in chars:
+            raise ValueError(
+                f"Invalid Bundle JSON: expected one of {chars!r} but found {char!r}"
+            )
+        self.pos += 1
+        return char
+
+    def _decode_value(self):
+        """Decodes the JSON value at the current position."""
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill(len(self.buffer)):
+                    raise
+                continue
+            if end == len(self.buffer) and self._fill():
+                # i.e a number might continue in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def entries(self):
+        """ """
+        self._expect("{")
+        if self._next_char() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(":")
+            if key == "entry":
+                self._expect("[")
+                if self._next_char() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._decode_value()
+                        if self._expect(",]") == "]":
+                            break
+            else:
+                self.bundle[key] = self._decode_value()
+            if self._expect(",}") == "}":
+                break
+
+
+def entry_index_record(entry, offset, length):
+    """``[resourceType, id, url, offset, length]`` record of a Bundle entry
+    written at ``offset`` (bytes) of the Bundle file."""
+    resource = entry.get("resource") or dict()
+    return [
+        resource.get("resourceType"),
+        resource.get("id"),
+        resource.get("url"),
+        offset,
+        length,
+    ]
+
+
+def write_bundle(fp, entries, bundle, output_format="pretty", index=None):
+    """Writes a Bundle to text file ``fp``, the same way as
+    ``json.dump(dict(entry=list(entries), **bundle), fp, indent=2)`` would (or
+    with compact separators) but without holding all entries in memory.
+
+    ``bundle`` (the other top level members) is only read once all ``entries``
+    have been consumed. When ``index`` is a list, the ``entry_index_record`` of
+    every entry is appended to it (offsets from the start of ``fp``).
+    """
+    dumps_kwargs = json_dumps_kwargs(output_format)
+    if output_format == "compact":
+        level1 = level2 = ""
+        key_separator = ":"
+    else:
+        level1 = "\n" + " " * dumps_kwargs["indent"]
+        level2 = "\n" + " " * dumps_kwargs["indent"] * 2
+        key_separator = ": "
+    # json.dumps escapes non ASCII characters: text length is the bytes length
+    position = 0
+    text = "{" + level1 + '"entry"' + key_separator + "["
+    fp.write(text)
+    position += len(text)
+    count = 0
+    for entry in entries:
+        text = count and "," + level2 or level2
+        fp.write(text)
+        position += len(text)
+        text = json.dumps(entry, **dumps_kwargs).replace("\n", level2)
+        fp.write(text)
+        if index is not None:
+            index.append(entry_index_record(entry, position, len(text)))
+        position += len(text)
+        count += 1
+    fp.write(count and level1 + "]" or "]")
+    for key, value in bundle.items():
+        if key == "entry":
+            continue
+        fp.write("," + level1 + json.dumps(key) + key_separator)
+        fp.write(json.dumps(value, **dumps_kwargs).replace("\n", level1))
+    fp.write(level1 and "\n}" or "}")
+    return count
+
+
+def minify_profiles_entries(entries):
+    """ """
+    for entry in entries:
+        resource = entry["resource"]
+        if "StructureDefinition" == resource["resourceType"]:
+            resource.pop("text", None)
+            resource.pop("snapshot", None)
+            yield {"fullUrl": entry.get("fullUrl"), "resource": resource}
+
+
+def minify_valuesets_entries(entries):
+    """ """
+    for entry in entries:
+        resource = entry["resource"]
+        if "ValueSet" == resource["resourceType"]:
+            assert "url" in resource
+
+        elif "CodeSystem" == resource["resourceType"]:
+            assert "url" in resource
+            if "content" not in resource and "concept" not in resource:
+                continue
+        else:
+            continue
+
+        resource.pop("text", None)
+        yield {"fullUrl": entry.get("fullUrl"), "resource": resource}
+
+
+def minify_bundle_file(
+    source: pathlib.Path,
+    destination: pathlib.Path,
+    minifier,
+    output_format: str = "pretty",
+):
+    """Streams the Bundle ``source`` through ``minifier`` into ``destination``,
+    one entry at a time."""
+    with io.open(str(source), "r", encoding="utf-8") as src_fp:
+        return minify_bundle_stream(src_fp, destination, minifier, output_format)
+
+
+def minify_bundle_stream(
+    src_fp,
+    destination: pathlib.Path,
+    minifier,
+    output_format: str = "pretty",
+    index: bool = False,
+):
+    """Same as ``minify_bundle_file`` but reads from the text stream ``src_fp``.
+    ``destination`` is compressed according to its suffix (see ``open_text``).
+    With ``index``, its byte offsets index is written aside (see
+    ``write_bundle_index``), only for an uncompressed ``destination``."""
+    if index and destination.suffix != ".json":
+        raise ValueError(f"Can't index the compressed bundle {destination.name}")
+    reader = BundleReader(src_fp)
+    records = list() if index else None
+    with open_text(destination, "w") as fp:
+        count = write_bundle(
+            fp, minifier(reader.entries()), reader.bundle, output_format, records
+        )
+    if index:
+        write_bundle_index(destination, records)
+    return count
+
+
+def bundle_index_path(path_: pathlib.Path):
+    """Sidecar offsets index path of the Bundle file ``path_``."""
+    return path_.with_name(path_.name + INDEX_FILE_SUFFIX)
+
+
+def write_bundle_index(path_: pathlib.Path, records):
+    """Writes the offsets index of the Bundle file ``path_``: its size (to
+    detect an outdated index) and the ``entry_index_record`` of its
+    entries."""
+    index_path = bundle_index_path(path_)
+    with open(str(index_path), "w", encoding="utf-8") as fp:
+        json.dump(
+            {"file": path_.name, "size": path_.stat().st_size, "entries": records},
+            fp,
+            separators=(",", ":"),
+        )
+    return index_path
+
+
+class IndexedBundle:
+    """Random access to the entries of a Bundle file through its offsets
+    index: the file is memory mapped (its pages are shared by every process
+    reading it) and only the requested entries are decoded::
+
+        with IndexedBundle(path_) as bundle:
+            valueset = bundle.get("http://hl7.org/fhir/ValueSet/example")
+            patient = bundle.get_by_id("StructureDefinition", "Patient")
+    """
+
+    def __init__(self, path_):
+        """ """
+        path_ = pathlib.Path(path_)
+        with open(str(bundle_index_path(path_)), "r", encoding="utf-8") as fp:
+            index = json.load(fp)
+        self.path = path_
+        self.records = index["entries"]
+        self.by_url = dict()
+        self.by_id = dict()
+        for record in self.records:
+            resource_type, id_, url = record[:3]
+            if url is not None:
+                self.by_url.setdefault(url, list()).append(record)
+            if id_ is not None:
+                self.by_id.setdefault((resource_type, id_), record)
+        self.fp = open(str(path_), "rb")
+        try:
+            size = os.fstat(self.fp.fileno()).st_size
+            if size != index["size"]:
+                raise ValueError(f"Outdated offsets index of {path_}")
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.fp.close()
+            raise
+
+    def __enter__(self):
+        """ """
+        return self
+
+    def __exit__(self, *exc_info):
+        """ """
+        self.close()
+
+    def __len__(self):
+        """ """
+        return len(self.records)
+
+    def __contains__(self, url):
+        """ """
+        return url in self.by_url
+
+    def close(self):
+        """ """
+        self.map.close()
+        self.fp.close()
+
+    def _decode(self, record):
+        """ """
+        offset, length = record[3:]
+        return json.loads(self.map[offset : offset + length])["resource"]
+
+    def get(self, url, resource_type=None):
+        """The resource of canonical ``url`` (``<url>|<version>`` is accepted),
+        of ``resource_type`` if any; None when not found."""
+        records = self.by_url.get(url)
+        if records is None and "|" in url:
+            records = self.by_url.get(url.split("|", 1)[0])
+        for record in records or ():
+            if resource_type is None or record[0] == resource_type:
+                return self._decode(record)
+        return None
+
+    def get_by_id(self, resource_type, id_):
+        """ """
+        record = self.by_id.get((resource_type, id_))
+        if record is None:
+            return None
+        return self._decode(record)
+
+    def resources(self, resource_type=None):
+        """Yields the resources (of ``resource_type``), in the file order."""
+        for record in self.records:
+            if resource_type is None or record[0] == resource_type:
+                yield self._decode(record)
+
+
+def keep_entries(entries):
+    """ """
+    yield from entries
+
 
 def build_minified_json(
     archive_file: pathlib.Path,
     version_info: pathlib.Path,
     destination_dir: pathlib.Path,
+    output_format: str = "compact",
+    compression: str = None,
+    index: bool = False,
 ):
-    """ """
-    tmp_dir = tempfile.mkdtemp()
+    """Minified JSON files are built straight from the definitions archive
+    members (nothing is extracted to disk). When ``version_info`` is None, the
+    archive's own ``version.info`` is used. With ``index``, every ``.min.json``
+    bundle gets its ``<file>.index.json`` byte offsets index (see
+    ``IndexedBundle``), not available with ``compression``.
+
+    Returns the size report: a list of ``(filename, source bytes, output bytes)``.
+    """
+    if index and compression is not None:
+        raise ValueError("Compressed files can't have an offsets index")
     if not destination_dir.exists():
         destination_dir.mkdir(parents=True)
+    report = list()
 
     with zipfile.ZipFile(str(archive_file), "r") as zip_ref:
-        zip_ref.extractall(tmp_dir)
+        members = archive_members(zip_ref)
 
-    shutil.copyfile(str(version_info), str(destination_dir / "version.info"))
-    search_param_file = "search-parameters.json"
+        def copy_member(filename):
+            with phase(filename), zip_ref.open(members[filename]) as src_fp:
+                with open(str(destination_dir / filename), "wb") as fp:
+                    shutil.copyfileobj(src_fp, fp)
 
-    shutil.copyfile(
-        os.path.join(tmp_dir, search_param_file), str(destination_dir / search_param_file)
-    )
+        def minify_member(filename, newfilename, minifier, index=False):
+            destination = compressed_path(destination_dir / newfilename, compression)
+            with phase(filename), io.TextIOWrapper(
+                zip_ref.open(members[filename]), encoding="utf-8"
+            ) as src_fp:
+                minify_bundle_stream(
+                    src_fp, destination, minifier, output_format, index
+                )
+            report.append(
+                (
+                    destination.name,
+                    members[filename].file_size,
+                    destination.stat().st_size,
+                )
+            )
 
-    for filename in ["profiles-types.json", "profiles-resources.json"]:
-        new_bundle = dict(entry=list())
+        if version_info is None:
+            copy_member("version.info")
+        else:
+            shutil.copyfile(str(version_info), str(destination_dir / "version.info"))
 
-        with io.open(os.path.join(tmp_dir, filename), "r", encoding="utf-8") as fp:
-            bundle_json = json.loads(fp.read())
+        search_param_file = "search-parameters.json"
+        if output_format == "pretty" and compression is None:
+            copy_member(search_param_file)
+            size = members[search_param_file].file_size
+            report.append((search_param_file, size, size))
+        else:
+            minify_member(search_param_file, search_param_file, keep_entries)
 
-        for entry in bundle_json["entry"]:
-            resource = entry["resource"].copy()
-            if "StructureDefinition" == resource["resourceType"]:
-                del resource["text"]
-                del resource["snapshot"]
-                new_bundle["entry"].append(
-                    {"fullUrl": entry.get("fullUrl"), "resource": resource}
-                )
-        del bundle_json["entry"]
-        new_bundle.update(bundle_json)
-        newfilename = filename.split(".")[:-1] + ["min", "json"]
-        with open(str(destination_dir / ".".join(newfilename)), "w", encoding="utf-8") as fp:
-            json.dump(new_bundle, fp, indent=2)
-
-    # Work with valuset
-    with io.open(os.path.join(tmp_dir, "valuesets.json"), "r", encoding="utf-8") as fp:
-        new_bundle = dict(entry=list())
-        bundle_json = json.loads(fp.read())
-        for entry in bundle_json["entry"]:
-            resource = entry["resource"].copy()
-            if "ValueSet" == resource["resourceType"]:
-                assert "url" in resource
-
-            elif "CodeSystem" == resource["resourceType"]:
-                assert "url" in resource
-                if "content" not in resource and "concept" not in resource:
+        for filename in ["profiles-types.json", "profiles-resources.json"]:
+            newfilename = filename.split(".")[:-1] + ["min", "json"]
+            minify_member(
+                filename, ".".join(newfilename), minify_profiles_entries, index
+            )
+
+        # Work with valuset
+        minify_member(
+            "valuesets.json", "valuesets.min.json", minify_valuesets_entries, index
+        )
+
+    return report
+
+
+# source definitions member and minifier of the static archive members
+STATIC_ARCHIVE_SOURCES = {
+    "version.info": ("version.info", None),
+    "search-parameters.json": ("search-parameters.json", keep_entries),
+    "valuesets.min.json": ("valuesets.json", minify_valuesets_entries),
+    "profiles-resources.min.json": (
+        "profiles-resources.json",
+        minify_profiles_entries,
+    ),
+    "profiles-types.min.json": ("profiles-types.json", minify_profiles_entries),
+}
+
+
+def static_archive_info(name: str, is_dir: bool = False):
+    """ZipInfo of a static archive member, with the fixed timestamp."""
+    info = zipfile.ZipInfo(name, STATIC_ARCHIVE_DATE_TIME)
+    if is_dir:
+        info.external_attr = 0o40755 << 16 | 0x10
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o100644 << 16
+    return info
+
+
+def build_static_archive(
+    archive_file: pathlib.Path,
+    version_info: pathlib.Path,
+    version: str,
+    destination: pathlib.Path,
+    output_format: str = "compact",
+):
+    """Builds the minified JSON files of a definitions archive straight into
+    the versioned static archive ``destination`` (members under a
+    ``<version>/`` directory), as the ones under
+    ``static/HL7/FHIR/spec/minified``: every definitions member is streamed
+    through its minifier into its archive member. The archive is written aside
+    and renamed into place.
+
+    Returns the size report (see ``build_minified_json``).
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    tmp_archive = destination.with_name(f".{destination.name}.tmp")
+    report = list()
+    with zipfile.ZipFile(str(archive_file), "r") as src_ref, zipfile.ZipFile(
+        str(tmp_archive), "w", zipfile.ZIP_DEFLATED
+    ) as zip_ref:
+        members = archive_members(src_ref)
+        zip_ref.writestr(static_archive_info(f"{version}/", is_dir=True), b"")
+        for filename in STATIC_ARCHIVE_FILES:
+            source_name, minifier = STATIC_ARCHIVE_SOURCES[filename]
+            info = static_archive_info(f"{version}/{filename}")
+            with phase(source_name), zip_ref.open(info, "w") as fp:
+                if filename == "version.info" and version_info is not None:
+                    with open(str(version_info), "rb") as src_fp:
+                        shutil.copyfileobj(src_fp, fp, 1024 * 1024)
                     continue
-            else:
-                continue
+                member = members[source_name]
+                if minifier is None or (
+                    minifier is keep_entries and output_format == "pretty"
+                ):
+                    with src_ref.open(member) as src_fp:
+                        shutil.copyfileobj(src_fp, fp, 1024 * 1024)
+                else:
+                    with io.TextIOWrapper(
+                        src_ref.open(member), encoding="utf-8"
+                    ) as src_fp, io.TextIOWrapper(fp, encoding="utf-8") as text_fp:
+                        reader = BundleReader(src_fp)
+                        write_bundle(
+                            text_fp,
+                            minifier(reader.entries()),
+                            reader.bundle,
+                            output_format,
+                        )
+            if minifier is not None:
+                report.append((filename, member.file_size, info.file_size))
+    os.replace(str(tmp_archive), str(destination))
+    return report
 
-            del resource["text"]
-            new_bundle["entry"].append(
-                {"fullUrl": entry.get("fullUrl"), "resource": resource}
-            )
-        del bundle_json["entry"]
-        new_bundle.update(bundle_json)
-        with open(str(destination_dir / "valuesets.min.json"), "w", encoding="utf-8") as fp:
-            json.dump(new_bundle, fp, indent=2)
 
-    shutil.rmtree(tmp_dir)
+def _build_static_archive_task(task):
+    """ """
+    return build_static_archive(**task)
+
+
+def build_static_archives(tasks, jobs: int = 1):
+    """Builds many static archives, in parallel across ``jobs`` processes
+    (0 or None means all available CPUs). ``tasks`` are the keyword arguments
+    of ``build_static_archive``.
+
+    Yields ``(task, report)`` in ``tasks`` order.
+    """
+    tasks = list(tasks)
+    if jobs == 0:
+        jobs = os.cpu_count()
+    if jobs is not None and (jobs <= 1 or len(tasks) <= 1):
+        for task in tasks:
+            yield task, build_static_archive(**task)
+        return
+    with ProcessPoolExecutor(max_workers=jobs and min(jobs, len(tasks))) as executor:
+        yield from zip(tasks, executor.map(_build_static_archive_task, tasks))
@@ -1,12 +1,18 @@
 """Main module."""
 import requests
 import pathlib
+import gzip
 import io
+import lzma
 import sys
-import shutil
 import tempfile
 import os
+import time
+import hashlib
+import threading
+import zipfile
 from urllib.parse import urlparse
+from tqdm import tqdm
 
 __author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
 
@@ -36,58 +42,277 @@ def resolve_path(string_path: str, parent: pathlib.PurePath = None):
     return me
 
 
+OUTPUT_FORMATS = ("pretty", "compact")
+COMPRESSIONS = ("gz", "xz")
+
+
+def json_dumps_kwargs(output_format: str = "pretty"):
+    """``json.dumps`` keyword arguments for the given output format:
+    ``pretty`` is indented for humans, ``compact`` has no whitespace at all."""
+    if output_format == "compact":
+        return {"separators": (",", ":")}
+    elif output_format == "pretty":
+        return {"indent": 2}
+    raise ValueError(f"Unknown output format {output_format}")
+
+
+def compressed_path(path: pathlib.Path, compression: str = None):
+    """Returns ``path`` with the suffix of the ``compression`` (if any)."""
+    if compression is None:
+        return path
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}")
+    return path.with_name(path.name + "." + compression)
+
+
+def open_text(path: pathlib.Path, mode: str = "r"):
+    """Opens text file ``path``, transparently (de)compressed based on its
+    suffix (``.gz`` or ``.xz``)."""
+    mode = mode + "t"
+    if path.suffix == ".gz":
+        return gzip.open(str(path), mode, encoding="utf-8")
+    elif path.suffix == ".xz":
+        return lzma.open(str(path), mode, encoding="utf-8")
+    return io.open(str(path), mode, encoding="utf-8")
+
+
+def write_text_atomic(path: pathlib.Path, text: str):
+    """Writes ``text`` to a temporary file beside ``path`` (compressed the same
+    way) then renames it over ``path``, readers never see a partial file."""
+    tmp_path = path.with_name(
+        f".tmp-{os.getpid()}-{threading.get_ident()}-{path.name}"
+    )
+    try:
+        with open_text(tmp_path, "w") as fp:
+            fp.write(text)
+        os.replace(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def archive_members(zip_ref: zipfile.ZipFile):
+    """Maps the base name of every archive member to its ZipInfo."""
+    return {
+        pathlib.PurePosixPath(info.filename).name: info
+        for info in zip_ref.infolist()
+        if not info.is_dir()
+    }
+
+
 def filename_from_url(url: str):
     """ """
     return pathlib.Path(urlparse(url).path).name
 
 
-def download(url: str, output_path: pathlib.Path = None):
+_session = None
+_session_lock = threading.Lock()
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def get_session():
+    """Returns the shared ``requests.Session`` (connection pooling)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4, pool_maxsize=16
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def content_range_start(response):
+    """The first byte position of the ``Content-Range`` of ``response``, None
+    if it has none (or an unparsable one)."""
+    value = response.headers.get("Content-Range", "")
+    unit, _, range_ = value.strip().partition(" ")
+    if unit != "bytes":
+        return None
+    try:
+        return int(range_.split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+def filename_from_response(response, url: str):
     """ """
-    if output_path is None:
-        output_path = pathlib.Path(tempfile.mkdtemp())
-
-    def _get_file_name(resp):
-        """ """
-        parts = resp.headers.get("Content-Disposition", "").split(";")
-        if len(parts) == 1 and parts[0] == "":
-            return filename_from_url(url)
-
-        for part in parts:
-            part = part.strip()
-            if not part:
-                continue
-            if part.lower().startswith("filename"):
-                filename = part.split("=", 1)[1]
-                return filename.strip()
+    parts = response.headers.get("Content-Disposition", "").split(";")
+    if len(parts) == 1 and parts[0] == "":
         return filename_from_url(url)
 
-    try:
-        sys.stdout.write(f"### helpers.download> Start downloading file from {url}\n")
-        with requests.get(
-            url, stream=True, allow_redirects=True, verify=True
-        ) as response:
-            assert response.status_code == 200
-            if output_path.is_dir():
-                if not output_path.exists():
-                    output_path.mkdir()
-                filename = _get_file_name(response)
-                output_path = output_path / filename
-            write_mode = (
-                response.headers.get("Content-Type").lower().startswith("text/")
-                and "w"
-                or "wb"
-            )
-            with io.open(str(output_path), write_mode) as fp:
-                if write_mode == "w":
-                    fp.write(response.text)
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        if part.lower().startswith("filename"):
+            filename = part.split("=", 1)[1]
+            return filename.strip().strip('"')
+    return filename_from_url(url)
+
+
+def download_file(
+    url: str,
+    output_path: pathlib.Path,
+    session: requests.Session = None,
+    retries: int = 5,
+    backoff: float = 0.5,
+    expected_sha256: str = None,
+    progress: bool = True,
+    timeout: float = 60,
+    chunk_size: int = 64 * 1024,
+):
+    """Downloads ``url`` to ``output_path`` (a file, or a directory in which
+    case the file name comes from the response).
+
+    The content is streamed to a ``.part`` file and the sha256 is computed on
+    the fly; an interrupted transfer is resumed with an HTTP Range request (also
+    from a ``.part`` file left by a previous run) and retried with exponential
+    backoff. Returns ``(path, sha256 hexdigest)``.
+
+    Range offsets and sizes are those of the file itself, so the content is
+    requested without ``Content-Encoding``; should the server encode it anyway
+    (the offsets would be the encoded ones) or answer another range than the
+    requested one, the download starts over.
+    """
+    session = session or get_session()
+    if output_path.is_dir():
+        target_dir, filename = output_path, filename_from_url(url)
+    else:
+        target_dir, filename = output_path.parent, output_path.name
+    partial = target_dir / (filename + ".part")
+
+    attempt = 0
+    while True:
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        try:
+            with session.get(
+                url,
+                stream=True,
+                allow_redirects=True,
+                verify=True,
+                headers=headers,
+                timeout=timeout,
+            ) as response:
+                if response.status_code == 416 and offset:
+                    # stale partial file, start over
+                    partial.unlink()
+                    continue
+                if response.status_code in RETRY_STATUS_CODES:
+                    raise requests.exceptions.ConnectionError(
+                        f"{response.status_code} Server Error for url: {url}",
+                        response=response,
+                    )
+                response.raise_for_status()
+                if output_path.is_dir():
+                    filename = filename_from_response(response, url)
+
+                encoded = response.headers.get("Content-Encoding", "identity") not in (
+                    "identity",
+                    "",
+                )
+                if encoded and offset:
+                    # resumed at a decoded offset of an encoded content
+                    partial.unlink()
+                    continue
+                if (
+                    response.status_code == 206
+                    and offset
+                    and content_range_start(response) != offset
+                ):
+                    # not the requested range, appending it would corrupt the file
+                    partial.unlink()
+                    continue
+                hash_ = hashlib.sha256()
+                if response.status_code == 206 and offset:
+                    mode = "ab"
+                    with open(str(partial), "rb") as fp:
+                        for chunk in iter(lambda: fp.read(chunk_size), b""):
+                            hash_.update(chunk)
                 else:
-                    shutil.copyfileobj(response.raw, fp)
-            sys.stdout.write(
-                f"### helpers.download> download completed within {response.elapsed} sec.\n"
-            )
-            sys.stdout.write(
-                f"### helpers.download> File has been written to {output_path}.\n"
+                    # the server does not support ranges (or nothing to resume)
+                    mode, offset = "wb", 0
+
+                total = not encoded and response.headers.get("Content-Length")
+                total = total and int(total) + offset or None
+                with open(str(partial), mode) as fp, tqdm(
+                    total=total,
+                    initial=offset,
+                    unit="B",
+                    unit_scale=True,
+                    desc=filename,
+                    disable=not progress,
+                ) as progress_bar:
+                    for chunk in response.iter_content(chunk_size):
+                        fp.write(chunk)
+                        hash_.update(chunk)
+                        progress_bar.update(len(chunk))
+                if total is not None and partial.stat().st_size < total:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Incomplete download of {url}"
+                    )
+                break
+        except RETRY_EXCEPTIONS as exc:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff * (2 ** (attempt - 1))
+            sys.stderr.write(
+                f"### helpers.download> {exc}, retrying in {delay} sec "
+                f"({attempt}/{retries}).\n"
             )
+            time.sleep(delay)
+
+    digest = hash_.hexdigest()
+    if expected_sha256 is not None and digest != expected_sha256.lower():
+        partial.unlink()
+        raise ValueError(
+            f"Checksum mismatch for {url}: expected {expected_sha256} got {digest}"
+        )
+    destination = target_dir / filename
+    os.replace(str(partial), str(destination))
+    return destination, digest
+
+
+def download_dir(url: str):
+    """The download directory of ``url`` in the temporary directory, the same
+    from one run to the next so that a partial download is resumed."""
+    path_ = (
+        pathlib.Path(tempfile.gettempdir())
+        / "fhirpath_helpers"
+        / hashlib.md5(url.encode()).hexdigest()
+    )
+    path_.mkdir(parents=True, exist_ok=True)
+    return path_
+
+
+def download(url: str, output_path: pathlib.Path = None, **kwargs):
+    """ """
+    if output_path is None:
+        output_path = download_dir(url)
+
+    try:
+        sys.stdout.write(f"### helpers.download> Start downloading file from {url}\n")
+        started = time.time()
+        output_path, digest = download_file(url, output_path, **kwargs)
+        sys.stdout.write(
+            "### helpers.download> download completed within "
+            f"{time.time() - started:.2f} sec (sha256 {digest}).\n"
+        )
+        sys.stdout.write(
+            f"### helpers.download> File has been written to {output_path}.\n"
+        )
     except requests.exceptions.HTTPError as exc:
         sys.stderr.write(str(exc) + "\n")
         return
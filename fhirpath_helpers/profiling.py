@@ -0,0 +1,236 @@
+# _*_ coding: utf-8 _*_
+"""Per phase instrumentation (wall time, CPU time, peak RSS and bytes
+read/written) of the mappings generation and the spec minification.
+
+The library code wraps its phases with ``phase(name)``, which costs nearly
+nothing unless something listens:
+
+- ``add_phase_hook(callback)`` registers ``callback(name, metrics)``, called at
+  the end of every phase; i.e. to forward timings to an embedding service's own
+  metrics.
+- ``recording()`` collects the phases metrics into a ``PhaseRecorder``, as used
+  by the ``--profile`` option of the CLI (``profile_run``).
+
+Nested phases are named after their parents (``generate/spec_load``) and are
+not exclusive: the metrics of a phase include the ones of its children. Bytes
+read/written are the ones of the whole process (``/proc/self/io``, linux only,
+None elsewhere); work done in worker processes only counts once they exit.
+
+Phases of tasks which may run in worker processes are measured there with
+``collect_phase`` and returned with the task result; the parent merges them
+with ``record_phases`` as children of its current phase. Their metrics add up
+over all the workers: with several workers, their wall time may exceed the
+one of their parent phase.
+"""
+from contextlib import contextmanager
+import cProfile
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+METRICS = ("wall", "cpu", "children_cpu", "read_bytes", "written_bytes")
+
+_hooks = list()
+_recorders = list()
+_local = threading.local()
+
+
+def add_phase_hook(callback):
+    """``callback(name, metrics)`` is called at the end of every phase."""
+    _hooks.append(callback)
+
+
+def remove_phase_hook(callback):
+    """ """
+    _hooks.remove(callback)
+
+
+def io_counters():
+    """Returns ``(read bytes, written bytes)`` of the process (including what
+    is served by the page cache), or ``(None, None)``."""
+    try:
+        with open("/proc/self/io", "rb") as fp:
+            counters = dict(line.split(b":") for line in fp.read().splitlines())
+        return int(counters[b"rchar"]), int(counters[b"wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss_kb():
+    """ """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def children_cpu():
+    """ """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def snapshot():
+    """ """
+    read_bytes, written_bytes = io_counters()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": time.process_time(),
+        "children_cpu": children_cpu(),
+        "read_bytes": read_bytes,
+        "written_bytes": written_bytes,
+    }
+
+
+def measure_since(start):
+    """Metrics of the phase started at ``start`` (a ``snapshot()``)."""
+    end = snapshot()
+    metrics = {
+        key: None
+        if start[key] is None or end[key] is None
+        else end[key] - start[key]
+        for key in METRICS
+    }
+    metrics["peak_rss_kb"] = peak_rss_kb()
+    return metrics
+
+
+@contextmanager
+def phase(name):
+    """Measures the enclosed code as phase ``name``."""
+    if not (_hooks or _recorders):
+        yield
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = list()
+    stack.append(name)
+    full_name = "/".join(stack)
+    start = snapshot()
+    try:
+        yield
+    finally:
+        stack.pop()
+        _dispatch(full_name, measure_since(start))
+
+
+def _dispatch(full_name, metrics):
+    """Hands the metrics of a phase over to the recorders and hooks."""
+    for recorder in list(_recorders):
+        recorder.record(full_name, metrics)
+    for callback in list(_hooks):
+        callback(full_name, metrics)
+
+
+def is_active():
+    """Whether phases are being recorded or hooked."""
+    return bool(_hooks or _recorders)
+
+
+@contextmanager
+def collect_phase(name, collected):
+    """Measures the enclosed code into the ``collected`` list as
+    ``(name, metrics)``, to be merged by ``record_phases`` (in the parent
+    process). Nothing is measured when ``collected`` is None."""
+    if collected is None:
+        yield
+        return
+    start = snapshot()
+    try:
+        yield
+    finally:
+        collected.append((name, measure_since(start)))
+
+
+def record_phases(collected):
+    """Records the ``collected`` phases as children of the current phase."""
+    if not (_hooks or _recorders):
+        return
+    stack = getattr(_local, "stack", None) or list()
+    for name, metrics in collected:
+        _dispatch("/".join(stack + [name]), metrics)
+
+
+class PhaseRecorder:
+    """Aggregates the metrics of the phases by name (in first seen order)."""
+
+    def __init__(self):
+        """ """
+        self.lock = threading.Lock()
+        self.phases = dict()
+        self.start = snapshot()
+        self.started = datetime.datetime.now().isoformat()
+
+    def record(self, name, metrics):
+        """ """
+        with self.lock:
+            aggregate = self.phases.get(name)
+            if aggregate is None:
+                self.phases[name] = dict(metrics, calls=1)
+                return
+            aggregate["calls"] += 1
+            for key in METRICS:
+                if aggregate[key] is not None and metrics[key] is not None:
+                    aggregate[key] += metrics[key]
+            aggregate["peak_rss_kb"] = metrics["peak_rss_kb"]
+
+    def report(self, **extra):
+        """ """
+        report = dict(extra)
+        report["started"] = self.started
+        report["total"] = measure_since(self.start)
+        report["phases"] = [
+            dict(metrics, name=name) for name, metrics in self.phases.items()
+        ]
+        return report
+
+
+@contextmanager
+def recording():
+    """Collects the metrics of the phases run inside, yields the
+    ``PhaseRecorder``."""
+    recorder = PhaseRecorder()
+    _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorders.remove(recorder)
+
+
+@contextmanager
+def profile_run(report_file=None, stats_file=None, command=None):
+    """Used by the CLI ``--profile``/``--profile-stats`` options: writes the
+    phases JSON run report to ``report_file`` and the ``cProfile`` stats
+    (loadable with ``pstats``) to ``stats_file``; either may be None."""
+    if report_file is None and stats_file is None:
+        yield
+        return
+    profiler = cProfile.Profile() if stats_file else None
+    with recording() as recorder:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(str(stats_file))
+            if report_file is not None:
+                report = recorder.report(
+                    command=command, argv=sys.argv[1:], pid=os.getpid()
+                )
+                with open(str(report_file), "w", encoding="utf-8") as fp:
+                    json.dump(report, fp, indent=2)
@@ -0,0 +1,352 @@
+# _*_ coding: utf-8 _*_
+"""Precompiled binary snapshot of a (minified) FHIR spec.
+
+A snapshot holds the pre-parsed tables of a spec release/version:
+StructureDefinitions elements, SearchParameters, the ValueSets/CodeSystems
+(slimmed down to what is needed to resolve codes) and the ValueSets membership
+tables compiled from them (see ``fhirpath_helpers.terminology``). It is serialized with
+``marshal``, which loads far faster than JSON, behind a fixed size header::
+
+    magic (8 bytes) | format version (uint16) | marshal version (uint16) |
+    python major (uint8) | python minor (uint8) | spec sha256 (32 bytes) |
+    source stamp (32 bytes)
+
+``marshal`` data is only portable between identical python versions, so any
+header mismatch makes the loader fall back to the JSON files. The source stamp
+(location, size and modification time of the spec files) tells cheaply that
+the spec files are the ones the snapshot has been built from; only when it
+differs are the files read to compare their sha256.
+"""
+from .helpers import archive_members
+from .helpers import open_text
+from .terminology import CodeTables
+from .terminology import compile_code_tables
+from .terminology import concept_properties
+import hashlib
+import json
+import logging
+import marshal
+import pathlib
+import struct
+import sys
+import zipfile
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+logger = logging.getLogger("fhirpath_helpers.snapshot")
+
+SNAPSHOT_MAGIC = b"FHIRSNAP"
+SNAPSHOT_FORMAT_VERSION = 4
+SNAPSHOT_HEADER = struct.Struct("<8sHHBB32s32s")
+
+SPEC_FILES = (
+    "version.info",
+    "profiles-types.min.json",
+    "profiles-resources.min.json",
+    "search-parameters.json",
+    "valuesets.min.json",
+)
+# columns of the StructureDefinition elements table
+ELEMENT_FIELDS = (
+    "path",
+    "types",
+    "min",
+    "max",
+    "content_reference",
+    "binding",
+    "is_summary",
+)
+# columns of the SearchParameters table
+SEARCH_PARAMETER_FIELDS = (
+    "url",
+    "name",
+    "code",
+    "base",
+    "type",
+    "expression",
+    "target",
+)
+
+
+class SnapshotMismatch(ValueError):
+    """The snapshot file can't be used (format, python or spec mismatch)."""
+
+
+def spec_file_path(source: pathlib.Path, filename: str):
+    """The (optionally compressed) file of ``filename`` in the directory
+    ``source``."""
+    for suffix in ("", ".gz", ".xz"):
+        path_ = source / (filename + suffix)
+        if path_.exists():
+            return path_
+    raise FileNotFoundError(f"{filename} is not found in {source}")
+
+
+def read_spec_files(source: pathlib.Path):
+    """Yields ``(filename, bytes)`` of the spec files from ``source``, which is
+    either a directory of (optionally compressed) files or a zip archive, as
+    the ones under ``static/HL7/FHIR/spec/minified``."""
+    if source.is_dir():
+        for filename in SPEC_FILES:
+            with open_text(spec_file_path(source, filename)) as fp:
+                yield filename, fp.read().encode("utf-8")
+        return
+
+    with zipfile.ZipFile(str(source), "r") as zip_ref:
+        members = archive_members(zip_ref)
+        for filename in SPEC_FILES:
+            yield filename, zip_ref.read(members[filename])
+
+
+def element_row(element):
+    """ """
+    return (
+        element["path"],
+        tuple(type_["code"] for type_ in element.get("type", ())),
+        element.get("min"),
+        element.get("max"),
+        element.get("contentReference"),
+        (element.get("binding") or {}).get("valueSet"),
+        element.get("isSummary", False),
+    )
+
+
+def slim_concepts(concepts):
+    """ """
+    return [
+        dict(
+            code=concept["code"],
+            display=concept.get("display"),
+            concept=slim_concepts(concept.get("concept", ())),
+        )
+        for concept in concepts
+    ]
+
+
+def slim_valueset(resource):
+    """Keeps only what is needed to resolve the ValueSet codes."""
+    compose = dict()
+    for part in ("include", "exclude"):
+        compose[part] = [
+            dict(
+                system=item.get("system"),
+                version=item.get("version"),
+                valueSet=item.get("valueSet", []),
+                filter=item.get("filter", []),
+                concept=slim_concepts(item.get("concept", ())),
+            )
+            for item in resource.get("compose", {}).get(part, ())
+        ]
+    return dict(
+        url=resource["url"],
+        version=resource.get("version"),
+        name=resource.get("name"),
+        compose=compose,
+    )
+
+
+def slim_codesystem(resource):
+    """Keeps the concepts hierarchy, the hierarchy meaning and the codes of the
+    (CodeSystem and concepts) properties."""
+    properties = {p["code"] for p in resource.get("property", ())}
+    properties.update(concept_properties(resource.get("concept", ())))
+    return dict(
+        url=resource["url"],
+        version=resource.get("version"),
+        name=resource.get("name"),
+        content=resource.get("content"),
+        hierarchyMeaning=resource.get("hierarchyMeaning"),
+        property=[dict(code=code) for code in sorted(filter(None, properties))],
+        concept=slim_concepts(resource.get("concept", ())),
+    )
+
+
+def spec_hash(source: pathlib.Path):
+    """sha256 of the spec files from ``source``, as stored in the header of
+    the snapshots compiled from them."""
+    hash_ = hashlib.sha256()
+    for filename, content in read_spec_files(source):
+        hash_.update(filename.encode())
+        hash_.update(content)
+    return hash_.digest()
+
+
+def source_stamp(source: pathlib.Path):
+    """sha256 of the location, size and modification time of the spec files
+    from ``source``, without reading them."""
+    if source.is_dir():
+        paths = [spec_file_path(source, filename) for filename in SPEC_FILES]
+    else:
+        paths = [source]
+    hash_ = hashlib.sha256()
+    for path_ in paths:
+        stat = path_.stat()
+        hash_.update(
+            f"{path_.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode()
+        )
+    return hash_.digest()
+
+
+def compile_spec(source: pathlib.Path):
+    """Parses the JSON spec files from ``source`` into the snapshot tables.
+
+    Returns ``(tables, spec_hash)``.
+    """
+    hash_ = hashlib.sha256()
+    tables = dict(
+        version_info="",
+        structure_definitions=dict(),
+        search_parameters=list(),
+        valuesets=dict(),
+        codesystems=dict(),
+    )
+    for filename, content in read_spec_files(source):
+        hash_.update(filename.encode())
+        hash_.update(content)
+        if filename == "version.info":
+            tables["version_info"] = content.decode("utf-8")
+            continue
+
+        entries = json.loads(content)["entry"]
+        del content
+        for entry in entries:
+            resource = entry["resource"]
+            resource_type = resource["resourceType"]
+            if resource_type == "StructureDefinition":
+                tables["structure_definitions"][resource["name"]] = (
+                    resource["url"],
+                    resource.get("kind"),
+                    resource.get("baseDefinition"),
+                    resource.get("type"),
+                    tuple(
+                        element_row(element)
+                        for element in resource.get("differential", {}).get(
+                            "element", ()
+                        )
+                    ),
+                )
+            elif resource_type == "SearchParameter":
+                tables["search_parameters"].append(
+                    (
+                        resource.get("url"),
+                        resource["name"],
+                        resource["code"],
+                        tuple(resource.get("base", ())),
+                        resource["type"],
+                        resource.get("expression"),
+                        tuple(resource.get("target", ())),
+                    )
+                )
+            elif resource_type == "ValueSet":
+                tables["valuesets"][resource["url"]] = slim_valueset(resource)
+            elif resource_type == "CodeSystem":
+                tables["codesystems"][resource["url"]] = slim_codesystem(resource)
+
+    tables["code_tables"] = compile_code_tables(
+        tables["valuesets"], tables["codesystems"]
+    )
+    return tables, hash_.digest()
+
+
+def python_tag():
+    """ """
+    return sys.version_info[0], sys.version_info[1]
+
+
+def write_snapshot(
+    tables, spec_hash: bytes, destination: pathlib.Path, stamp: bytes = bytes(32)
+):
+    """ """
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_FORMAT_VERSION,
+        marshal.version,
+        *python_tag(),
+        spec_hash,
+        stamp,
+    )
+    with open(str(destination), "wb") as fp:
+        fp.write(header)
+        fp.write(marshal.dumps(tables))
+    return destination.stat().st_size
+
+
+def build_snapshot(source: pathlib.Path, destination: pathlib.Path):
+    """Compiles the spec files from ``source`` into the snapshot file
+    ``destination``. Returns the spec hash (hex)."""
+    # stamped before reading, a file changed meanwhile won't match the stamp
+    stamp = source_stamp(source)
+    tables, spec_hash = compile_spec(source)
+    write_snapshot(tables, spec_hash, destination, stamp)
+    return spec_hash.hex()
+
+
+def read_snapshot_header(fp):
+    """Returns the ``(spec_hash, source_stamp)`` of the snapshot header."""
+    data = fp.read(SNAPSHOT_HEADER.size)
+    if len(data) != SNAPSHOT_HEADER.size:
+        raise SnapshotMismatch("Truncated snapshot header")
+    magic, format_version, marshal_version, major, minor, spec_hash, stamp = (
+        SNAPSHOT_HEADER.unpack(data)
+    )
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotMismatch("Not a spec snapshot file")
+    if format_version != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotMismatch(
+            f"Snapshot format version {format_version} is not supported "
+            f"(expected {SNAPSHOT_FORMAT_VERSION})"
+        )
+    if marshal_version != marshal.version or (major, minor) != python_tag():
+        raise SnapshotMismatch(
+            f"Snapshot has been built with python {major}.{minor} "
+            f"(marshal version {marshal_version})"
+        )
+    return spec_hash, stamp
+
+
+def read_snapshot_tables(fp):
+    """Loads the tables following the header."""
+    try:
+        # loads() on the whole payload is much faster than load(fp)
+        return marshal.loads(fp.read())
+    except (EOFError, ValueError, TypeError) as exc:
+        raise SnapshotMismatch(f"Corrupted snapshot: {exc}")
+
+
+def read_snapshot(path: pathlib.Path, spec_hash: bytes = None):
+    """Loads the snapshot tables; ``spec_hash`` if provided must match the one
+    the snapshot has been built from."""
+    with open(str(path), "rb") as fp:
+        snapshot_hash, _ = read_snapshot_header(fp)
+        if spec_hash is not None and spec_hash != snapshot_hash:
+            raise SnapshotMismatch("Snapshot has been built from another spec")
+        return read_snapshot_tables(fp)
+
+
+def read_source_snapshot(path: pathlib.Path, source: pathlib.Path):
+    """Loads the snapshot tables if the snapshot has been built from the spec
+    files of ``source``: their stamp is checked first, their sha256 only if
+    the stamp differs (i.e. files copied or touched)."""
+    with open(str(path), "rb") as fp:
+        snapshot_hash, stamp = read_snapshot_header(fp)
+        if stamp != source_stamp(source) and snapshot_hash != spec_hash(source):
+            raise SnapshotMismatch("Snapshot has been built from another spec")
+        return read_snapshot_tables(fp)
+
+
+def load_spec_tables(source: pathlib.Path, snapshot: pathlib.Path = None):
+    """Loads the spec tables from the ``snapshot`` file, falling back to
+    compile them from the JSON files of ``source`` when the snapshot is
+    missing, can't be used or has been built from other spec files (i.e. an
+    outdated snapshot or another release)."""
+    if snapshot is not None:
+        try:
+            return read_source_snapshot(snapshot, source)
+        except (OSError, SnapshotMismatch) as exc:
+            logger.warning(f"Cannot use spec snapshot {snapshot}: {exc}")
+    return compile_spec(source)[0]
+
+
+def load_code_tables(source: pathlib.Path, snapshot: pathlib.Path = None):
+    """``CodeTables`` of the ValueSets of the spec (see ``load_spec_tables``)."""
+    return CodeTables(load_spec_tables(source, snapshot)["code_tables"])
@@ -0,0 +1,355 @@
+# _*_ coding: utf-8 _*_
+"""Download cache of the FHIR spec artifacts (definitions archives and
+version info files).
+
+Every cached file is recorded in the ``manifest.json`` of the cache directory
+with its url, size, sha256 and last access time. A file is verified against
+its manifest entry whenever it is read from the cache and fetched again on
+mismatch. When a maximum size is given, the least recently used files are
+evicted to fit in it. The cache may be shared by concurrent processes: the
+manifest is only read and written under an exclusive lock of the cache
+directory (``.lock`` file), files are verified outside of it. A file accessed
+less than ``EVICTION_GRACE`` seconds ago is never evicted, as it may be in use
+by another process.
+
+Downloads go through the ``.partial`` directory of the cache, where an
+interrupted download is left to be resumed by the next run.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .helpers import download_file
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+logger = logging.getLogger("fhirpath_helpers.spec_cache")
+
+SPEC_BASE_URL = (
+    "https://github.com/nazrulworld/fhir-parser/raw/master/archives/HL7/FHIR"
+)
+DEFAULT_CONCURRENCY = 4
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+PARTIAL_DIR = ".partial"
+# temporary download directories older than that are leftovers of killed runs
+STALE_TMP_AGE = 24 * 3600
+# files accessed more recently than that may be in use, they aren't evicted
+EVICTION_GRACE = 600
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def spec_artifact_urls(release: str, version: str, base_url: str = SPEC_BASE_URL):
+    """Returns the ``(version_info_url, definitions_archive_url)`` pair."""
+    return (
+        f"{base_url}/{release}/{version}-version.info",
+        f"{base_url}/{release}/{version}-definitions.json.zip",
+    )
+
+
+def parse_size(value):
+    """Parses a size such as ``1024``, ``500K``, ``200M`` or ``1G`` into
+    bytes; None stays None (no limit)."""
+    if value is None or isinstance(value, int):
+        return value
+    size = value.strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ""
+    try:
+        return int(float(size[: len(size) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size {value!r}")
+
+
+def cache_file_for(cache_dir: pathlib.Path, url: str):
+    """ """
+    return cache_dir / hashlib.md5(url.encode()).digest().hex()
+
+
+def file_sha256(path_: pathlib.Path):
+    """ """
+    hash_ = hashlib.sha256()
+    with open(str(path_), "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def remove_path(path_: pathlib.Path):
+    """ """
+    if path_.is_dir():
+        shutil.rmtree(str(path_), ignore_errors=True)
+        return
+    try:
+        path_.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def cache_lock(cache_dir: pathlib.Path, lock_file: str = LOCK_FILE):
+    """Exclusive (inter-process) lock of ``cache_dir`` (or of one of its files
+    with another ``lock_file``)."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(str(cache_dir / lock_file), "a") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def read_manifest(cache_dir: pathlib.Path):
+    """Should be called with the cache lock held."""
+    try:
+        with open(str(cache_dir / MANIFEST_FILE), "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return dict()
+    except ValueError:
+        logger.warning(f"Corrupted spec cache manifest in {cache_dir}, reset.")
+        return dict()
+
+
+def write_manifest(cache_dir: pathlib.Path, manifest):
+    """Should be called with the cache lock held."""
+    tmp_file = cache_dir / (MANIFEST_FILE + ".tmp")
+    with open(str(tmp_file), "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(str(tmp_file), str(cache_dir / MANIFEST_FILE))
+
+
+def verify_entry(cache_dir: pathlib.Path, name: str, entry):
+    """Returns None if the cached file matches its manifest ``entry``,
+    otherwise the reason of the mismatch."""
+    path_ = cache_dir / name
+    if not path_.is_file():
+        return "missing"
+    if path_.stat().st_size != entry["size"]:
+        return "size mismatch"
+    if file_sha256(path_) != entry["sha256"]:
+        return "sha256 mismatch"
+    return None
+
+
+def evict(cache_dir: pathlib.Path, manifest, max_size: int, keep=()):
+    """Removes the least recently used files until the cache fits in
+    ``max_size`` bytes, ``keep`` files and the ones accessed within the
+    ``EVICTION_GRACE`` are never evicted.
+    Should be called with the cache lock held. Returns the evicted names."""
+    total = sum(entry["size"] for entry in manifest.values())
+    evicted = list()
+    now = time.time()
+    for name, entry in sorted(
+        manifest.items(), key=lambda item: item[1]["last_access"]
+    ):
+        if total <= max_size:
+            break
+        if name in keep or now - entry["last_access"] < EVICTION_GRACE:
+            continue
+        remove_path(cache_dir / name)
+        del manifest[name]
+        total -= entry["size"]
+        evicted.append(name)
+    return evicted
+
+
+def lookup(cache_dir: pathlib.Path, url: str):
+    """Returns the verified cache file of ``url`` (refreshing its access
+    time) or None. A file that doesn't match its manifest entry is removed.
+
+    The file is hashed without holding the cache lock, its manifest entry is
+    checked again under the lock (it may have been re-fetched or evicted
+    meanwhile)."""
+    name = cache_file_for(cache_dir, url).name
+    with cache_lock(cache_dir):
+        entry = read_manifest(cache_dir).get(name)
+    if entry is None:
+        return None
+    reason = verify_entry(cache_dir, name, entry)
+    with cache_lock(cache_dir):
+        manifest = read_manifest(cache_dir)
+        current = manifest.get(name)
+        if current is None or current["created"] != entry["created"]:
+            return None
+        if reason is not None:
+            logger.warning(f"Cached {url} is invalid ({reason}), re-fetching.")
+            remove_path(cache_dir / name)
+            del manifest[name]
+        else:
+            current["last_access"] = time.time()
+        write_manifest(cache_dir, manifest)
+    return None if reason else cache_dir / name
+
+
+def fetch_to_cache(
+    url: str,
+    cache_dir: pathlib.Path,
+    use_cache: bool = True,
+    max_size: int = None,
+    keep=(),
+):
+    """Returns the cached file of ``url``, downloading it first if it is not
+    cached yet or fails verification.
+
+    The file is downloaded (without holding the cache lock) into the
+    ``.partial`` directory, then atomically renamed into the cache and recorded
+    in the manifest, so concurrent runs never see a partial file. A download
+    interrupted by a previous run is resumed; a lock of the url keeps
+    concurrent runs from writing the same partial file. The eviction to fit in
+    ``max_size`` spares this file and the ``keep`` ones.
+    """
+    if use_cache:
+        cache_file = lookup(cache_dir, url)
+        if cache_file is not None:
+            return cache_file
+
+    cache_file = cache_file_for(cache_dir, url)
+    partial_dir = cache_dir / PARTIAL_DIR
+    with cache_lock(partial_dir, cache_file.name + LOCK_FILE):
+        if use_cache:
+            # fetched by a concurrent run meanwhile
+            cached_file = lookup(cache_dir, url)
+            if cached_file is not None:
+                return cached_file
+        sys.stdout.write(f"### spec_cache> Start downloading file from {url}\n")
+        filename, digest = download_file(
+            url, partial_dir / cache_file.name, progress=False
+        )
+        with cache_lock(cache_dir):
+            os.replace(str(filename), str(cache_file))
+            manifest = read_manifest(cache_dir)
+            now = time.time()
+            manifest[cache_file.name] = dict(
+                url=url,
+                sha256=digest,
+                size=cache_file.stat().st_size,
+                created=now,
+                last_access=now,
+            )
+            if max_size is not None:
+                evict(cache_dir, manifest, max_size, keep=(cache_file.name, *keep))
+            write_manifest(cache_dir, manifest)
+    return cache_file
+
+
+def fetch_all(
+    urls,
+    cache_dir: pathlib.Path,
+    use_cache: bool = True,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    max_size: int = None,
+):
+    """Fetches all ``urls`` concurrently (at most ``concurrency`` at the same
+    time) into ``cache_dir``. Returns the cached files, in ``urls`` order.
+
+    The least recently used files are evicted once all ``urls`` are fetched,
+    never the files of ``urls`` themselves (even if they don't fit in
+    ``max_size`` together)."""
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    urls = list(urls)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(urls)))) as pool:
+        files = list(
+            pool.map(lambda url: fetch_to_cache(url, cache_dir, use_cache), urls)
+        )
+    if max_size is not None:
+        with cache_lock(cache_dir):
+            manifest = read_manifest(cache_dir)
+            evict(cache_dir, manifest, max_size, keep={f.name for f in files})
+            write_manifest(cache_dir, manifest)
+    return files
+
+
+def list_cache(cache_dir: pathlib.Path):
+    """Returns the manifest entries (with their ``name``), most recently
+    used first."""
+    if not cache_dir.exists():
+        return list()
+    with cache_lock(cache_dir):
+        manifest = read_manifest(cache_dir)
+    return [
+        dict(entry, name=name)
+        for name, entry in sorted(
+            manifest.items(), key=lambda item: -item[1]["last_access"]
+        )
+    ]
+
+
+def verify_cache(cache_dir: pathlib.Path, remove: bool = True):
+    """Verifies every cached file. Returns ``{name: reason}`` of the invalid
+    ones, which are removed from the cache unless ``remove`` is False."""
+    if not cache_dir.exists():
+        return dict()
+    invalid = dict()
+    with cache_lock(cache_dir):
+        manifest = read_manifest(cache_dir)
+        for name, entry in list(manifest.items()):
+            reason = verify_entry(cache_dir, name, entry)
+            if reason is None:
+                continue
+            invalid[name] = reason
+            if remove:
+                remove_path(cache_dir / name)
+                del manifest[name]
+        if remove:
+            write_manifest(cache_dir, manifest)
+    return invalid
+
+
+def prune_cache(cache_dir: pathlib.Path, max_size: int = None):
+    """Removes the files unknown to the manifest (i.e. from older versions or
+    stale temporary and partial downloads), then evicts the least recently used
+    files until the cache fits in ``max_size`` bytes. Returns the removed
+    names."""
+    if not cache_dir.exists():
+        return list()
+    removed = list()
+    with cache_lock(cache_dir):
+        manifest = read_manifest(cache_dir)
+        for path_ in cache_dir.iterdir():
+            if path_.name in manifest or path_.name in (MANIFEST_FILE, LOCK_FILE):
+                continue
+            if path_.name == PARTIAL_DIR and path_.is_dir():
+                # resumable downloads, unless a previous run left them long ago
+                for partial in path_.glob("*.part"):
+                    if time.time() - partial.stat().st_mtime >= STALE_TMP_AGE:
+                        remove_path(partial)
+                        removed.append(f"{PARTIAL_DIR}/{partial.name}")
+                continue
+            if path_.name.startswith(".tmp-") and (
+                time.time() - path_.stat().st_mtime < STALE_TMP_AGE
+            ):
+                # most likely an in progress download of another run
+                continue
+            remove_path(path_)
+            removed.append(path_.name)
+        if max_size is not None:
+            removed.extend(evict(cache_dir, manifest, max_size))
+        write_manifest(cache_dir, manifest)
+    return removed
+
+
+def clear_spec_cache(cache_dir: pathlib.Path):
+    """Removes every cached file (the lock file is kept, as other processes
+    may be waiting on it)."""
+    if not cache_dir.exists():
+        return
+    with cache_lock(cache_dir):
+        for path_ in cache_dir.iterdir():
+            if path_.name != LOCK_FILE:
+                remove_path(path_)
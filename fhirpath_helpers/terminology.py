@@ -0,0 +1,241 @@
+# _*_ coding: utf-8 _*_
+"""ValueSets membership tables.
+
+Every ValueSet is compiled into ``(complete, {system: frozenset(codes)})``,
+its (system, code) pairs with interned strings, so that checking a code is a
+hash lookup instead of walking ``compose``/``concept`` structures.
+
+The ``compose`` rules are resolved with the CodeSystems at hand:
+
+- ``include.concept``: the listed codes.
+- a whole CodeSystem include: all the codes of the (local) CodeSystem, the
+  table is ``complete`` only if the CodeSystem ``content`` is.
+- ``filter``: ``concept`` ``is-a``/``descendent-of`` filters on a local
+  CodeSystem whose hierarchy is the nesting of its concepts (``is-a``
+  ``hierarchyMeaning``, no ``parent``/``child``/``subsumedBy`` properties).
+  Other filters (e.g. on SNOMED CT or LOINC) can't be resolved.
+- ``include.valueSet``: the (intersection of the) tables of the ValueSets.
+- ``exclude``: the same, subtracted.
+
+The codes of a table always belong to the ValueSet. Whatever can't be resolved
+makes the table incomplete: a code missing from an incomplete table might still
+belong to the ValueSet. An unresolved include adds no code; an unresolved
+exclude removes all the codes of its system (of all systems without one), as
+any of them might be excluded.
+"""
+import sys
+
+__author__ = "Md Nazrul Islam <email2nazrul@gmail.com>"
+
+CONCEPT_FILTER_OPS = ("is-a", "descendent-of")
+# concept properties stating the hierarchy besides the concepts nesting
+HIERARCHY_PROPERTIES = ("parent", "child", "subsumedBy")
+
+
+def codesystem_codes(concepts):
+    """Yields the codes of the (nested) ``concepts``."""
+    for concept in concepts:
+        yield concept["code"]
+        yield from codesystem_codes(concept.get("concept") or ())
+
+
+def find_concept(concepts, code):
+    """The concept of ``code`` among the (nested) ``concepts``, or None."""
+    for concept in concepts:
+        if concept["code"] == code:
+            return concept
+        found = find_concept(concept.get("concept") or (), code)
+        if found is not None:
+            return found
+    return None
+
+
+def concept_properties(concepts):
+    """Yields the property codes of the (nested) ``concepts``."""
+    for concept in concepts:
+        for property_ in concept.get("property") or ():
+            yield property_.get("code")
+        yield from concept_properties(concept.get("concept") or ())
+
+
+def nested_hierarchy(codesystem):
+    """Whether the is-a hierarchy of ``codesystem`` is entirely stated by the
+    nesting of its concepts."""
+    if codesystem.get("hierarchyMeaning") not in (None, "is-a"):
+        return False
+    properties = {p.get("code") for p in codesystem.get("property") or ()}
+    properties.update(concept_properties(codesystem.get("concept") or ()))
+    return not properties.intersection(HIERARCHY_PROPERTIES)
+
+
+def filter_codes(codesystem, filter_):
+    """Codes of ``codesystem`` matching ``filter_``, None if it can't be
+    resolved."""
+    if filter_.get("property") != "concept" or filter_.get("op") not in (
+        CONCEPT_FILTER_OPS
+    ):
+        return None
+    if not nested_hierarchy(codesystem):
+        return None
+    concept = find_concept(codesystem.get("concept") or (), filter_.get("value"))
+    if concept is None:
+        return set()
+    codes = set(codesystem_codes(concept.get("concept") or ()))
+    if filter_["op"] == "is-a":
+        codes.add(concept["code"])
+    return codes
+
+
+def _intersection(tables):
+    """The (system, code) pairs common to all the ``{system: codes}``
+    ``tables``."""
+    systems = dict(tables[0])
+    for table in tables[1:]:
+        systems = {
+            system: codes & table[system]
+            for system, codes in systems.items()
+            if system in table
+        }
+    return systems
+
+
+def compile_code_tables(valuesets, codesystems):
+    """Compiles the membership table of every one of ``valuesets``.
+
+    ``valuesets`` and ``codesystems`` are keyed by url (as the snapshot tables,
+    raw resources work too). Returns ``{url: (complete, {system: codes})}``.
+    """
+    tables = dict()
+    resolving = set()
+
+    def resolve_include(item):
+        """Returns ``(complete, {system: set(codes)})`` of a compose item."""
+        complete = True
+        parts = list()
+        system = item.get("system")
+        if system:
+            codesystem = codesystems.get(system)
+            if item.get("concept"):
+                codes = {concept["code"] for concept in item["concept"]}
+            elif codesystem is None:
+                codes = set()
+                complete = False
+            else:
+                codes = set(codesystem_codes(codesystem.get("concept") or ()))
+                complete = codesystem.get("content") == "complete"
+                for filter_ in item.get("filter") or ():
+                    filtered = filter_codes(codesystem, filter_)
+                    if filtered is None:
+                        # the matching codes are unknown
+                        codes = set()
+                        complete = False
+                    else:
+                        codes &= filtered
+            parts.append({system: codes})
+        for url in item.get("valueSet") or ():
+            valueset_complete, systems = resolve_valueset(url)
+            complete = complete and valueset_complete
+            parts.append({system: set(codes) for system, codes in systems.items()})
+        if not parts:
+            return False, dict()
+        return complete, _intersection(parts)
+
+    def resolve_valueset(url):
+        """Returns the (cached) table of the ValueSet ``url``."""
+        url = url.split("|", 1)[0]
+        if url in tables:
+            return tables[url]
+        valueset = valuesets.get(url)
+        if valueset is None or url in resolving:
+            # unknown or circular reference
+            return False, dict()
+        resolving.add(url)
+        compose = valueset.get("compose") or dict()
+        complete = bool(compose.get("include"))
+        systems = dict()
+        for item in compose.get("include") or ():
+            item_complete, item_systems = resolve_include(item)
+            complete = complete and item_complete
+            for system, codes in item_systems.items():
+                systems.setdefault(system, set()).update(codes)
+        for item in compose.get("exclude") or ():
+            item_complete, item_systems = resolve_include(item)
+            if not item_complete:
+                # any code of the excluded systems might be excluded
+                complete = False
+                if item.get("system") and not item.get("valueSet"):
+                    systems.pop(item["system"], None)
+                else:
+                    systems.clear()
+                continue
+            for system, codes in item_systems.items():
+                if system in systems:
+                    systems[system] -= codes
+        resolving.discard(url)
+        tables[url] = complete, {
+            sys.intern(system): frozenset(sys.intern(code) for code in codes)
+            for system, codes in systems.items()
+            if codes
+        }
+        return tables[url]
+
+    for url in valuesets:
+        resolve_valueset(url)
+    return tables
+
+
+class CodeTables:
+    """Membership checks on compiled ValueSets tables (see
+    ``compile_code_tables``), in constant time::
+
+        # see fhirpath_helpers.snapshot.load_code_tables
+        tables = load_code_tables(source, snapshot)
+        tables.contains(
+            "http://hl7.org/fhir/ValueSet/administrative-gender",
+            "male",
+            "http://hl7.org/fhir/administrative-gender",
+        )
+    """
+
+    def __init__(self, tables):
+        """``tables``: as returned by ``compile_code_tables``."""
+        self.tables = tables
+
+    def __len__(self):
+        """Number of ValueSets."""
+        return len(self.tables)
+
+    def __contains__(self, url):
+        """Whether the ValueSet ``url`` (``<url>|<version>``) is known."""
+        return url.split("|", 1)[0] in self.tables
+
+    def _table(self, url):
+        """The table of the ValueSet ``url``, KeyError if unknown."""
+        table = self.tables.get(url)
+        if table is None:
+            table = self.tables.get(url.split("|", 1)[0])
+            if table is None:
+                raise KeyError(f"Unknown ValueSet {url}")
+        return table
+
+    def is_complete(self, url):
+        """Whether every (system, code) of the ValueSet ``url`` is known."""
+        return self._table(url)[0]
+
+    def contains(self, url, code, system=None):
+        """Whether ``code`` of ``system`` (any system when None) belongs to the
+        ValueSet ``url`` (``<url>|<version>`` is accepted). Raises KeyError
+        for an unknown ValueSet."""
+        systems = self._table(url)[1]
+        if system is not None:
+            codes = systems.get(system)
+            return codes is not None and code in codes
+        return any(code in codes for codes in systems.values())
+
+    def codes(self, url):
+        """Sorted ``(system, code)`` pairs of the ValueSet ``url``."""
+        return sorted(
+            (system, code)
+            for system, codes in self._table(url)[1].items()
+            for code in codes
+        )
@@ -0,0 +1,80 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.analysis`."""
+import json
+
+from click.testing import CliRunner
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.elasticsearch.analysis import analyze_mapping
+from fhirpath_helpers.elasticsearch.analysis import analyze_mappings
+
+PROPERTIES = {
+    "id": {"type": "keyword"},
+    "name": {
+        "type": "nested",
+        "properties": {
+            "text": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+            "period": {
+                "properties": {"start": {"type": "date"}, "end": {"type": "date"}}
+            },
+            "extension": {
+                "type": "nested",
+                "properties": {"url": {"type": "keyword"}},
+            },
+        },
+    },
+    "resourceType": {"type": "keyword"},
+}
+
+
+def test_analyze_mapping():
+    """ """
+    stats = analyze_mapping(PROPERTIES, nested_cardinality=3)
+    # id, name, text (+raw), period, start, end, extension, url, resourceType
+    assert stats["total_fields"] == 10
+    assert stats["nested_fields"] == 2
+    assert stats["max_depth"] == 3
+    # 3 name values, each with 3 extensions
+    assert stats["hidden_docs"] == 3 + 9
+    assert stats["largest_subtrees"] == [
+        ["name", 8],
+        ["name.period", 3],
+        ["name.extension", 2],
+    ]
+    assert stats["exceeded"] == []
+
+    stats = analyze_mapping(
+        PROPERTIES, limits={"total_fields": 9, "depth": 2}, nested_cardinality=3, top=1
+    )
+    assert stats["largest_subtrees"] == [["name", 8]]
+    assert stats["exceeded"] == ["total_fields", "depth"]
+
+
+def test_analyze_mappings_order():
+    """ """
+    report = analyze_mappings({"Small": {"id": {"type": "keyword"}}, "Big": PROPERTIES})
+    assert list(report) == ["Big", "Small"]
+
+
+def test_cli_analyze_mapping():
+    """ """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main, ["es-analyze-mapping", "-r", "Patient", "-r", "Claim", "--json"]
+    )
+    assert result.exit_code == 1, result.output
+    report = json.loads(result.output[result.output.index("{") :])
+    assert list(report) == ["Claim", "Patient"]
+    assert report["Claim"]["exceeded"] == ["nested_fields"]
+    assert report["Patient"]["exceeded"] == []
+
+    result = runner.invoke(
+        cli.main,
+        ["es-analyze-mapping", "-r", "Patient", "--nested-fields-limit", "10"],
+    )
+    assert result.exit_code == 1
+    assert "1 of 1 mappings exceed the limits: Patient" in result.output
+
+    result = runner.invoke(cli.main, ["es-analyze-mapping", "-r", "Patient"])
+    assert result.exit_code == 0, result.output
+    assert "contact" in result.output
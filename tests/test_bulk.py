@@ -0,0 +1,218 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.bulk`."""
+import http.server
+import json
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.elasticsearch.bulk import iter_actions
+from fhirpath_helpers.elasticsearch.bulk import iter_payloads
+from fhirpath_helpers.elasticsearch.bulk import post_payloads
+from fhirpath_helpers.elasticsearch.bulk import read_resources
+from fhirpath_helpers.elasticsearch.bulk import write_payloads
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings
+
+
+def patient(index):
+    """ """
+    return {
+        "resourceType": "Patient",
+        "id": f"p{index}",
+        "extension": [{"url": "http://example.org/x", "valueString": "y"}],
+        "name": [{"family": f"Doe{index}"}],
+    }
+
+
+def observation(index):
+    """ """
+    return {"resourceType": "Observation", "id": f"o{index}", "status": "final"}
+
+
+class BulkHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in ``_bulk`` endpoint: records the bodies, fails the first
+    request with 503 and the actions of ``fail_id``, rejects the bodies
+    holding ``reject_id`` with 413."""
+
+    lock = threading.Lock()
+    bodies = list()
+    active = 0
+    max_active = 0
+    fail_first = True
+    fail_id = None
+    reject_id = None
+
+    def log_message(self, *args):
+        """ """
+
+    def do_POST(self):
+        """ """
+        cls = type(self)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with cls.lock:
+            if cls.fail_first:
+                cls.fail_first = False
+                self.send_error(503)
+                return
+            if cls.reject_id and f'"_id":"{cls.reject_id}"'.encode() in body:
+                self.send_error(413)
+                return
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(0.05)
+            lines = body.decode("utf-8").splitlines()
+            items = list()
+            for action in lines[::2]:
+                action = json.loads(action)["index"]
+                if action.get("_id") == cls.fail_id:
+                    action = dict(action, status=400, error={"type": "bad"})
+                else:
+                    action = dict(action, status=201)
+                items.append({"index": action})
+            result = json.dumps(
+                {"errors": any("error" in i["index"] for i in items), "items": items}
+            ).encode()
+            with cls.lock:
+                cls.bodies.append(body)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(result)))
+            self.end_headers()
+            self.wfile.write(result)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+@pytest.fixture
+def server():
+    """ """
+    BulkHandler.bodies = list()
+    BulkHandler.active = BulkHandler.max_active = 0
+    BulkHandler.fail_first = True
+    BulkHandler.fail_id = None
+    BulkHandler.reject_id = None
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BulkHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/_bulk"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """An NDJSON file of 30 resources and a Bundle of 10."""
+    ndjson = tmp_path / "resources.ndjson"
+    with open(str(ndjson), "w", encoding="utf-8") as fp:
+        for index in range(15):
+            fp.write(json.dumps(patient(index)) + "\n")
+            fp.write(json.dumps(observation(index)) + "\n")
+    bundle = tmp_path / "bundle.json"
+    bundle.write_text(
+        json.dumps(
+            {
+                "resourceType": "Bundle",
+                "type": "collection",
+                "entry": [{"resource": patient(100 + i)} for i in range(10)],
+            }
+        )
+    )
+    return [ndjson, bundle]
+
+
+def test_read_resources(inputs, tmp_path):
+    """ """
+    assert len(list(read_resources(inputs[0]))) == 30
+    assert [r["id"] for r in read_resources(inputs[1])][:2] == ["p100", "p101"]
+    single = tmp_path / "patient.json"
+    single.write_text(json.dumps(patient(7)))
+    assert [r["id"] for r in read_resources(single)] == ["p7"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_iter_payloads(inputs, jobs):
+    """ """
+    actions = list(iter_actions(inputs, index_prefix="fhir", jobs=jobs, chunk_size=4))
+    assert len(actions) == 40
+    assert json.loads(actions[0].splitlines()[0]) == {
+        "index": {"_index": "fhir-patient", "_id": "p0"}
+    }
+    assert json.loads(actions[1].splitlines()[0])["index"]["_index"] == (
+        "fhir-observation"
+    )
+    payloads = list(iter_payloads(actions, max_bytes=10 ** 6, max_docs=7))
+    assert [len(p.splitlines()) for p in payloads] == [14] * 5 + [10]
+    assert b"".join(payloads) == b"".join(actions)
+
+    max_bytes = len(actions[0]) * 3
+    payloads = list(iter_payloads(actions, max_bytes=max_bytes, max_docs=100))
+    assert all(len(p) <= max_bytes for p in payloads)
+    assert b"".join(payloads) == b"".join(actions)
+
+
+def test_iter_actions_mappings(inputs):
+    """ """
+    mappings = generate_mappings(FHIR_VERSION.R4.name, resources=["Patient"])
+    stats = dict()
+    actions = list(iter_actions(inputs, mappings, "", jobs=2, stats=stats))
+    assert len(actions) == 25
+    assert stats["skipped"] == 15
+    index, source = actions[0].splitlines()
+    assert json.loads(index)["index"]["_index"] == "patient"
+    assert "extension" not in json.loads(source)
+
+
+def test_write_payloads(tmp_path):
+    """ """
+    paths = write_payloads([b"a\n", b"b\n"], tmp_path / "bulk")
+    assert [p.name for p in paths] == ["bulk-000001.ndjson", "bulk-000002.ndjson"]
+    assert paths[1].read_bytes() == b"b\n"
+
+
+def test_post_payloads(server, inputs):
+    """ """
+    payloads = iter_payloads(iter_actions(inputs), max_docs=3)
+    summary = post_payloads(payloads, server, concurrency=3)
+    # the first request is retried after the 503
+    assert summary == {"requests": 14, "items": 40, "failed": 0}
+    assert len(BulkHandler.bodies) == 14
+    assert 1 < BulkHandler.max_active <= 3
+
+
+def test_post_payloads_rejected(server, inputs, caplog):
+    """A rejected body fails its actions, the other bodies are still sent."""
+    BulkHandler.reject_id = "o4"
+    payloads = iter_payloads(iter_actions(inputs), max_docs=3)
+    summary = post_payloads(payloads, server, concurrency=2)
+    assert summary == {"requests": 14, "items": 40, "failed": 3}
+    assert len(BulkHandler.bodies) == 13
+    assert "_bulk request of 3 actions failed" in caplog.text
+
+
+def test_cli_bulk(server, inputs, tmp_path):
+    """ """
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ["es-bulk", str(inputs[0])])
+    assert result.exit_code != 0
+    assert "Exactly one of --output-dir or --url" in result.output
+
+    result = runner.invoke(
+        cli.main,
+        ["es-bulk", "-o", str(tmp_path / "out"), "--max-docs", "10"]
+        + [str(p) for p in inputs],
+    )
+    assert result.exit_code == 0, result.output
+    assert "4 _bulk bodies written" in result.output
+
+    BulkHandler.fail_id = "o3"
+    result = runner.invoke(
+        cli.main, ["es-bulk", "--url", server, "-j", "2", str(inputs[0])]
+    )
+    assert result.exit_code == 1
+    assert "1 _bulk requests, 29 resources indexed, 1 failed" in result.output
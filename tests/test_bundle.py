@@ -0,0 +1,112 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.bundle`."""
+import json
+import pathlib
+
+import pytest
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers.elasticsearch.bundle import build_index_templates
+from fhirpath_helpers.elasticsearch.bundle import read_mappings_bundle
+from fhirpath_helpers.elasticsearch.mapping import make_and_write_es_mappings
+from fhirpath_helpers.elasticsearch.mapping import mapping_documents
+from fhirpath_helpers.helpers import open_text
+
+RESOURCES = ["Patient", "Observation", "Encounter"]
+
+
+@pytest.fixture(scope="module")
+def documents():
+    """ """
+    return mapping_documents(FHIR_VERSION.R4.name, resources=RESOURCES)
+
+
+def without_last_updated(document):
+    """ """
+    return dict(
+        document,
+        meta={k: v for k, v in document["meta"].items() if k != "lastUpdated"},
+    )
+
+
+@pytest.mark.parametrize(
+    "output_mode,compression",
+    [("bundle", None), ("ndjson", None), ("ndjson", "gz"), ("bundle", "xz")],
+)
+def test_bundle_output_modes(tmp_path, documents, output_mode, compression, capsys):
+    """ """
+    paths = make_and_write_es_mappings(
+        tmp_path,
+        FHIR_VERSION.R4.name,
+        resources=RESOURCES,
+        output_mode=output_mode,
+        compression=compression,
+    )
+    (path_,) = map(pathlib.Path, paths)
+    assert list(tmp_path.iterdir()) == [path_]
+    bundle = read_mappings_bundle(path_)
+    assert list(bundle) == sorted(RESOURCES)
+    for resource in RESOURCES:
+        assert without_last_updated(bundle[resource]) == without_last_updated(
+            documents[resource]
+        )
+    if output_mode == "ndjson":
+        with open_text(path_) as fp:
+            assert len(fp.readlines()) == len(RESOURCES)
+
+    content = (path_).read_bytes()
+    capsys.readouterr()
+    make_and_write_es_mappings(
+        tmp_path,
+        FHIR_VERSION.R4.name,
+        resources=RESOURCES,
+        output_mode=output_mode,
+        compression=compression,
+    )
+    assert "is unchanged" in capsys.readouterr().out
+    assert (path_).read_bytes() == content
+
+
+def test_index_templates(documents):
+    """ """
+    templates = build_index_templates(documents, "R4", index_prefix="test")
+    assert list(templates["component_templates"]) == ["test-r4-base"]
+    shared = templates["component_templates"]["test-r4-base"]["template"][
+        "mappings"
+    ]["properties"]
+    assert {"id", "meta", "resourceType"} <= set(shared)
+    assert "gender" not in shared
+
+    assert sorted(templates["index_templates"]) == [
+        "test-encounter",
+        "test-observation",
+        "test-patient",
+    ]
+    for resource, document in documents.items():
+        template = templates["index_templates"][f"test-{resource.lower()}"]
+        assert template["composed_of"] == ["test-r4-base"]
+        assert f"test-{resource.lower()}-*" in template["index_patterns"]
+        properties = template["template"]["mappings"]["properties"]
+        assert not set(properties) & set(shared)
+        # composed mapping is the resource mapping
+        assert dict(shared, **properties) == document["mapping"]["properties"]
+        assert template["_meta"]["contentHash"] == document["meta"]["contentHash"]
+
+
+def test_index_templates_output_mode(tmp_path):
+    """ """
+    cache_dir = tmp_path / "cache"
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    for _ in range(2):
+        (path_,) = make_and_write_es_mappings(
+            output_dir,
+            FHIR_VERSION.R4.name,
+            resources=RESOURCES,
+            cache_dir=cache_dir,
+            output_mode="index-templates",
+        )
+    with open(path_) as fp:
+        templates = json.load(fp)
+    assert len(templates["index_templates"]) == len(RESOURCES)
+    assert len(templates["component_templates"]) == 1
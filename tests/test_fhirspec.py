@@ -0,0 +1,413 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.fhirspec`."""
+import io
+import json
+import tracemalloc
+import zipfile
+from unittest import mock
+
+import pytest
+from click.testing import CliRunner
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.fhirspec import BundleReader
+from fhirpath_helpers.fhirspec import IndexedBundle
+from fhirpath_helpers.fhirspec import build_minified_json
+from fhirpath_helpers.fhirspec import build_static_archives
+from fhirpath_helpers.fhirspec import bundle_index_path
+from fhirpath_helpers.fhirspec import minify_bundle_file
+from fhirpath_helpers.fhirspec import minify_valuesets_entries
+from fhirpath_helpers.fhirspec import write_bundle
+from fhirpath_helpers.helpers import open_text
+
+
+def make_structure_definition(index):
+    """ """
+    return {
+        "fullUrl": f"http://hl7.org/fhir/StructureDefinition/Res{index}",
+        "resource": {
+            "resourceType": "StructureDefinition",
+            "id": f"Res{index}",
+            "url": f"http://hl7.org/fhir/StructureDefinition/Res{index}",
+            "name": f"Res{index}",
+            "text": {"status": "generated", "div": "<div>ü " + "x" * 200 + "</div>"},
+            "snapshot": {"element": [{"path": f"Res{index}.a", "max": "*"}] * 20},
+            "differential": {
+                "element": [{"path": f"Res{index}", "min": 0, "max": "1"}]
+            },
+            "version": 4.01,
+        },
+    }
+
+
+def make_valueset_entries(count):
+    """ """
+    for index in range(count):
+        yield {
+            "fullUrl": f"http://hl7.org/fhir/ValueSet/vs{index}",
+            "resource": {
+                "resourceType": "ValueSet",
+                "url": f"http://hl7.org/fhir/ValueSet/vs{index}",
+                "text": {"div": "<div/>"},
+                "compose": {"include": [{"system": "http://example.org/cs"}]},
+            },
+        }
+        yield {
+            "fullUrl": f"http://hl7.org/fhir/CodeSystem/cs{index}",
+            "resource": {
+                "resourceType": "CodeSystem",
+                "url": f"http://hl7.org/fhir/CodeSystem/cs{index}",
+                "text": {"div": "<div/>"},
+                "content": "complete",
+                "concept": [{"code": "a"}, {"code": "b"}],
+            },
+        }
+        yield {
+            "fullUrl": f"http://hl7.org/fhir/CodeSystem/empty{index}",
+            "resource": {
+                "resourceType": "CodeSystem",
+                "url": f"http://hl7.org/fhir/CodeSystem/empty{index}",
+            },
+        }
+        yield {"resource": {"resourceType": "ConceptMap", "id": f"cm{index}"}}
+
+
+def make_bundle(entries):
+    """ """
+    return {
+        "resourceType": "Bundle",
+        "id": "resources",
+        "meta": {"lastUpdated": "2019-11-01T09:29:23.356+11:00"},
+        "type": "collection",
+        "entry": list(entries),
+    }
+
+
+def legacy_minify(bundle_json, resource_types):
+    """Former in-memory implementation, used as reference output."""
+    new_bundle = dict(entry=list())
+    for entry in bundle_json["entry"]:
+        resource = entry["resource"].copy()
+        if resource["resourceType"] not in resource_types:
+            continue
+        if resource["resourceType"] == "CodeSystem" and (
+            "content" not in resource and "concept" not in resource
+        ):
+            continue
+        resource.pop("text", None)
+        resource.pop("snapshot", None)
+        new_bundle["entry"].append(
+            {"fullUrl": entry.get("fullUrl"), "resource": resource}
+        )
+    del bundle_json["entry"]
+    new_bundle.update(bundle_json)
+    return json.dumps(new_bundle, indent=2)
+
+
+@pytest.fixture
+def definitions_archive(tmp_path):
+    """ """
+    archive = tmp_path / "definitions.json.zip"
+    profiles = make_bundle(make_structure_definition(i) for i in range(30))
+    with zipfile.ZipFile(str(archive), "w") as zip_ref:
+        zip_ref.writestr(
+            "search-parameters.json",
+            json.dumps(make_bundle(make_valueset_entries(5)), indent=2),
+        )
+        zip_ref.writestr("profiles-types.json", json.dumps(profiles))
+        zip_ref.writestr("profiles-resources.json", json.dumps(profiles, indent=1))
+        zip_ref.writestr(
+            "valuesets.json", json.dumps(make_bundle(make_valueset_entries(10)))
+        )
+        zip_ref.writestr("version.info", "[FHIR]\nFhirVersion=4.0.1\n")
+    version_info = tmp_path / "version.info"
+    version_info.write_text("[FHIR]\nFhirVersion=4.0.1\n")
+    return archive, version_info
+
+
+def test_bundle_reader():
+    """ """
+    # members before and after entry, tiny chunks to cross every boundary
+    text = (
+        '{"resourceType" : "Bundle", "total": 12345, "entry" : [ {"a": [1, 2.5]},'
+        '\n {"b": "\\u00fc,]}"} ] , "type": "collection", "count": 67890}'
+    )
+    reader = BundleReader(io.StringIO(text))
+    reader.chunk_size = 3
+    assert list(reader.entries()) == [{"a": [1, 2.5]}, {"b": "ü,]}"}]
+    assert reader.bundle == {
+        "resourceType": "Bundle",
+        "total": 12345,
+        "type": "collection",
+        "count": 67890,
+    }
+
+    reader = BundleReader(io.StringIO('{"entry": [], "id": "x"}'))
+    assert list(reader.entries()) == []
+    assert reader.bundle == {"id": "x"}
+
+    with pytest.raises(ValueError):
+        list(BundleReader(io.StringIO('{"entry": [{"a": 1}')).entries())
+
+
+def test_write_bundle():
+    """ """
+    for entries in ([], [{"a": {"b": [1, "ü"]}}, {"c": None}]):
+        bundle = {"resourceType": "Bundle", "meta": {"tag": [{"code": "x"}]}}
+        fp = io.StringIO()
+        write_bundle(fp, iter(entries), bundle)
+        assert fp.getvalue() == json.dumps(dict(entry=entries, **bundle), indent=2)
+
+        fp = io.StringIO()
+        write_bundle(fp, iter(entries), bundle, output_format="compact")
+        assert fp.getvalue() == json.dumps(
+            dict(entry=entries, **bundle), separators=(",", ":")
+        )
+
+
+def test_build_minified_json(definitions_archive, tmp_path):
+    """Streaming output must be identical to the former in-memory output."""
+    archive, version_info = definitions_archive
+    destination = tmp_path / "R4" / "4.0.1"
+    build_minified_json(archive, version_info, destination, output_format="pretty")
+
+    with zipfile.ZipFile(str(archive)) as zip_ref:
+        for filename, resource_types in (
+            ("profiles-types", ("StructureDefinition",)),
+            ("profiles-resources", ("StructureDefinition",)),
+            ("valuesets", ("ValueSet", "CodeSystem")),
+        ):
+            expected = legacy_minify(
+                json.loads(zip_ref.read(filename + ".json")), resource_types
+            )
+            result = (destination / (filename + ".min.json")).read_text("utf-8")
+            assert result == expected
+    assert (destination / "search-parameters.json").exists()
+    assert (destination / "version.info").exists()
+
+
+def test_minify_bundle_file_memory(tmp_path):
+    """Peak memory must not grow with the size of the bundle."""
+    peaks = list()
+    for count in (200, 2000):
+        source = tmp_path / f"valuesets-{count}.json"
+        with open(str(source), "w", encoding="utf-8") as fp:
+            write_bundle(fp, make_valueset_entries(count), {"type": "collection"})
+        tracemalloc.start()
+        minify_bundle_file(
+            source, tmp_path / f"valuesets-{count}.min.json", minify_valuesets_entries
+        )
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < peaks[0] * 1.5
+    assert peaks[1] < source.stat().st_size / 4
+
+
+def test_build_minified_json_without_extracting(definitions_archive, tmp_path):
+    """Archive members are read in place, version.info may come from it."""
+    archive, _ = definitions_archive
+    destination = tmp_path / "output"
+    with mock.patch.object(zipfile.ZipFile, "extractall") as extractall:
+        build_minified_json(archive, None, destination)
+    assert extractall.called is False
+    assert (destination / "version.info").read_text() == (
+        "[FHIR]\nFhirVersion=4.0.1\n"
+    )
+    assert sorted(p.name for p in destination.iterdir()) == [
+        "profiles-resources.min.json",
+        "profiles-types.min.json",
+        "search-parameters.json",
+        "valuesets.min.json",
+        "version.info",
+    ]
+
+
+@pytest.mark.parametrize("compression", [None, "gz", "xz"])
+def test_build_minified_json_compact(definitions_archive, tmp_path, compression):
+    """ """
+    archive, version_info = definitions_archive
+    pretty_dir = tmp_path / "pretty"
+    compact_dir = tmp_path / "compact"
+    build_minified_json(archive, version_info, pretty_dir, output_format="pretty")
+    report = build_minified_json(
+        archive, version_info, compact_dir, compression=compression
+    )
+    suffix = compression and "." + compression or ""
+    assert [r[0] for r in report] == [
+        "search-parameters.json" + suffix,
+        "profiles-types.min.json" + suffix,
+        "profiles-resources.min.json" + suffix,
+        "valuesets.min.json" + suffix,
+    ]
+    for filename, source_size, size in report:
+        assert (compact_dir / filename).stat().st_size == size
+        assert size < source_size
+        with open_text(compact_dir / filename) as fp:
+            compact = json.load(fp)
+        with open_text(pretty_dir / filename[: len(filename) - len(suffix)]) as fp:
+            assert compact == json.load(fp)
+
+
+@pytest.mark.parametrize("output_format", ["compact", "pretty"])
+def test_indexed_bundle(definitions_archive, tmp_path, output_format):
+    """ """
+    archive, version_info = definitions_archive
+    destination = tmp_path / "indexed"
+    build_minified_json(
+        archive, version_info, destination, output_format=output_format, index=True
+    )
+    assert sorted(p.name for p in destination.glob("*.index.json")) == [
+        "profiles-resources.min.json.index.json",
+        "profiles-types.min.json.index.json",
+        "valuesets.min.json.index.json",
+    ]
+    valuesets = json.loads((destination / "valuesets.min.json").read_text("utf-8"))
+    with IndexedBundle(destination / "valuesets.min.json") as bundle:
+        assert len(bundle) == len(valuesets["entry"]) == 20
+        assert list(bundle.resources()) == [e["resource"] for e in valuesets["entry"]]
+        assert len(list(bundle.resources("CodeSystem"))) == 10
+        url = "http://hl7.org/fhir/CodeSystem/cs3"
+        assert url in bundle
+        assert bundle.get(url)["concept"] == [{"code": "a"}, {"code": "b"}]
+        assert bundle.get(url + "|4.0.1")["url"] == url
+        assert bundle.get(url, "ValueSet") is None
+        assert bundle.get("http://hl7.org/fhir/CodeSystem/empty3") is None
+
+    with IndexedBundle(destination / "profiles-resources.min.json") as bundle:
+        resource = bundle.get_by_id("StructureDefinition", "Res7")
+        assert resource["url"] == "http://hl7.org/fhir/StructureDefinition/Res7"
+        assert "snapshot" not in resource
+        assert bundle.get_by_id("StructureDefinition", "Res99") is None
+
+    # the index is tied to its bundle file
+    path_ = destination / "profiles-types.min.json"
+    path_.write_text(path_.read_text() + " ")
+    with pytest.raises(ValueError):
+        IndexedBundle(path_)
+
+    with pytest.raises(ValueError):
+        build_minified_json(
+            archive, version_info, tmp_path / "gz", compression="gz", index=True
+        )
+
+
+def test_write_bundle_index_offsets():
+    """Offsets are bytes offsets, whatever the (escaped) non ASCII text."""
+    entries = [
+        {"resource": {"resourceType": "ValueSet", "id": "ü", "url": "u1"}},
+        {"resource": {"resourceType": "CodeSystem", "id": "b", "url": "ü2"}},
+    ]
+    fp = io.StringIO()
+    records = list()
+    write_bundle(fp, iter(entries), {"type": "collection"}, index=records)
+    data = fp.getvalue().encode("utf-8")
+    for entry, record in zip(entries, records):
+        assert json.loads(data[record[3] : record[3] + record[4]]) == entry
+    assert [r[:3] for r in records] == [
+        ["ValueSet", "ü", "u1"],
+        ["CodeSystem", "b", "ü2"],
+    ]
+
+
+def test_build_static_archives(definitions_archive, tmp_path):
+    """ """
+    archive, version_info = definitions_archive
+    tasks = [
+        dict(
+            archive_file=archive,
+            version_info=version_info,
+            version=version,
+            destination=tmp_path / "static" / release / f"{version}.zip",
+        )
+        for release, version in (("R4", "4.0.0"), ("R4", "4.0.1"))
+    ]
+    results = list(build_static_archives(tasks, jobs=2))
+    assert [task for task, _ in results] == tasks
+    # nothing is written to a temporary directory
+    with mock.patch("tempfile.mkdtemp", side_effect=AssertionError):
+        list(build_static_archives(tasks[:1]))
+
+    build_minified_json(archive, version_info, tmp_path / "minified")
+    static_archive = cli.STATIC_SPEC_DIR / "R4" / "4.0.1.zip"
+    with zipfile.ZipFile(str(static_archive)) as zip_ref:
+        expected_names = [info.filename for info in zip_ref.infolist()]
+    for task, report in results:
+        with zipfile.ZipFile(str(task["destination"])) as zip_ref:
+            names = [info.filename for info in zip_ref.infolist()]
+            assert names == [
+                name.replace("4.0.1", task["version"]) for name in expected_names
+            ]
+            for filename in (tmp_path / "minified").iterdir():
+                assert (
+                    zip_ref.read(f"{task['version']}/{filename.name}")
+                    == filename.read_bytes()
+                )
+        assert len(report) == 4
+
+    # reproducible archives
+    first = tasks[0]["destination"].read_bytes()
+    list(build_static_archives(tasks[:1]))
+    assert tasks[0]["destination"].read_bytes() == first
+
+
+def test_cli_batch_build(definitions_archive, tmp_path, monkeypatch):
+    """ """
+    archive, version_info = definitions_archive
+    fetched = list()
+
+    def fetch_all(urls, *args, **kwargs):
+        fetched.extend(urls)
+        return [version_info, archive] * (len(urls) // 2)
+
+    monkeypatch.setattr(cli, "fetch_all", fetch_all)
+    matrix = tmp_path / "matrix.txt"
+    matrix.write_text("# release version\nSTU3 3.0.2\n\nR4 4.0.1  # latest\n")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        [
+            "fhirspec-build-minified-static-json",
+            "--matrix",
+            str(matrix),
+            "-o",
+            str(tmp_path / "out"),
+            "-j",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert len(fetched) == 4
+    assert (tmp_path / "out" / "STU3" / "3.0.2.zip").exists()
+    assert (tmp_path / "out" / "R4" / "4.0.1.zip").exists()
+
+    result = runner.invoke(
+        cli.main,
+        ["fhirspec-build-minified-static-json", "--all", "-r", "R4"],
+    )
+    assert result.exit_code == 2
+    result = runner.invoke(
+        cli.main, ["fhirspec-build-minified-static-json", "--all", "--index"]
+    )
+    assert result.exit_code == 2
+
+    result = runner.invoke(
+        cli.main,
+        [
+            "fhirspec-build-minified-static-json",
+            "-r",
+            "R4",
+            "-v",
+            "4.0.1",
+            "-o",
+            str(tmp_path / "single"),
+            "--index",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    valuesets = tmp_path / "single" / "R4" / "4.0.1" / "valuesets.min.json"
+    assert bundle_index_path(valuesets).exists()
+    matrix.write_text("R4\n")
+    result = runner.invoke(
+        cli.main, ["fhirspec-build-minified-static-json", "--matrix", str(matrix)]
+    )
+    assert result.exit_code == 2
@@ -0,0 +1,199 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.helpers`."""
+import gzip
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+
+import pytest
+import requests
+
+from fhirpath_helpers.helpers import download
+from fhirpath_helpers.helpers import download_dir
+from fhirpath_helpers.helpers import download_file
+
+CONTENT = os.urandom(256 * 1024 + 123)
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves ``CONTENT`` with Range support; a path may ask for failures:
+    ``/drop`` cuts the first transfer half way, ``/busy`` answers 503 first,
+    ``/norange`` ignores Range headers, ``/gzip`` serves the content gzip
+    encoded whatever the ``Accept-Encoding`` (Range on the encoded bytes) and
+    cuts the first transfer half way, ``/badrange`` answers any Range request
+    with the whole content (as a 206)."""
+
+    requests_log = list()
+
+    def log_message(self, *args):
+        """ """
+
+    def do_GET(self):
+        """ """
+        self.requests_log.append((self.path, self.headers.get("Range")))
+        attempts = sum(1 for path, _ in self.requests_log if path == self.path)
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        if self.path == "/busy" and attempts == 1:
+            self.send_error(503)
+            return
+
+        start = 0
+        range_ = self.headers.get("Range")
+        if range_ and self.path != "/norange":
+            start = int(range_.split("=")[1].split("-")[0])
+            self.send_response(206)
+            if self.path == "/badrange":
+                start = 0
+                self.send_header(
+                    "Content-Range", f"bytes 0-{len(CONTENT) - 1}/{len(CONTENT)}"
+                )
+        else:
+            self.send_response(200)
+        content = CONTENT
+        if self.path == "/gzip":
+            content = gzip.compress(CONTENT)
+            self.send_header("Content-Encoding", "gzip")
+        if start:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        body = content[start:]
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.path in ("/drop", "/norange", "/gzip") and attempts == 1:
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    """Local HTTP stand-in server."""
+    StandInHandler.requests_log = list()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_file(server, tmp_path):
+    """ """
+    path_, digest = download_file(server + "/spec.zip", tmp_path, progress=False)
+    assert path_ == tmp_path / "spec.zip"
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert not (tmp_path / "spec.zip.part").exists()
+
+
+def test_download_file_resume(server, tmp_path):
+    """An interrupted transfer is resumed with a Range request."""
+    path_, digest = download_file(
+        server + "/drop", tmp_path / "spec.zip", backoff=0, progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    log = StandInHandler.requests_log
+    assert len(log) == 2
+    assert log[0][1] is None
+    # resumed from what had been received (in whole chunks)
+    offset = int(log[1][1][len("bytes=") : -1])
+    assert 0 < offset <= len(CONTENT) // 2
+
+
+def test_download_file_resume_partial_from_previous_run(server, tmp_path):
+    """ """
+    (tmp_path / "spec.zip.part").write_bytes(CONTENT[:1000])
+    path_, digest = download_file(
+        server + "/spec.zip", tmp_path / "spec.zip", progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert StandInHandler.requests_log == [("/spec.zip", "bytes=1000-")]
+
+
+def test_download_file_unexpected_range(server, tmp_path):
+    """A range other than the requested one isn't appended."""
+    (tmp_path / "spec.zip.part").write_bytes(CONTENT[:1000])
+    path_, digest = download_file(
+        server + "/badrange", tmp_path / "spec.zip", progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert StandInHandler.requests_log == [
+        ("/badrange", "bytes=1000-"),
+        ("/badrange", None),
+    ]
+
+
+def test_download_file_without_range_support(server, tmp_path):
+    """ """
+    path_, digest = download_file(
+        server + "/norange", tmp_path / "spec.zip", backoff=0, progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_download_file_retry_and_errors(server, tmp_path):
+    """ """
+    path_, _ = download_file(
+        server + "/busy", tmp_path / "spec.zip", backoff=0, progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        download_file(server + "/missing", tmp_path / "missing", progress=False)
+    assert download(server + "/missing", tmp_path, progress=False) is None
+
+    with pytest.raises(ValueError):
+        download_file(
+            server + "/spec.zip",
+            tmp_path / "other.zip",
+            expected_sha256="0" * 64,
+            progress=False,
+        )
+    assert not (tmp_path / "other.zip").exists()
+    assert not (tmp_path / "other.zip.part").exists()
+
+
+def test_download_file_encoded(server, tmp_path):
+    """An encoded content isn't resumed at the offset of the decoded one."""
+    path_, digest = download_file(
+        server + "/gzip", tmp_path / "spec.zip", backoff=0, progress=False
+    )
+    assert path_.read_bytes() == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    assert [range_ for _, range_ in StandInHandler.requests_log][-1] is None
+
+
+def test_download(server, tmp_path, monkeypatch):
+    """ """
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    path_ = download(
+        server + "/spec.zip",
+        expected_sha256=hashlib.sha256(CONTENT).hexdigest(),
+        progress=False,
+    )
+    assert path_.name == "spec.zip"
+    assert path_.read_bytes() == CONTENT
+    assert path_.parent == download_dir(server + "/spec.zip")
+    assert path_.parent.parent.parent == tmp_path
+
+
+def test_download_resume_previous_run(server, tmp_path, monkeypatch):
+    """The partial download of a previous run is resumed."""
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    url = server + "/spec.zip"
+    (download_dir(url) / "spec.zip.part").write_bytes(CONTENT[:1000])
+    path_ = download(url, progress=False)
+    assert path_.read_bytes() == CONTENT
+    assert StandInHandler.requests_log == [("/spec.zip", "bytes=1000-")]
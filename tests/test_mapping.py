@@ -0,0 +1,382 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.mapping`."""
+import json
+import logging
+import pathlib
+
+import pytest
+from fhirpath.enums import FHIR_VERSION
+from fhirpath.fhirspec import FhirSpecFactory
+
+from fhirpath_helpers.elasticsearch import mapping as mapping_module
+from fhirpath_helpers.elasticsearch import cache as cache_module
+from fhirpath_helpers.elasticsearch.cache import cache_stats
+from fhirpath_helpers.elasticsearch.cache import clear_cache
+from fhirpath_helpers.elasticsearch.cache import generator_source_hash
+from fhirpath_helpers.elasticsearch.mapping import build_elements_paths
+from fhirpath_helpers.elasticsearch.mapping import build_elements_tree
+from fhirpath_helpers.elasticsearch.mapping import create_resource_mapping
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings
+from fhirpath_helpers.elasticsearch.mapping import ignored_datatype
+from fhirpath_helpers.elasticsearch.mapping import make_and_write_es_mappings
+from fhirpath_helpers.elasticsearch.mapping import write_resource_mapping
+from fhirpath_helpers.elasticsearch.pytypes import fhir_types_mapping
+from fhirpath_helpers.fhirspec import fhir_spec_from_release
+from fhirpath_helpers.helpers import open_text
+
+
+def legacy_create_resource_mapping(elements_paths_def, fhir_es_mappings):
+    """The former quadratic implementation, only fixed to match children on
+    path segment boundaries. Used as reference for the tree based one."""
+    mapped = dict()
+
+    def iterate_elements():
+        mapped_elements = list()
+        for path, code, multiple in elements_paths_def:
+            if path not in mapped_elements:
+                children = [
+                    x for x in elements_paths_def if x[0].startswith(path + ".")
+                ]
+                mapped_elements.extend([path, *[c[0] for c in children]])
+                yield path, code, multiple, children
+
+    for path, code, multiple, children in iterate_elements():
+        name = path.split(".")[-1]
+        try:
+            map_ = fhir_es_mappings[code].copy()
+        except KeyError:
+            if code == "BackboneElement":
+                map_ = {
+                    "type": "nested",
+                    "properties": legacy_create_resource_mapping(
+                        children, fhir_es_mappings
+                    ),
+                }
+            elif code in ignored_datatype:
+                continue
+            else:
+                raise
+
+        if multiple and "type" not in map_:
+            map_.update({"type": "nested"})
+
+        mapped[name] = map_
+
+    mapped["resourceType"] = fhir_es_mappings["code"].copy()
+    return mapped
+
+
+@pytest.fixture(scope="module")
+def r4_elements_paths():
+    """ """
+    logging.getLogger("fhirspec").setLevel(logging.CRITICAL)
+    fhir_spec = FhirSpecFactory.from_release(FHIR_VERSION.R4.name)
+    resources_elements = dict()
+    for definition_klass in fhir_spec.profiles.values():
+        if definition_klass.name in ("Resource", "DomainResource") or (
+            definition_klass.structure.subclass_of == "DomainResource"
+        ):
+            resources_elements[definition_klass.name] = definition_klass.elements
+    return build_elements_paths(resources_elements)
+
+
+def test_build_elements_tree():
+    """ """
+    paths = [
+        ("Patient.name", "HumanName", True),
+        ("Patient.nameX", "string", False),
+        ("Patient.contact", "BackboneElement", True),
+        ("Patient.contact.name", "HumanName", False),
+    ]
+    tree = build_elements_tree(paths)
+    assert list(tree) == ["Patient"]
+    definition, children = tree["Patient"]
+    assert definition is None
+    assert list(children) == ["name", "nameX", "contact"]
+    assert children["name"] == [paths[0], {}]
+    assert children["contact"][1]["name"][0] == paths[3]
+
+
+def test_create_resource_mapping_segment_boundaries():
+    """A sibling sharing a string prefix must not be taken as a child."""
+    fhir_es_mappings = fhir_types_mapping(FHIR_VERSION.R4.name)
+    paths = [
+        ("Patient.name", "BackboneElement", True),
+        ("Patient.name.text", "string", False),
+        ("Patient.nameX", "string", False),
+    ]
+    mapped = create_resource_mapping(paths, fhir_es_mappings)
+    assert list(mapped) == ["name", "nameX", "resourceType"]
+    assert list(mapped["name"]["properties"]) == ["text", "resourceType"]
+    assert mapped["nameX"] == fhir_es_mappings["string"]
+
+
+def test_create_resource_mapping_r4_regression(r4_elements_paths):
+    """ """
+    fhir_es_mappings = fhir_types_mapping(FHIR_VERSION.R4.name)
+    for resource, paths_def in r4_elements_paths.items():
+        expected = legacy_create_resource_mapping(paths_def, fhir_es_mappings)
+        result = create_resource_mapping(paths_def, fhir_es_mappings)
+        # compare serialized form to make sure the keys order is kept as well
+        assert json.dumps(result) == json.dumps(expected), resource
+
+
+def test_generate_mappings_jobs():
+    """Parallel generation must produce exactly the serial output."""
+    serial = generate_mappings(FHIR_VERSION.R4.name)
+    parallel = generate_mappings(FHIR_VERSION.R4.name, jobs=2)
+    assert json.dumps(parallel) == json.dumps(serial)
+
+
+def test_make_and_write_es_mappings_jobs(tmp_path):
+    """ """
+    serial_dir = tmp_path / "serial"
+    parallel_dir = tmp_path / "parallel"
+    for output_dir, jobs in ((serial_dir, 1), (parallel_dir, 3)):
+        output_dir.mkdir()
+        make_and_write_es_mappings(output_dir, FHIR_VERSION.R4.name, jobs=jobs)
+
+    serial_files = sorted(p.name for p in serial_dir.iterdir())
+    assert serial_files == sorted(p.name for p in parallel_dir.iterdir())
+    for filename in serial_files:
+        serial = json.loads((serial_dir / filename).read_text())
+        parallel = json.loads((parallel_dir / filename).read_text())
+        del serial["meta"]["lastUpdated"], parallel["meta"]["lastUpdated"]
+        assert serial == parallel
+
+
+def test_make_and_write_es_mappings_cache(tmp_path, monkeypatch):
+    """A warm run copies the cached files out without loading the spec."""
+    cache_dir = tmp_path / "cache"
+    cold_dir = tmp_path / "cold"
+    warm_dir = tmp_path / "warm"
+    cold_dir.mkdir()
+    warm_dir.mkdir()
+    make_and_write_es_mappings(cold_dir, FHIR_VERSION.R4.name, cache_dir=cache_dir)
+    assert cache_stats(cache_dir)["entries"] == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("spec should not be loaded on a warm run")
+
+    monkeypatch.setattr(mapping_module, "load_elements_paths", fail)
+    paths = make_and_write_es_mappings(
+        warm_dir, FHIR_VERSION.R4.name, cache_dir=cache_dir
+    )
+    assert len(paths) == len(list(cold_dir.iterdir()))
+    for path_ in cold_dir.iterdir():
+        assert path_.read_bytes() == (warm_dir / path_.name).read_bytes()
+
+    # a different token normalizer is another cache entry
+    with pytest.raises(AssertionError):
+        make_and_write_es_mappings(
+            warm_dir,
+            FHIR_VERSION.R4.name,
+            token_normalizer="lower",
+            cache_dir=cache_dir,
+        )
+    clear_cache(cache_dir)
+    assert cache_stats(cache_dir)["entries"] == 0
+
+
+def test_generator_source_hash(monkeypatch):
+    """The cache key covers the modules and the fhirpath version the mappings
+    depend on."""
+    import fhirpath
+
+    hashed = list()
+    hash_files = cache_module.hash_files
+    monkeypatch.setattr(
+        cache_module,
+        "hash_files",
+        lambda files: hash_files(hashed.extend(files) or files),
+    )
+    first = generator_source_hash()
+    assert {"analysis.py", "fhirspec.py", "settings.py"} <= {p.name for p in hashed}
+    monkeypatch.setattr(fhirpath, "__version__", "0.0.0")
+    assert generator_source_hash() != first
+
+
+@pytest.mark.parametrize("output_mode", ["files", "bundle"])
+def test_cached_mappings_last_updated(tmp_path, output_mode):
+    """A changed mapping served from the cache gets a new lastUpdated, not the
+    one of the cache entry."""
+    cache_dir = tmp_path / "cache"
+    output_dir = tmp_path / "mappings"
+    output_dir.mkdir()
+    kwargs = dict(resources=["Patient"], cache_dir=cache_dir, output_mode=output_mode)
+    (path_,) = map(
+        pathlib.Path,
+        make_and_write_es_mappings(output_dir, FHIR_VERSION.R4.name, **kwargs),
+    )
+    data = json.loads(path_.read_text())
+    document = data if output_mode == "files" else data["Patient"]
+    cached = document["meta"]["lastUpdated"]
+    # an older mapping, updated after the cache entry has been created
+    document["meta"].update(contentHash="outdated", lastUpdated="9999")
+    path_.write_text(json.dumps(data))
+
+    make_and_write_es_mappings(output_dir, FHIR_VERSION.R4.name, **kwargs)
+    data = json.loads(path_.read_text())
+    document = data if output_mode == "files" else data["Patient"]
+    assert cached < document["meta"]["lastUpdated"] < "9999"
+
+
+def test_generate_mappings_selected_resources():
+    """ """
+    resources = ["Patient", "Observation", "Encounter"]
+    selected = generate_mappings(FHIR_VERSION.R4.name, resources=resources)
+    assert sorted(selected) == sorted(resources)
+    full = generate_mappings(FHIR_VERSION.R4.name)
+    for resource in resources:
+        assert json.dumps(selected[resource]) == json.dumps(full[resource])
+
+    with pytest.raises(ValueError):
+        generate_mappings(FHIR_VERSION.R4.name, resources=["Patient", "Unknown"])
+
+
+def test_selective_fhir_spec():
+    """Unused resources definitions must not be parsed."""
+    spec = fhir_spec_from_release(FHIR_VERSION.R4.name, resources=["Patient"])
+    assert "patient" in spec.profiles
+    assert "domainresource" in spec.profiles
+    assert "observation" not in spec.profiles
+    # datatypes are still available
+    assert "humanname" in spec.profiles
+
+
+def test_write_resource_mapping_formats(tmp_path):
+    """ """
+    mappings = {"active": {"type": "boolean"}}
+    pretty = write_resource_mapping(
+        tmp_path, "Patient", mappings, FHIR_VERSION.R4.name, verbose=False
+    )
+    compact = write_resource_mapping(
+        tmp_path,
+        "Patient",
+        mappings,
+        FHIR_VERSION.R4.name,
+        verbose=False,
+        output_format="compact",
+        compression="gz",
+    )
+    assert pretty.endswith("Patient.mapping.json")
+    assert compact.endswith("Patient.mapping.json.gz")
+    with open_text(pathlib.Path(compact)) as fp:
+        text = fp.read()
+    assert " " not in text
+    assert json.loads(text)["mapping"]["properties"] == mappings
+
+
+@pytest.mark.parametrize("compression", [None, "gz"])
+def test_write_resource_mapping_incremental(tmp_path, compression):
+    """Unchanged mappings are not rewritten and keep their lastUpdated."""
+    mappings = {"active": {"type": "boolean"}}
+    path_ = pathlib.Path(
+        write_resource_mapping(
+            tmp_path,
+            "Patient",
+            mappings,
+            FHIR_VERSION.R4.name,
+            verbose=False,
+            compression=compression,
+        )
+    )
+    with open_text(path_) as fp:
+        first = json.load(fp)
+    content = path_.read_bytes()
+    mtime = path_.stat().st_mtime_ns
+
+    write_resource_mapping(
+        tmp_path,
+        "Patient",
+        mappings,
+        FHIR_VERSION.R4.name,
+        verbose=False,
+        compression=compression,
+    )
+    assert path_.read_bytes() == content
+    assert path_.stat().st_mtime_ns == mtime
+
+    mappings["gender"] = {"type": "keyword"}
+    write_resource_mapping(
+        tmp_path,
+        "Patient",
+        mappings,
+        FHIR_VERSION.R4.name,
+        verbose=False,
+        compression=compression,
+    )
+    with open_text(path_) as fp:
+        second = json.load(fp)
+    assert second["meta"]["contentHash"] != first["meta"]["contentHash"]
+    assert second["meta"]["lastUpdated"] > first["meta"]["lastUpdated"]
+    assert second["mapping"]["properties"] == mappings
+    assert [p.name for p in tmp_path.iterdir()] == [path_.name]
+
+
+def test_make_and_write_es_mappings_incremental(tmp_path, capsys):
+    """ """
+    output_dir = tmp_path / "mappings"
+    output_dir.mkdir()
+    resources = ["Patient", "Observation"]
+    for cache_dir in (None, tmp_path / "cache", tmp_path / "cache"):
+        make_and_write_es_mappings(
+            output_dir, FHIR_VERSION.R4.name, resources=resources, cache_dir=cache_dir
+        )
+    first = capsys.readouterr().out
+    assert "2 added, 0 changed, 0 unchanged" in first
+    assert first.count("0 added, 0 changed, 2 unchanged") == 2
+
+    patient = output_dir / "Patient.mapping.json"
+    data = json.loads(patient.read_text())
+    data["mapping"]["properties"].pop("gender")
+    patient.write_text(json.dumps(data))
+    make_and_write_es_mappings(
+        output_dir,
+        FHIR_VERSION.R4.name,
+        resources=resources,
+        cache_dir=tmp_path / "cache",
+    )
+    assert "0 added, 1 changed, 1 unchanged" in capsys.readouterr().out
+
+
+def test_create_resource_mapping_copy_on_write(r4_elements_paths):
+    """Mappings built from the registry are the same as from plain dicts but
+    share the untouched templates (read only) instead of copying them."""
+    import tracemalloc
+
+    from fhirpath_helpers.elasticsearch.pytypes import types_mapping_registry
+
+    registry = types_mapping_registry(FHIR_VERSION.R4.name)
+    plain = fhir_types_mapping(FHIR_VERSION.R4.name)
+
+    tracemalloc.start()
+    try:
+        legacy = {
+            resource: legacy_create_resource_mapping(paths_def, plain)
+            for resource, paths_def in r4_elements_paths.items()
+        }
+        legacy_size = tracemalloc.get_traced_memory()[0]
+        del legacy
+        start = tracemalloc.get_traced_memory()[0]
+        mapped = {
+            resource: create_resource_mapping(paths_def, registry)
+            for resource, paths_def in r4_elements_paths.items()
+        }
+        size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    assert size < legacy_size
+
+    patient = mapped["Patient"]
+    assert json.dumps(patient) == json.dumps(
+        create_resource_mapping(r4_elements_paths["Patient"], plain)
+    )
+    assert patient["gender"] is registry["code"]
+    with pytest.raises(TypeError):
+        patient["gender"]["type"] = "text"
+    # multiple values: a new node, the template is untouched
+    assert patient["identifier"]["type"] == "nested"
+    assert type(patient["identifier"]) is dict
+    assert "type" not in registry["Identifier"]
+    assert patient["identifier"]["properties"] is registry["Identifier"]["properties"]
@@ -0,0 +1,131 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.multivalue`."""
+import json
+
+import pytest
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings
+from fhirpath_helpers.elasticsearch.multivalue import apply_inner_strategies
+from fhirpath_helpers.elasticsearch.multivalue import load_multi_value_policy
+from fhirpath_helpers.elasticsearch.multivalue import resolve_strategy
+from fhirpath_helpers.elasticsearch.multivalue import with_strategy
+from fhirpath_helpers.elasticsearch.pytypes import types_mapping_registry
+
+
+def nested_paths(properties, prefix=""):
+    """ """
+    for name, field in properties.items():
+        if field.get("type") == "nested":
+            yield prefix + name
+        if "properties" in field:
+            yield from nested_paths(field["properties"], prefix + name + ".")
+
+
+def test_resolve_strategy():
+    """ """
+    policy = {
+        "default": "object",
+        "datatypes": {"Identifier": "nested", "HumanName": "flattened"},
+        "paths": {"*.name": "object", "Patient.name": "nested"},
+    }
+    # exact path first, then patterns, then datatypes
+    assert resolve_strategy(policy, "Patient.name", "HumanName") == "nested"
+    assert resolve_strategy(policy, "Practitioner.name", "HumanName") == "object"
+    assert resolve_strategy(policy, "Patient.contact.name", "HumanName") == "object"
+    assert resolve_strategy(policy, "Patient.identifier", "Identifier") == "nested"
+    assert resolve_strategy(policy, "Patient.address", "Address") == "object"
+
+
+def test_with_strategy():
+    """ """
+    template = {"properties": {"code": {"type": "keyword"}}}
+    nested = with_strategy(template, "nested")
+    assert nested == {"type": "nested", "properties": template["properties"]}
+    assert with_strategy(nested, "nested") is nested
+    assert with_strategy(template, "object") is template
+    assert with_strategy(
+        {**nested, "include_in_root": True}, "object"
+    ) == template
+    assert with_strategy(nested, "flattened") == {"type": "flattened"}
+
+
+def test_apply_inner_strategies():
+    """ """
+    registry = types_mapping_registry(FHIR_VERSION.R4.name)
+    policy = load_multi_value_policy("nested")
+    policy["paths"] = {"Patient.maritalStatus.coding": "object"}
+    concept = registry["CodeableConcept"]
+    mapped = apply_inner_strategies(concept, "Patient.maritalStatus", policy)
+    assert "type" not in mapped["properties"]["coding"]
+    # copy on write: the registry template is untouched and shared otherwise
+    assert concept["properties"]["coding"]["type"] == "nested"
+    assert mapped["properties"]["text"] is concept["properties"]["text"]
+    assert apply_inner_strategies(concept, "Patient.code", policy) is concept
+
+
+def test_load_multi_value_policy(tmp_path):
+    """ """
+    policy_file = tmp_path / "policy.json"
+    policy_file.write_text(
+        json.dumps(
+            {
+                "extends": "performance",
+                "datatypes": {"HumanName": "flattened"},
+                "paths": {"Observation.component": "object"},
+            }
+        )
+    )
+    policy = load_multi_value_policy(str(policy_file))
+    assert policy["default"] == "object"
+    assert policy["datatypes"]["HumanName"] == "flattened"
+    assert policy["datatypes"]["Identifier"] == "nested"
+    assert policy["paths"]["Observation.component"] == "object"
+
+    policy_file.write_text(json.dumps({"default": "hidden"}))
+    with pytest.raises(ValueError):
+        load_multi_value_policy(str(policy_file))
+
+
+def test_generate_mappings_multi_value():
+    """ """
+    release = FHIR_VERSION.R4.name
+    resources = ["Patient", "Observation"]
+    default = generate_mappings(release, resources=resources)
+    assert default == generate_mappings(
+        release, resources=resources, multi_value=load_multi_value_policy("nested")
+    )
+    performance = generate_mappings(
+        release,
+        resources=resources,
+        multi_value=load_multi_value_policy("performance"),
+        jobs=2,
+    )
+    patient = set(nested_paths(performance["Patient"]))
+    assert {"identifier", "telecom", "meta.tag", "maritalStatus.coding"} <= patient
+    assert "name" not in patient and "address" not in patient
+    assert "name" in set(nested_paths(default["Patient"]))
+    assert "component" in set(nested_paths(performance["Observation"]))
+    assert len(patient) < len(set(nested_paths(default["Patient"])))
+
+
+def test_backbone_element_datatype_rule():
+    """A datatype rule of a BackboneElement child isn't overridden by the path
+    rules (or default) applied inside the BackboneElement."""
+    policy = load_multi_value_policy("performance")
+    mappings = generate_mappings(
+        FHIR_VERSION.R4.name,
+        resources=["Practitioner", "Specimen"],
+        multi_value=policy,
+    )
+    assert "qualification.identifier" in set(nested_paths(mappings["Practitioner"]))
+    assert "container.identifier" in set(nested_paths(mappings["Specimen"]))
+
+    # a path rule still wins over the datatype rule
+    policy["paths"]["Practitioner.qualification.identifier"] = "object"
+    mappings = generate_mappings(
+        FHIR_VERSION.R4.name, resources=["Practitioner"], multi_value=policy
+    )
+    practitioner = set(nested_paths(mappings["Practitioner"]))
+    assert "qualification.identifier" not in practitioner
+    assert "identifier" in practitioner
@@ -0,0 +1,144 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.profiling`."""
+import json
+import pstats
+import sys
+import time
+
+from click.testing import CliRunner
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.profiling import add_phase_hook
+from fhirpath_helpers.profiling import phase
+from fhirpath_helpers.profiling import recording
+from fhirpath_helpers.profiling import remove_phase_hook
+
+
+def test_phase_hooks():
+    """ """
+    calls = list()
+
+    def hook(name, metrics):
+        calls.append((name, metrics))
+
+    with phase("ignored"):
+        pass
+    add_phase_hook(hook)
+    try:
+        with phase("outer"):
+            with phase("inner"):
+                time.sleep(0.01)
+    finally:
+        remove_phase_hook(hook)
+    with phase("ignored"):
+        pass
+
+    assert [name for name, _ in calls] == ["outer/inner", "outer"]
+    for _, metrics in calls:
+        assert metrics["wall"] >= 0.01
+        assert set(metrics) >= {
+            "wall",
+            "cpu",
+            "children_cpu",
+            "peak_rss_kb",
+            "read_bytes",
+            "written_bytes",
+        }
+
+
+def test_recording(tmp_path):
+    """ """
+    with recording() as recorder:
+        for _ in range(3):
+            with phase("write"):
+                (tmp_path / "data").write_bytes(b"x" * 100000)
+    with phase("write"):
+        pass
+    report = recorder.report(command="test")
+    assert report["command"] == "test"
+    (write,) = report["phases"]
+    assert write["name"] == "write"
+    assert write["calls"] == 3
+    if sys.platform.startswith("linux"):
+        assert write["written_bytes"] >= 300000
+    assert report["total"]["wall"] >= write["wall"]
+
+
+def test_cli_profile(tmp_path):
+    """ """
+    report_file = tmp_path / "report.json"
+    stats_file = tmp_path / "stats.prof"
+    output_dir = tmp_path / "mappings"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        [
+            "es-generate-mapping",
+            "--no-cache",
+            "-r",
+            "Patient",
+            "--profile",
+            str(report_file),
+            "--profile-stats",
+            str(stats_file),
+            str(output_dir),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    report = json.loads(report_file.read_text())
+    assert report["command"] == "es-generate-mapping"
+    names = [p["name"] for p in report["phases"]]
+    assert names == [
+        "spec_load",
+        "path_extraction",
+        "mappings/construction",
+        "mappings/write",
+        "mappings",
+    ]
+    assert pstats.Stats(str(stats_file)).total_calls > 0
+
+
+def test_cli_profile_jobs(tmp_path):
+    """The phases of the worker processes are merged into the report."""
+    report_file = tmp_path / "report.json"
+    result = CliRunner().invoke(
+        cli.main,
+        [
+            "es-generate-mapping",
+            "--no-cache",
+            "-r",
+            "Patient",
+            "-r",
+            "Observation",
+            "-j",
+            "2",
+            "--profile",
+            str(report_file),
+            str(tmp_path / "mappings"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    phases = {p["name"]: p for p in json.loads(report_file.read_text())["phases"]}
+    assert phases["mappings/construction"]["calls"] == 2
+    assert phases["mappings/write"]["calls"] == 2
+    assert phases["mappings/construction"]["cpu"] > 0
+    assert phases["mappings"]["calls"] == 1
+
+
+def test_cli_profile_stats_only(tmp_path):
+    """ """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        [
+            "es-generate-mapping",
+            "--no-cache",
+            "-r",
+            "Patient",
+            "--profile-stats",
+            str(tmp_path / "stats.prof"),
+            str(tmp_path / "mappings"),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["mappings", "stats.prof"]
@@ -0,0 +1,172 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.projection`."""
+import json
+
+import pytest
+from click.testing import CliRunner
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings
+from fhirpath_helpers.elasticsearch.mapping import make_and_write_es_mappings
+from fhirpath_helpers.elasticsearch.projection import compile_projector
+from fhirpath_helpers.elasticsearch.projection import load_mappings
+from fhirpath_helpers.elasticsearch.projection import project_ndjson
+from fhirpath_helpers.helpers import open_text
+
+PATIENT = {
+    "resourceType": "Patient",
+    "id": "p1",
+    "meta": {"lastUpdated": "2020-01-01T00:00:00Z", "extension": [{"url": "x"}]},
+    "extension": [{"url": "http://example.org/x", "valueString": "y"}],
+    "name": [
+        {"family": "Doe", "given": ["John"], "_family": {"extension": []}},
+        {"extension": [{"url": "http://example.org/x"}]},
+    ],
+    "birthDate": "1970-01-01",
+    "_birthDate": {"extension": [{"url": "http://example.org/x"}]},
+    "deceasedBoolean": False,
+    "contained": [{"resourceType": "Organization", "id": "o1"}],
+}
+OBSERVATION = {
+    "resourceType": "Observation",
+    "id": "o1",
+    "status": "final",
+    "code": {"coding": [{"system": "http://loinc.org", "code": "1234-5"}]},
+    "valueQuantity": {"value": 1.5, "unit": "mg"},
+    "component": [{"code": {"text": "c"}, "valueString": "v", "extension": []}],
+}
+
+
+@pytest.fixture(scope="module")
+def mappings():
+    """ """
+    return generate_mappings(
+        FHIR_VERSION.R4.name, resources=["Patient", "Observation"]
+    )
+
+
+def test_compile_projector():
+    """ """
+    project = compile_projector(
+        {
+            "id": {"type": "keyword"},
+            "name": {
+                "type": "nested",
+                "properties": {"family": {"type": "keyword"}},
+            },
+            "valueString": {"type": "keyword"},
+            "data": {"type": "object", "enabled": False},
+        }
+    )
+    resource = {
+        "id": "1",
+        "name": [{"family": "Doe", "text": "x"}, {"text": "y"}],
+        "valueString": "v",
+        "valueCode": "c",
+        "data": {"any": ["thing"]},
+    }
+    assert project(resource) == {
+        "id": "1",
+        "name": [{"family": "Doe"}],
+        "valueString": "v",
+        "data": {"any": ["thing"]},
+    }
+    # the resource is left untouched
+    assert resource["name"][0]["text"] == "x"
+
+
+def test_project_resources(mappings):
+    """ """
+    patient = compile_projector(mappings["Patient"])(PATIENT)
+    assert patient == {
+        "resourceType": "Patient",
+        "id": "p1",
+        "meta": {"lastUpdated": "2020-01-01T00:00:00Z"},
+        "name": [{"family": "Doe", "given": ["John"]}],
+        "birthDate": "1970-01-01",
+        "deceasedBoolean": False,
+    }
+    observation = compile_projector(mappings["Observation"])(OBSERVATION)
+    assert observation["valueQuantity"] == OBSERVATION["valueQuantity"]
+    assert observation["component"] == [{"code": {"text": "c"}, "valueString": "v"}]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_project_ndjson(tmp_path, mappings, jobs):
+    """ """
+    input_path = tmp_path / "resources.ndjson"
+    with open(str(input_path), "w", encoding="utf-8") as fp:
+        for index in range(25):
+            fp.write(json.dumps(dict(PATIENT, id=f"p{index}")) + "\n")
+            fp.write(json.dumps(OBSERVATION) + "\n")
+        fp.write("\n" + json.dumps({"resourceType": "Bundle"}) + "\n")
+    output_path = tmp_path / "projected.ndjson.gz"
+    assert project_ndjson(
+        mappings, input_path, output_path, jobs=jobs, chunk_size=7
+    ) == (50, 1)
+    with open_text(output_path) as fp:
+        lines = [json.loads(line) for line in fp]
+    assert [line["id"] for line in lines[:4]] == ["p0", "o1", "p1", "o1"]
+    assert all("extension" not in line for line in lines)
+
+
+def test_cli_project_resources(tmp_path, capsys):
+    """ """
+    make_and_write_es_mappings(
+        tmp_path, FHIR_VERSION.R4.name, resources=["Patient"]
+    )
+    assert list(load_mappings(tmp_path)) == ["Patient"]
+    input_path = tmp_path / "resources.ndjson"
+    input_path.write_text(
+        json.dumps(PATIENT) + "\n" + json.dumps(OBSERVATION) + "\n"
+    )
+    output_path = tmp_path / "projected.ndjson"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        [
+            "es-project-resources",
+            "--mappings",
+            str(tmp_path),
+            str(input_path),
+            str(output_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "1 resources projected" in result.output
+    assert "1 without mapping skipped" in result.output
+    assert json.loads(output_path.read_text())["id"] == "p1"
+
+
+@pytest.mark.parametrize("output_mode", ["bundle", "ndjson", "index-templates"])
+def test_load_mappings_outputs(tmp_path, output_mode):
+    """ """
+    resources = ["Patient", "Observation"]
+    (tmp_path / "files").mkdir()
+    (tmp_path / output_mode).mkdir()
+    make_and_write_es_mappings(
+        tmp_path / "files", FHIR_VERSION.R4.name, resources=resources
+    )
+    make_and_write_es_mappings(
+        tmp_path / output_mode,
+        FHIR_VERSION.R4.name,
+        resources=resources,
+        output_mode=output_mode,
+    )
+    (path_,) = (tmp_path / output_mode).iterdir()
+    assert load_mappings(path_) == load_mappings(tmp_path / "files")
+
+
+def test_load_mappings_invalid(tmp_path):
+    """ """
+    path_ = tmp_path / "mappings.json"
+    path_.write_text(json.dumps({"Patient": {"resourceType": "Patient"}}))
+    with pytest.raises(ValueError):
+        load_mappings(path_)
+    result = CliRunner().invoke(
+        cli.main,
+        ["es-bulk", "-o", str(tmp_path / "out"), "-m", str(path_), str(path_)],
+    )
+    assert result.exit_code == 2
+    assert "is not a mapping files directory" in result.output
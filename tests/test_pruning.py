@@ -0,0 +1,99 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.pruning`."""
+import pytest
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers.elasticsearch.analysis import analyze_mapping
+from fhirpath_helpers.elasticsearch.mapping import generate_mappings
+from fhirpath_helpers.elasticsearch.pruning import expression_paths
+from fhirpath_helpers.elasticsearch.pruning import load_search_paths
+from fhirpath_helpers.elasticsearch.pruning import prune_mapping
+from fhirpath_helpers.elasticsearch.pruning import referenced_tree
+
+
+@pytest.mark.parametrize(
+    "expression,paths",
+    [
+        ("Patient.name", [("Patient", "name")]),
+        (
+            "Patient.name | Practitioner.address.city",
+            [("Patient", "name"), ("Practitioner", "address.city")],
+        ),
+        (
+            "(Observation.value as CodeableConcept).text",
+            [("Observation", "valueCodeableConcept.text")],
+        ),
+        ("Condition.onset.as(dateTime)", [("Condition", "onsetDateTime")]),
+        ("Account.subject.where(resolve() is Patient)", [("Account", "subject")]),
+        (
+            "Library.relatedArtifact.where(type='depends-on').resource",
+            [("Library", "relatedArtifact.resource")],
+        ),
+        (
+            "Patient.deceased.exists() and Patient.deceased != false",
+            [("Patient", "deceased"), ("Patient", "deceased")],
+        ),
+        ("Bundle.entry[0].resource", [("Bundle", "entry.resource")]),
+    ],
+)
+def test_expression_paths(expression, paths):
+    """ """
+    assert expression_paths(expression) == paths
+
+
+def test_load_search_paths():
+    """ """
+    search_paths = load_search_paths(FHIR_VERSION.R4.name)
+    assert {"id", "meta.tag"} <= search_paths["Resource"]
+    assert {"name", "birthDate", "telecom"} <= search_paths["Patient"]
+
+
+def test_prune_mapping():
+    """ """
+    properties = {
+        "id": {"type": "keyword"},
+        "name": {
+            "type": "nested",
+            "properties": {
+                "family": {"type": "keyword"},
+                "period": {"properties": {"start": {"type": "date"}}},
+            },
+        },
+        "valueString": {"type": "text"},
+        "valueQuantity": {"properties": {"value": {"type": "float"}}},
+        "code": {"type": "keyword"},
+        "codeFilter": {"type": "keyword"},
+        "resourceType": {"type": "keyword"},
+    }
+    tree = referenced_tree(["name.family", "value", "code"])
+    assert prune_mapping(properties, tree, "exclude") == {
+        "name": {"type": "nested", "properties": {"family": {"type": "keyword"}}},
+        "valueString": {"type": "text"},
+        "valueQuantity": {"properties": {"value": {"type": "float"}}},
+        "code": {"type": "keyword"},
+        "resourceType": {"type": "keyword"},
+    }
+    pruned = prune_mapping(properties, tree, "disable")
+    disabled = {"type": "object", "enabled": False}
+    assert pruned["id"] == pruned["codeFilter"] == disabled
+    assert pruned["name"]["properties"]["period"] == disabled
+    # the source mapping is left untouched
+    assert "period" in properties["name"]["properties"]
+
+    with pytest.raises(ValueError):
+        prune_mapping(properties, tree, "drop")
+
+
+def test_generate_pruned_mappings():
+    """ """
+    full = generate_mappings(FHIR_VERSION.R4.name, resources=["Patient"])["Patient"]
+    pruned = generate_mappings(
+        FHIR_VERSION.R4.name, resources=["Patient"], prune="exclude", jobs=2
+    )["Patient"]
+    assert {"id", "name", "birthDate", "meta", "resourceType"} <= set(pruned)
+    assert "photo" in full and "photo" not in pruned
+    assert pruned["name"] == full["name"]
+    assert (
+        analyze_mapping(pruned)["total_fields"]
+        < analyze_mapping(full)["total_fields"]
+    )
@@ -0,0 +1,51 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.pytypes`."""
+import json
+import pickle
+
+import pytest
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers.elasticsearch.pytypes import FrozenDict
+from fhirpath_helpers.elasticsearch.pytypes import fhir_types_mapping
+from fhirpath_helpers.elasticsearch.pytypes import freeze
+from fhirpath_helpers.elasticsearch.pytypes import types_mapping_registry
+
+
+def test_frozen_dict():
+    """ """
+    frozen = freeze({"a": {"b": 1}})
+    assert isinstance(frozen["a"], FrozenDict)
+    for mutate in (
+        lambda: frozen.__setitem__("c", 1),
+        lambda: frozen["a"].update(b=2),
+        lambda: frozen.pop("a"),
+        lambda: frozen.setdefault("c", 1),
+        lambda: frozen.clear(),
+    ):
+        with pytest.raises(TypeError):
+            mutate()
+    with pytest.raises(TypeError):
+        del frozen["a"]
+
+    copy = frozen.copy()
+    copy["c"] = 1
+    assert type(copy) is dict and "c" not in frozen
+    assert json.dumps(frozen) == '{"a": {"b": 1}}'
+    restored = pickle.loads(pickle.dumps(frozen))
+    assert restored == frozen and isinstance(restored["a"], FrozenDict)
+
+
+def test_types_mapping_registry():
+    """ """
+    registry = types_mapping_registry(FHIR_VERSION.R4.name)
+    assert registry is types_mapping_registry(FHIR_VERSION.R4.name)
+    assert registry is not types_mapping_registry(FHIR_VERSION.R4.name, "custom")
+    assert registry is not types_mapping_registry(FHIR_VERSION.STU3.name)
+    assert registry == fhir_types_mapping(FHIR_VERSION.R4.name)
+    # shared templates stay shared once frozen
+    assert registry["code"] is registry["Coding"]["properties"]["code"]
+
+    normalized = types_mapping_registry(FHIR_VERSION.R4.name, None, "lower")
+    assert normalized["code"]["normalizer"] == "lower"
+    assert "normalizer" not in registry["code"]
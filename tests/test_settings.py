@@ -0,0 +1,178 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.elasticsearch.settings`."""
+import json
+
+import pytest
+from click.testing import CliRunner
+from fhirpath.enums import FHIR_VERSION
+
+from fhirpath_helpers import cli
+from fhirpath_helpers.elasticsearch.bundle import build_index_templates
+from fhirpath_helpers.elasticsearch.mapping import mapping_documents
+from fhirpath_helpers.elasticsearch.settings import analysis_settings
+from fhirpath_helpers.elasticsearch.settings import index_body
+from fhirpath_helpers.elasticsearch.settings import profile_settings
+from fhirpath_helpers.elasticsearch.settings import resource_settings
+from fhirpath_helpers.elasticsearch.settings import restore_settings
+from fhirpath_helpers.elasticsearch.settings import shard_count
+
+
+def test_analysis_settings():
+    """ """
+    assert analysis_settings() == {}
+    assert analysis_settings("standard", "lowercase") == {}
+    analysis = analysis_settings("fhir_reference", "fhir_token")
+    assert analysis["analyzer"]["fhir_reference"]["filter"] == [
+        "fhir_reference_reference"
+    ]
+    assert "fhir_reference_reference" in analysis["filter"]
+    assert analysis["normalizer"]["fhir_token"]["type"] == "custom"
+
+
+def test_profile_settings():
+    """ """
+    settings = profile_settings("bulk-load")
+    assert settings == {
+        "index": {
+            "number_of_shards": 1,
+            "refresh_interval": "-1",
+            "number_of_replicas": 0,
+            "translog": {
+                "durability": "async",
+                "sync_interval": "30s",
+                "flush_threshold_size": "1gb",
+            },
+        }
+    }
+    settings = profile_settings("serve", token_normalizer="fhir_token")
+    assert settings["index"]["codec"] == "best_compression"
+    assert "fhir_token" in settings["analysis"]["normalizer"]
+    assert profile_settings("analysis") == {"index": {}}
+    with pytest.raises(ValueError):
+        profile_settings("fast")
+
+
+def test_restore_settings():
+    """Only the dynamic settings changed by bulk-load are restored."""
+    bulk_load = profile_settings("bulk-load")["index"]
+    serve = profile_settings("serve")["index"]
+    restore = restore_settings()["index"]
+    assert restore == {
+        "refresh_interval": serve["refresh_interval"],
+        "number_of_replicas": serve["number_of_replicas"],
+        "translog": {"durability": "request"},
+    }
+    assert set(restore) <= set(bulk_load)
+    assert "codec" not in restore and "number_of_shards" not in restore
+
+
+def test_resource_settings():
+    """ """
+    settings = profile_settings("serve")
+    small = {"id": {"type": "keyword"}}
+    assert resource_settings(settings, small) is settings
+    large = {f"field{i}": {"type": "keyword"} for i in range(1234)}
+    limits = resource_settings(settings, large)["index"]["mapping"]
+    assert limits == {"total_fields": {"limit": 1300}}
+    assert "mapping" not in settings["index"]
+
+
+def test_shard_count():
+    """ """
+    assert shard_count() == 1
+    assert shard_count(1024) == 1
+    assert shard_count(30 * 1024**3) == 1
+    assert shard_count(200 * 1024**3) == 7
+    settings = profile_settings("serve")
+    small = {"id": {"type": "keyword"}}
+    sized = resource_settings(settings, small, 200 * 1024**3)
+    assert sized["index"]["number_of_shards"] == 7
+    assert sized["index"]["codec"] == "best_compression"
+    assert settings["index"]["number_of_shards"] == 1
+    settings = profile_settings("analysis")
+    assert resource_settings(settings, small, 200 * 1024**3) is settings
+
+
+def test_mapping_documents_settings():
+    """ """
+    documents = mapping_documents(
+        FHIR_VERSION.R4.name,
+        token_normalizer="fhir_token",
+        resources=["Patient", "ExplanationOfBenefit"],
+        settings_profile="bulk-load",
+    )
+    patient = documents["Patient"]
+    assert list(patient) == ["resourceType", "meta", "settings", "mapping"]
+    assert "mapping" not in patient["settings"]["index"]
+    eob = documents["ExplanationOfBenefit"]["settings"]["index"]["mapping"]
+    assert eob["total_fields"]["limit"] > 1000
+    assert eob["nested_fields"]["limit"] > 50
+
+    body = index_body(patient)
+    assert body["settings"] == patient["settings"]
+    assert body["mappings"]["properties"] == patient["mapping"]["properties"]
+    assert body["mappings"]["_meta"]["resourceType"] == "Patient"
+
+    templates = build_index_templates(documents, FHIR_VERSION.R4.name)
+    template = templates["index_templates"]["fhir-patient"]["template"]
+    assert template["settings"] == patient["settings"]
+
+
+def test_mapping_documents_size_hints():
+    """ """
+    documents = mapping_documents(
+        FHIR_VERSION.R4.name,
+        resources=["Patient", "Observation"],
+        settings_profile="serve",
+        size_hints={"Observation": 100 * 1024**3},
+    )
+    assert documents["Observation"]["settings"]["index"]["number_of_shards"] == 4
+    assert documents["Patient"]["settings"]["index"]["number_of_shards"] == 1
+
+
+def test_cli_settings_profile(tmp_path):
+    """ """
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.main,
+        [
+            "es-generate-mapping",
+            "--no-cache",
+            "-r",
+            "Patient",
+            "--settings-profile",
+            "serve",
+            str(tmp_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "Patient.mapping.json", encoding="utf-8") as fp:
+        document = json.load(fp)
+    assert document["settings"]["index"]["codec"] == "best_compression"
+    assert document["settings"]["index"]["number_of_shards"] == 1
+
+    result = runner.invoke(
+        cli.main,
+        [
+            "es-generate-mapping",
+            "--no-cache",
+            "-r",
+            "Patient",
+            "--settings-profile",
+            "serve",
+            "--size-hint",
+            "Patient=100G",
+            str(tmp_path),
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "Patient.mapping.json", encoding="utf-8") as fp:
+        document = json.load(fp)
+    assert document["settings"]["index"]["number_of_shards"] == 4
+
+    result = runner.invoke(
+        cli.main,
+        ["es-generate-mapping", "--size-hint", "Patient", str(tmp_path)],
+    )
+    assert result.exit_code == 2
+    assert "--size-hint" in result.output
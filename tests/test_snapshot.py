@@ -0,0 +1,118 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.snapshot`."""
+import os
+import pathlib
+import struct
+import zipfile
+
+import pytest
+
+from fhirpath_helpers import snapshot as snapshot_module
+from fhirpath_helpers.snapshot import SNAPSHOT_HEADER
+from fhirpath_helpers.snapshot import SnapshotMismatch
+from fhirpath_helpers.snapshot import build_snapshot
+from fhirpath_helpers.snapshot import compile_spec
+from fhirpath_helpers.snapshot import load_spec_tables
+from fhirpath_helpers.snapshot import read_snapshot
+from fhirpath_helpers.snapshot import spec_hash
+
+STATIC_R4 = (
+    pathlib.Path(__file__).parent.parent
+    / "static/HL7/FHIR/spec/minified/R4/4.0.1.zip"
+)
+
+
+@pytest.fixture(scope="module")
+def r4_tables():
+    """ """
+    return compile_spec(STATIC_R4)
+
+
+def test_snapshot_roundtrip(tmp_path, r4_tables):
+    """ """
+    tables, spec_hash = r4_tables
+    snapshot = tmp_path / "R4-4.0.1.snapshot"
+    assert build_snapshot(STATIC_R4, snapshot) == spec_hash.hex()
+
+    loaded = read_snapshot(snapshot, spec_hash)
+    assert loaded == tables
+    assert "4.0.1" in loaded["version_info"]
+    url, kind, base, type_, elements = loaded["structure_definitions"]["Patient"]
+    assert kind == "resource"
+    assert elements[0][0] == "Patient"
+    assert "http://hl7.org/fhir/ValueSet/administrative-gender" in loaded["valuesets"]
+    assert len(loaded["search_parameters"]) > 1000
+
+    with pytest.raises(SnapshotMismatch):
+        read_snapshot(snapshot, b"\0" * 32)
+
+
+def test_snapshot_fallback(tmp_path, r4_tables, caplog):
+    """Any header mismatch falls back to the JSON files."""
+    tables, spec_hash = r4_tables
+    snapshot = tmp_path / "R4-4.0.1.snapshot"
+    build_snapshot(STATIC_R4, snapshot)
+    data = bytearray(snapshot.read_bytes())
+    # bump the format version
+    struct.pack_into("<H", data, 8, 999)
+    snapshot.write_bytes(bytes(data))
+
+    with pytest.raises(SnapshotMismatch):
+        read_snapshot(snapshot)
+    assert load_spec_tables(STATIC_R4, snapshot) == tables
+    assert "Cannot use spec snapshot" in caplog.text
+
+    snapshot.write_bytes(bytes(data[: SNAPSHOT_HEADER.size - 1]))
+    assert load_spec_tables(STATIC_R4, snapshot) == tables
+    assert load_spec_tables(STATIC_R4, tmp_path / "missing") == tables
+
+
+def test_snapshot_source_stamp(tmp_path, r4_tables, caplog, monkeypatch):
+    """The spec files are only read when their stamp differs."""
+    tables, _ = r4_tables
+    snapshot = tmp_path / "R4-4.0.1.snapshot"
+    build_snapshot(STATIC_R4, snapshot)
+    calls = list()
+    monkeypatch.setattr(
+        snapshot_module,
+        "spec_hash",
+        lambda source: calls.append(source) or spec_hash(source),
+    )
+    assert load_spec_tables(STATIC_R4, snapshot) == tables
+    assert calls == []
+
+    copy = tmp_path / "4.0.1.zip"
+    copy.write_bytes(STATIC_R4.read_bytes())
+    assert load_spec_tables(copy, snapshot) == tables
+    assert calls == [copy]
+    assert "Cannot use spec snapshot" not in caplog.text
+
+
+def test_snapshot_source_modified(tmp_path, r4_tables, caplog):
+    """A snapshot built from other spec files isn't used."""
+    tables, _ = r4_tables
+    source = tmp_path / "spec"
+    source.mkdir()
+    with zipfile.ZipFile(str(STATIC_R4)) as zip_ref:
+        for info in zip_ref.infolist():
+            if not info.is_dir():
+                name = info.filename.rsplit("/", 1)[-1]
+                (source / name).write_bytes(zip_ref.read(info))
+    snapshot = tmp_path / "R4-4.0.1.snapshot"
+    assert build_snapshot(source, snapshot) == spec_hash(source).hex()
+    assert load_spec_tables(source, snapshot) == tables
+    assert "Cannot use spec snapshot" not in caplog.text
+
+    # touched only
+    stat = (source / "version.info").stat()
+    os.utime(source / "version.info", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10))
+    assert load_spec_tables(source, snapshot) == tables
+    assert "Cannot use spec snapshot" not in caplog.text
+
+    (source / "version.info").write_text(
+        (source / "version.info").read_text() + "\n# modified\n"
+    )
+    loaded = load_spec_tables(source, snapshot)
+    assert "Cannot use spec snapshot" in caplog.text
+    assert loaded["version_info"].endswith("# modified\n")
+    assert loaded["code_tables"] == tables["code_tables"]
@@ -0,0 +1,332 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.spec_cache`."""
+import http.server
+import json
+import multiprocessing
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+import pytest
+from click.testing import CliRunner
+
+from fhirpath_helpers import cli
+from fhirpath_helpers import spec_cache
+from fhirpath_helpers.spec_cache import MANIFEST_FILE
+from fhirpath_helpers.spec_cache import cache_file_for
+from fhirpath_helpers.spec_cache import cache_lock
+from fhirpath_helpers.spec_cache import fetch_all
+from fhirpath_helpers.spec_cache import fetch_to_cache
+from fhirpath_helpers.spec_cache import list_cache
+from fhirpath_helpers.spec_cache import parse_size
+from fhirpath_helpers.spec_cache import prune_cache
+from fhirpath_helpers.spec_cache import spec_artifact_urls
+from fhirpath_helpers.spec_cache import verify_cache
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every path with its own name after a short delay, keeping
+    track of how many requests are served at the same time. ``/flaky`` cuts
+    the first transfer half way, then fails once and supports Range
+    requests."""
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    hits = 0
+    ranges = list()
+
+    def log_message(self, *args):
+        """ """
+
+    def do_GET(self):
+        """ """
+        cls = type(self)
+        with cls.lock:
+            cls.hits += 1
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            cls.ranges.append(self.headers.get("Range"))
+        try:
+            time.sleep(0.2)
+            if self.path == "/missing":
+                self.send_error(404)
+                return
+            body = self.path.encode() * 1024
+            if self.path == "/flaky":
+                # larger than a download chunk
+                body *= 64
+                if cls.hits == 2:
+                    self.send_error(404)
+                    return
+                range_ = self.headers.get("Range")
+                start = range_ and int(range_.split("=")[1].split("-")[0])
+                if start:
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+                    )
+                    body = body[start:]
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if cls.hits == 1:
+                    self.wfile.write(body[: len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+@pytest.fixture
+def server():
+    """ """
+    SlowHandler.active = SlowHandler.max_active = SlowHandler.hits = 0
+    SlowHandler.ranges = list()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_spec_artifact_urls():
+    """ """
+    version_info_url, definitions_url = spec_artifact_urls("R4", "4.0.1")
+    assert version_info_url.endswith("/R4/4.0.1-version.info")
+    assert definitions_url.endswith("/R4/4.0.1-definitions.json.zip")
+
+
+def test_fetch_all_concurrent(server, tmp_path):
+    """ """
+    urls = [f"{server}/artifact-{i}" for i in range(6)]
+    files = fetch_all(urls, tmp_path / "spec", concurrency=3)
+
+    assert files == [cache_file_for(tmp_path / "spec", url) for url in urls]
+    for i, file_ in enumerate(files):
+        assert file_.read_bytes() == f"/artifact-{i}".encode() * 1024
+    assert SlowHandler.max_active == 3
+    # no temporary download directory is left behind
+    assert not [
+        p for p in (tmp_path / "spec").iterdir() if p.name.startswith(".tmp-")
+    ]
+
+
+def test_fetch_all_cache(server, tmp_path):
+    """ """
+    urls = [f"{server}/a", f"{server}/b"]
+    fetch_all(urls, tmp_path)
+    assert SlowHandler.hits == 2
+    fetch_all(urls, tmp_path)
+    assert SlowHandler.hits == 2
+    fetch_all(urls, tmp_path, use_cache=False)
+    assert SlowHandler.hits == 4
+
+
+def test_fetch_all_failure_is_atomic(server, tmp_path):
+    """ """
+    import requests
+
+    with pytest.raises(requests.HTTPError):
+        fetch_all([f"{server}/ok", f"{server}/missing"], tmp_path)
+    assert not cache_file_for(tmp_path, f"{server}/missing").exists()
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith(".tmp-")]
+
+
+def test_fetch_resumes_previous_run(server, tmp_path):
+    """A download interrupted by a failed fetch is resumed by the next one."""
+    import requests
+
+    url = f"{server}/flaky"
+    with pytest.raises(requests.HTTPError):
+        fetch_to_cache(url, tmp_path)
+    assert not cache_file_for(tmp_path, url).exists()
+    assert list(tmp_path.glob(".partial/*.part"))
+    # a partial download is kept unless stale
+    assert prune_cache(tmp_path) == list()
+
+    cache_file = fetch_to_cache(url, tmp_path)
+    assert cache_file.read_bytes() == b"/flaky" * 1024 * 64
+    assert SlowHandler.ranges[0] is None
+    assert SlowHandler.ranges[-1].startswith("bytes=")
+    assert not list(tmp_path.glob(".partial/*.part"))
+    assert verify_cache(tmp_path) == dict()
+
+
+def test_parse_size():
+    """ """
+    assert parse_size(None) is None
+    assert parse_size("1024") == 1024
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5M") == int(1.5 * 1024 ** 2)
+    assert parse_size("1GB") == 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_manifest(server, tmp_path):
+    """ """
+    url = f"{server}/a"
+    cache_file = fetch_to_cache(url, tmp_path)
+    manifest = json.loads((tmp_path / MANIFEST_FILE).read_text())
+    entry = manifest[cache_file.name]
+    assert entry["url"] == url
+    assert entry["size"] == cache_file.stat().st_size
+    assert len(entry["sha256"]) == 64
+    assert [e["name"] for e in list_cache(tmp_path)] == [cache_file.name]
+
+
+def test_corrupted_file_is_refetched(server, tmp_path):
+    """ """
+    url = f"{server}/a"
+    cache_file = fetch_to_cache(url, tmp_path)
+    content = cache_file.read_bytes()
+    # same size, other content
+    cache_file.write_bytes(b"x" * len(content))
+    assert verify_cache(tmp_path, remove=False) == {
+        cache_file.name: "sha256 mismatch"
+    }
+
+    assert fetch_to_cache(url, tmp_path) == cache_file
+    assert SlowHandler.hits == 2
+    assert cache_file.read_bytes() == content
+    assert verify_cache(tmp_path) == dict()
+
+    # truncated
+    cache_file.write_bytes(content[:10])
+    assert verify_cache(tmp_path) == {cache_file.name: "size mismatch"}
+    assert not cache_file.exists()
+    assert list_cache(tmp_path) == list()
+
+
+def test_lru_eviction(server, tmp_path, monkeypatch):
+    """ """
+    monkeypatch.setattr(spec_cache, "EVICTION_GRACE", 0)
+    size = len(b"/a" * 1024)
+    a, b = fetch_all([f"{server}/a", f"{server}/b"], tmp_path, concurrency=1)
+    # a becomes the most recently used
+    fetch_to_cache(f"{server}/a", tmp_path)
+    c = fetch_to_cache(f"{server}/c", tmp_path, max_size=2 * size)
+    assert a.exists() and c.exists()
+    assert not b.exists()
+    assert {e["name"] for e in list_cache(tmp_path)} == {a.name, c.name}
+
+    (tmp_path / "leftover").write_bytes(b"x")
+    removed = prune_cache(tmp_path, max_size=size)
+    assert sorted(removed) == sorted(["leftover", a.name])
+    assert [e["name"] for e in list_cache(tmp_path)] == [c.name]
+
+
+def test_eviction_grace(server, tmp_path):
+    """Recently accessed files may be in use, they aren't evicted."""
+    a = fetch_to_cache(f"{server}/a", tmp_path)
+    b = fetch_to_cache(f"{server}/b", tmp_path, max_size=0)
+    assert a.exists() and b.exists()
+    assert prune_cache(tmp_path, max_size=0) == list()
+
+
+@pytest.mark.skipif(fcntl is None, reason="no flock")
+def test_lookup_hashes_unlocked(server, tmp_path, monkeypatch):
+    """Cached files are verified without holding the cache lock."""
+    url = f"{server}/a"
+    cache_file = fetch_to_cache(url, tmp_path)
+    hashed = list()
+    file_sha256 = spec_cache.file_sha256
+
+    def unlocked_sha256(path_):
+        with open(str(tmp_path / ".lock"), "a") as fp:
+            # raises if the lock is held
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        hashed.append(path_)
+        return file_sha256(path_)
+
+    monkeypatch.setattr(spec_cache, "file_sha256", unlocked_sha256)
+    assert fetch_to_cache(url, tmp_path) == cache_file
+    assert hashed == [cache_file]
+    assert SlowHandler.hits == 1
+
+
+def test_fetch_all_eviction_keeps_batch(server, tmp_path, monkeypatch):
+    """The files of a batch larger than the cache budget are all kept, only
+    the older files are evicted."""
+    monkeypatch.setattr(spec_cache, "EVICTION_GRACE", 0)
+    size = len(b"/a" * 1024)
+    old = fetch_to_cache(f"{server}/old", tmp_path)
+    files = fetch_all(
+        [f"{server}/a", f"{server}/b", f"{server}/c"],
+        tmp_path,
+        concurrency=1,
+        max_size=2 * size,
+    )
+    assert all(f.exists() for f in files)
+    assert not old.exists()
+    assert {e["name"] for e in list_cache(tmp_path)} == {f.name for f in files}
+
+
+def _hold_lock(cache_dir, started, duration):
+    """ """
+    with cache_lock(cache_dir):
+        started.set()
+        time.sleep(duration)
+
+
+def test_cache_lock(tmp_path):
+    """The lock is held across processes."""
+    started = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_hold_lock, args=(tmp_path, started, 0.5)
+    )
+    process.start()
+    try:
+        assert started.wait(10)
+        start = time.monotonic()
+        with cache_lock(tmp_path):
+            waited = time.monotonic() - start
+        assert waited > 0.2
+    finally:
+        process.join()
+
+
+def test_cache_cli(server, tmp_path, monkeypatch):
+    """ """
+    monkeypatch.setattr(cli, "SPEC_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(spec_cache, "EVICTION_GRACE", 0)
+    cache_file = fetch_to_cache(f"{server}/a", tmp_path)
+    runner = CliRunner()
+
+    result = runner.invoke(cli.main, ["cache", "ls"])
+    assert result.exit_code == 0
+    assert cache_file.name in result.output
+    assert f"{server}/a" in result.output
+
+    result = runner.invoke(cli.main, ["cache", "verify"])
+    assert result.exit_code == 0
+
+    cache_file.write_bytes(b"corrupted")
+    result = runner.invoke(cli.main, ["cache", "verify"])
+    assert result.exit_code == 1
+    assert "size mismatch" in result.output
+
+    fetch_to_cache(f"{server}/b", tmp_path)
+    result = runner.invoke(cli.main, ["cache", "prune", "--max-size", "0"])
+    assert result.exit_code == 0
+    assert "1 files removed" in result.output
+
+    result = runner.invoke(cli.main, ["cache", "clear"])
+    assert result.exit_code == 0
+    assert [p.name for p in tmp_path.iterdir()] == [".lock"]
@@ -0,0 +1,181 @@
+# _*_ coding: utf-8 _*_
+"""Tests for `fhirpath_helpers.terminology`."""
+import pathlib
+import sys
+
+import pytest
+
+from fhirpath_helpers.snapshot import build_snapshot
+from fhirpath_helpers.snapshot import load_code_tables
+from fhirpath_helpers.terminology import CodeTables
+from fhirpath_helpers.terminology import compile_code_tables
+
+STATIC_R4 = (
+    pathlib.Path(__file__).parent.parent
+    / "static/HL7/FHIR/spec/minified/R4/4.0.1.zip"
+)
+
+CS = "http://example.org/cs"
+CS_FRAGMENT = "http://example.org/fragment"
+CS_PARENT = "http://example.org/parent"
+CS_PART_OF = "http://example.org/part-of"
+
+CODESYSTEMS = {
+    CS: {
+        "url": CS,
+        "content": "complete",
+        "concept": [
+            {"code": "a", "concept": [{"code": "a1", "concept": [{"code": "a11"}]}]},
+            {"code": "b"},
+            {"code": "c"},
+        ],
+    },
+    CS_FRAGMENT: {
+        "url": CS_FRAGMENT,
+        "content": "fragment",
+        "concept": [{"code": "x"}],
+    },
+    # a1 is-a a through a property, besides the nesting
+    CS_PARENT: {
+        "url": CS_PARENT,
+        "content": "complete",
+        "property": [{"code": "parent", "type": "code"}],
+        "concept": [
+            {"code": "a"},
+            {"code": "a1", "property": [{"code": "parent", "valueCode": "a"}]},
+        ],
+    },
+    CS_PART_OF: {
+        "url": CS_PART_OF,
+        "content": "complete",
+        "hierarchyMeaning": "part-of",
+        "concept": [{"code": "a", "concept": [{"code": "a1"}]}],
+    },
+}
+
+
+def valueset(url, include=(), exclude=()):
+    """ """
+    return {
+        "url": url,
+        "compose": {"include": list(include), "exclude": list(exclude)},
+    }
+
+
+def filtered(url, property_, op, value, system=CS):
+    """ """
+    filter_ = {"property": property_, "op": op, "value": value}
+    return valueset(url, [{"system": system, "filter": [filter_]}])
+
+
+VALUESETS = {
+    vs["url"]: vs
+    for vs in (
+        valueset("all", [{"system": CS}]),
+        valueset(
+            "listed", [{"system": CS, "concept": [{"code": "b"}, {"code": "z"}]}]
+        ),
+        filtered("is-a", "concept", "is-a", "a"),
+        filtered("descendent-of", "concept", "descendent-of", "a"),
+        filtered("regex", "code", "regex", "a"),
+        filtered("parent-property", "concept", "is-a", "a", CS_PARENT),
+        filtered("part-of", "concept", "is-a", "a", CS_PART_OF),
+        valueset(
+            "excluded-regex",
+            [{"system": CS}, {"system": CS_FRAGMENT}],
+            [{"system": CS, "filter": [{"property": "code", "op": "regex"}]}],
+        ),
+        valueset(
+            "excluded-unknown",
+            [{"system": CS}, {"system": CS_FRAGMENT}],
+            [{"valueSet": ["missing"]}],
+        ),
+        valueset("excluded", [{"valueSet": ["all|1.0"]}], [{"valueSet": ["is-a"]}]),
+        valueset("union", [{"valueSet": ["listed"]}, {"system": CS_FRAGMENT}]),
+        valueset("intersection", [{"valueSet": ["all", "listed"]}]),
+        valueset("unknown", [{"system": "http://loinc.org"}]),
+        valueset(
+            "cycle1",
+            [{"valueSet": ["cycle2"]}, {"system": CS, "concept": [{"code": "c"}]}],
+        ),
+        valueset("cycle2", [{"valueSet": ["cycle1"]}]),
+        {"url": "no-compose"},
+    )
+}
+
+
+@pytest.fixture(scope="module")
+def tables():
+    """ """
+    return CodeTables(compile_code_tables(VALUESETS, CODESYSTEMS))
+
+
+@pytest.mark.parametrize(
+    "url,complete,codes",
+    [
+        ("all", True, {"a", "a1", "a11", "b", "c"}),
+        ("listed", True, {"b", "z"}),
+        ("is-a", True, {"a", "a1", "a11"}),
+        ("descendent-of", True, {"a1", "a11"}),
+        ("regex", False, set()),
+        ("excluded-unknown", False, set()),
+        ("excluded", True, {"b", "c"}),
+        ("intersection", True, {"b"}),
+        ("unknown", False, set()),
+        ("cycle1", False, {"c"}),
+        ("no-compose", False, set()),
+    ],
+)
+def test_compile_code_tables(tables, url, complete, codes):
+    """ """
+    assert tables.is_complete(url) is complete
+    assert tables.codes(url) == sorted((CS, code) for code in codes)
+
+
+def test_unresolved_rules(tables):
+    """Unresolved filters and excludes make incomplete tables, without codes
+    which might not belong to the ValueSet."""
+    for url in ("parent-property", "part-of"):
+        assert not tables.is_complete(url)
+        assert tables.codes(url) == []
+    # the CS codes might be excluded, not the fragment ones
+    assert tables.codes("excluded-regex") == [(CS_FRAGMENT, "x")]
+
+
+def test_code_tables(tables):
+    """ """
+    assert len(tables) == len(VALUESETS)
+    assert tables.is_complete("union") is False
+    assert tables.codes("union") == [(CS, "b"), (CS, "z"), (CS_FRAGMENT, "x")]
+    assert tables.contains("union", "x", CS_FRAGMENT)
+    assert tables.contains("union", "x")
+    assert not tables.contains("union", "x", CS)
+    assert not tables.contains("union", "x", "http://example.org/other")
+    assert tables.contains("all|2.0", "a11", CS)
+    assert "all|2.0" in tables
+    assert "missing" not in tables
+    with pytest.raises(KeyError):
+        tables.contains("missing", "a")
+
+
+def test_load_code_tables(tmp_path):
+    """ """
+    snapshot = tmp_path / "R4-4.0.1.snapshot"
+    build_snapshot(STATIC_R4, snapshot)
+    tables = load_code_tables(STATIC_R4, snapshot)
+    assert tables.tables == load_code_tables(STATIC_R4).tables
+
+    gender = "http://hl7.org/fhir/ValueSet/administrative-gender"
+    system = "http://hl7.org/fhir/administrative-gender"
+    assert tables.is_complete(gender)
+    assert tables.codes(gender) == [
+        (system, code) for code in ("female", "male", "other", "unknown")
+    ]
+    assert tables.contains(gender + "|4.0.1", "male", system)
+    assert not tables.contains(gender, "male", "http://snomed.info/sct")
+    code = next(iter(tables.tables[gender][1][system]))
+    assert code is sys.intern(code)
+
+    # whole CodeSystems of other ValueSets, SNOMED CT is not at hand
+    assert len(tables.codes("http://hl7.org/fhir/ValueSet/resource-types")) > 140
+    assert not tables.is_complete("http://hl7.org/fhir/ValueSet/condition-code")